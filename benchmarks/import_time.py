@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+'''Benchmark of the startup of the worker scripts.
+
+Measures the time to start an interpreter and import a worker (sixtrack,
+preprocess), from the source folder as shipped formerly and from its
+zipapp bundle (see pysixdesk.lib.bundle), against a bare interpreter, and
+compares the files to transfer.
+
+Usage: python3 benchmarks/import_time.py [n_runs]
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
+from pysixdesk.lib import bundle  # noqa: E402
+
+WORKERS = ['sixtrack', 'preprocess']
+
+
+def startup(cmd, n_runs, env=None):
+    '''The median wall time of a command (seconds)'''
+    timings = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, env=env, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def folder_size(folder):
+    '''The number of files and size (kB) of the sources of a folder'''
+    files = [i for i in Path(folder).rglob('*.py')]
+    return len(files), sum(i.stat().st_size for i in files) / 1024
+
+
+def main():
+    n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    folder = tempfile.mkdtemp(prefix='pysixdesk_bench_')
+    env = dict(os.environ)
+    env.pop('PYTHONPATH', None)
+    source_env = dict(env, PYTHONPATH=str(bundle.ROOT))
+    try:
+        base = startup([sys.executable, '-c', 'pass'], n_runs, env)
+        n_files, size = folder_size(bundle.ROOT / bundle.PACKAGE)
+        print(f'median of {n_runs} runs, bare interpreter {base:.3f} s, '
+              f'source folder {n_files} files ({size:.0f} kB)')
+        print('%-12s %10s %10s %14s' % ('worker', 'source', 'bundle',
+                                         'bundle size'))
+        for name in WORKERS:
+            script = bundle.ROOT / bundle.PACKAGE / 'lib' / (name + '.py')
+            pyz = bundle.build(script, folder)
+            source = startup([sys.executable, '-c',
+                              f'import pysixdesk.lib.{name}'], n_runs,
+                             source_env)
+            packed = startup([sys.executable, pyz, '--help'], n_runs, env)
+            n_modules = len(bundle.required_modules(script))
+            print('%-12s %10.3f %10.3f %7d modules, %.0f kB' % (
+                name, source, packed, n_modules,
+                os.path.getsize(pyz) / 1024))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
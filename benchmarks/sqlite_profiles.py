@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+'''Benchmark of the sqlite profiles of SQLDatabaseAdaptor.
+
+Mimics the write pattern of a study: per-row creation of the tasks (as in
+prepare_sixtrack_input), then gathering (one blob update and a block of
+result rows per task) and finally the removal of half of the tasks (as in
+purge_table).
+
+Usage: python3 benchmarks/sqlite_profiles.py [n_tasks]
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+from pathlib import Path
+from collections import OrderedDict
+
+sys.path.insert(0, str(Path(__file__).absolute().parents[1]))
+from pysixdesk.lib.pysixdb import SixDB  # noqa: E402
+
+TASK_COLS = OrderedDict([
+    ('task_id', 'INTEGER'),
+    ('wu_id', 'int'),
+    ('fort_6', 'blob'),
+    ('status', 'text'),
+    ('mtime', 'bigint')])
+TASK_KEYS = {'primary': ['task_id'], 'autoincrement': ['task_id']}
+RESULT_COLS = OrderedDict([('task_id', 'int'), ('row_num', 'int')] +
+                          [('col%d' % i, 'float') for i in range(58)])
+RESULT_KEYS = {'primary': ['task_id', 'row_num'],
+               'foreign': {'sixtrack_task': [['task_id'], ['task_id']]}}
+ROWS_PER_TASK = 30
+BLOB = os.urandom(64 * 1024)
+
+
+def run(name, settings, bulk, n_tasks, folder):
+    '''Run the workload with the given settings, returns the timings'''
+    db_name = os.path.join(folder, name + '.db')
+    db = SixDB({'db_type': 'sql', 'db_name': db_name}, settings=settings,
+               create=True)
+    db.create_table('sixtrack_task', OrderedDict(TASK_COLS), dict(TASK_KEYS))
+    db.create_table('six_results', OrderedDict(RESULT_COLS),
+                    dict(RESULT_KEYS))
+    timings = OrderedDict()
+
+    start = time.perf_counter()
+    with db.profile(bulk):
+        for i in range(n_tasks):
+            mtime = int(time.time() * 1E7)
+            db.insert('sixtrack_task', {'wu_id': i, 'mtime': mtime})
+            task_id = db.select('sixtrack_task', ['task_id'],
+                                f'mtime={mtime} and wu_id={i}')[0][0]
+            db.update('sixtrack_task', {'status': 'submitted'},
+                      f'task_id={task_id}')
+    timings['prepare'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with db.profile(bulk):
+        for task_id in range(1, n_tasks + 1):
+            db.update('sixtrack_task', {'fort_6': BLOB, 'status': 'Success'},
+                      f'task_id={task_id}')
+            rows = OrderedDict()
+            rows['task_id'] = [task_id] * ROWS_PER_TASK
+            rows['row_num'] = list(range(ROWS_PER_TASK))
+            for col in list(RESULT_COLS.keys())[2:]:
+                rows[col] = [0.1] * ROWS_PER_TASK
+            db.insertm('six_results', rows)
+    timings['gather'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    db.remove('sixtrack_task', f'task_id<={n_tasks // 2}')
+    db.vacuum()
+    timings['purge'] = time.perf_counter() - start
+    db.close()
+    return timings
+
+
+def main():
+    n_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    folder = tempfile.mkdtemp(prefix='pysixdesk_bench_')
+    cases = OrderedDict([
+        ('legacy', ('legacy', None)),
+        ('durable', ('durable', None)),
+        ('interactive', ('interactive', None)),
+        ('interactive+bulk-load', ('interactive', 'bulk-load'))])
+    try:
+        print(f'{n_tasks} tasks, {ROWS_PER_TASK} result rows and a '
+              f'{len(BLOB) // 1024} kB blob per task (seconds)')
+        print('%-22s %10s %10s %10s' % ('profile', 'prepare', 'gather',
+                                         'purge'))
+        for name, (settings, bulk) in cases.items():
+            timings = run(name.replace('+', '_'), settings, bulk, n_tasks,
+                          folder)
+            print('%-22s %10.3f %10.3f %10.3f' % (name, *timings.values()))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
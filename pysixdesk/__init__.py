@@ -1,10 +1,5 @@
-from .lib.study import Study
-from .lib.workspace import WorkSpace
-from .lib.pysixdb import SixDB
-from .lib.submission import HTCondor
-from .lib.mysqladm import MysqlAdmin
-
 import logging
+import importlib
 # The module level logger is 'pysixdesk'
 
 default_frmt = logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s',
@@ -16,9 +11,34 @@ sh.setFormatter(default_frmt)
 logger.addHandler(sh)
 logger.setLevel(logging.INFO)
 
+# the public classes and their modules, imported on first access so that
+# the workers only import the modules they use
+_exports = {'Study': '.lib.study',
+            'SixDB': '.lib.pysixdb',
+            'WorkSpace': '.lib.workspace',
+            'HTCondor': '.lib.submission',
+            'LocalCluster': '.lib.submission',
+            'MysqlAdmin': '.lib.mysqladm'}
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError("module %r has no attribute %r" % (__name__,
+                                                                 name))
+    module = importlib.import_module(_exports[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_exports))
+
+
 __all__ = []
 __all__.append('Study')
 __all__.append('SixDB')
 __all__.append('WorkSpace')
 __all__.append('HTCondor')
+__all__.append('LocalCluster')
 __all__.append('MysqlAdmin')
@@ -0,0 +1,179 @@
+'''Zipapp bundles of the worker scripts.
+
+Instead of transferring the whole pysixdesk folder with each job, the
+modules a worker script imports (directly or not, found by scanning the
+import statements of the sources) are packed in a single executable
+zipapp, run as ``<bundle> wu_id input.ini``. Its __main__ calls the main
+function of the worker.
+
+The sources are packed with their bytecode (unchecked hash based .pyc,
+zipimport can't cache it), an interpreter of another version falls back to
+the sources. The bundle is rebuilt only when the sources or the version
+change: their digest is kept in the zip comment, and the archive is
+reproducible (fixed timestamps, sorted entries).
+'''
+import os
+import ast
+import zipfile
+import importlib.util
+import py_compile
+import logging
+import tempfile
+from pathlib import Path
+
+from .cache import digest
+
+logger = logging.getLogger(__name__)
+
+PACKAGE = 'pysixdesk'
+# the folder of the package
+ROOT = Path(__file__).absolute().parents[2]
+INTERPRETER = '/usr/bin/env python3'
+COMMENT = b'pysixdesk bundle '
+DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+MAIN = '''import sys
+from %s import main
+
+sys.exit(main())
+'''
+
+
+def module_name(path):
+    '''The module name of a source file of the package, None if outside'''
+    try:
+        parts = Path(path).absolute().relative_to(ROOT).with_suffix('').parts
+    except ValueError:
+        return None
+    if not parts or parts[0] != PACKAGE:
+        return None
+    if parts[-1] == '__init__':
+        parts = parts[:-1]
+    return '.'.join(parts)
+
+
+def module_file(name):
+    '''The source file of a module of the package, None if not one'''
+    parts = name.split('.')
+    if parts[0] != PACKAGE:
+        return None
+    path = ROOT.joinpath(*parts)
+    if (path / '__init__.py').is_file():
+        return path / '__init__.py'
+    path = path.with_suffix('.py')
+    return path if path.is_file() else None
+
+
+def _imported(path, name):
+    '''The module names imported by a source file'''
+    tree = ast.parse(Path(path).read_text(), str(path))
+    package = name.split('.')
+    if Path(path).name != '__init__.py':
+        package = package[:-1]
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module.split('.') if node.module else []
+            if node.level:
+                base = package[:len(package) - node.level + 1] + base
+            base = '.'.join(base)
+            names.append(base)
+            names.extend(base + '.' + alias.name for alias in node.names)
+    return names
+
+
+def required_modules(script):
+    '''The modules of the package needed by a script.
+
+    Returns:
+        dict: module name -> source file, with the parent packages.
+    '''
+    start = module_name(script)
+    found = {}
+    todo = [start]
+    while todo:
+        name = todo.pop()
+        if name in found:
+            continue
+        path = module_file(name)
+        if path is None:
+            continue
+        found[name] = path
+        parts = name.split('.')
+        todo.extend('.'.join(parts[:i]) for i in range(1, len(parts)))
+        todo.extend(_imported(path, name))
+    return found
+
+
+def _write(z_out, arcname, data):
+    info = zipfile.ZipInfo(arcname, DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    z_out.writestr(info, data)
+
+
+def _bytecode(arcname, source):
+    '''The unchecked hash based .pyc of a source'''
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'source.py')
+        with open(src, 'wb') as f_out:
+            f_out.write(source)
+        out = py_compile.compile(
+            src, os.path.join(tmp, 'source.pyc'), dfile=arcname,
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        with open(out, 'rb') as f_in:
+            return f_in.read()
+
+
+def build(script, folder):
+    '''Build (or reuse) the bundle of a worker script of the package.
+
+    Args:
+        script (str/path): the worker script, with a main function.
+        folder (str/path): the folder of the bundle, named after the script.
+
+    Returns:
+        str: the path of the bundle, None if the script isn't a module of
+        the package.
+    '''
+    name = module_name(script)
+    if name is None:
+        return None
+    modules = required_modules(script)
+    arcnames = sorted(str(path.relative_to(ROOT))
+                      for path in modules.values())
+    sources = [(ROOT / i).read_bytes() for i in arcnames]
+    main = (MAIN % name).encode()
+    arcnames.append('__main__.py')
+    sources.append(main)
+    key = digest(arcnames + ['magic'],
+                 sources + [importlib.util.MAGIC_NUMBER])
+    out_name = os.path.join(folder, Path(script).stem + '.pyz')
+    if os.path.isfile(out_name):
+        try:
+            with zipfile.ZipFile(out_name) as z_in:
+                if z_in.comment == COMMENT + key.encode():
+                    return out_name
+        except zipfile.BadZipFile:
+            pass
+    fd, tmp = tempfile.mkstemp(prefix='.bundle_', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            f_out.write(b'#!' + INTERPRETER.encode() + b'\n')
+            with zipfile.ZipFile(f_out, 'w', zipfile.ZIP_DEFLATED) as z_out:
+                for arcname, source in zip(arcnames, sources):
+                    _write(z_out, arcname, source)
+                    _write(z_out, arcname + 'c', _bytecode(arcname, source))
+                z_out.comment = COMMENT + key.encode()
+        os.chmod(tmp, 0o755)
+        os.replace(tmp, out_name)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    content = "Bundled %d modules for %s in %s." % (len(arcnames) - 1,
+                                                    name, out_name)
+    logger.info(content)
+    return out_name
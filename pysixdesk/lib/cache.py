@@ -0,0 +1,342 @@
+'''Node-local cache of the decompressed inputs of the tasks.
+
+The tasks running on the same node often need the same inputs, e.g. all the
+sixtrack tasks of a preprocess task share its fort.2, fort.8 and fort.16.
+The cache keeps one decompressed copy of each distinct set of inputs, in a
+folder named after the hash of the compressed buffers, and hardlinks the
+files into the working folder of the tasks. The executables (MAD-X and
+SixTrack, often on AFS) are cached the same way, by content, and run from
+the cache. Only the ELF binaries which don't find their libraries relative
+to their own location ($ORIGIN rpath) are cached, the scripts and the other
+executables run in place, since they may refer to their sibling files.
+
+The population is safe between concurrent processes: the entries are
+written in a temporary folder renamed into place, under an exclusive file
+lock. The tasks hold a shared lock while linking the files, so that an
+entry in use is never evicted. The least recently used entries are evicted
+when the size of the cache exceeds its bound.
+'''
+import os
+import time
+import fcntl
+import struct
+import errno
+import shutil
+import hashlib
+import getpass
+import logging
+import tempfile
+from pathlib import Path
+from contextlib import contextmanager
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+# default size bound of the cache (MB)
+DEFAULT_SIZE = 1024
+
+
+def default_root():
+    '''The cache folder: PYSIXDESK_CACHE, or a folder in /tmp, which is
+    local to the node unlike TMPDIR, set to the job scratch by HTCondor.
+
+    Returns:
+        Path: the folder, None if no writable location.
+    '''
+    root = os.environ.get('PYSIXDESK_CACHE')
+    if root:
+        return Path(root)
+    if os.access('/tmp', os.W_OK):
+        return Path('/tmp', f'pysixdesk_cache_{getpass.getuser()}')
+    return None
+
+
+def digest(names, bufs):
+    '''The content hash of a set of named buffers'''
+    sha = hashlib.sha256()
+    for name, buf in zip(names, bufs):
+        sha.update(name.encode() + b'\0')
+        sha.update(len(buf).to_bytes(8, 'little'))
+        sha.update(buf)
+    return sha.hexdigest()
+
+
+def alias_key(*parts):
+    '''An alias from the parts identifying a set of buffers'''
+    text = '\0'.join(map(str, parts))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def cacheable(path):
+    '''Whether an executable runs the same from a copy in the cache: an ELF
+    file without $ORIGIN in its rpath or runpath. The files which can't be
+    read, or without section headers, aren't cacheable.
+    '''
+    try:
+        with open(path, 'rb') as f_in:
+            ident = f_in.read(16)
+            if len(ident) < 16 or ident[:4] != b'\x7fELF':
+                return False
+            order = {1: '<', 2: '>'}[ident[5]]
+            # the layouts of the ELF header, section header and dynamic entry
+            header, section, dynamic = {
+                1: ('HHIIIIIHHHHHH', 'IIIIIIIIII', 'iI'),
+                2: ('HHIQQQIHHHHHH', 'IIQQQQIIQQ', 'qQ')}[ident[4]]
+            header = struct.Struct(order + header)
+            section = struct.Struct(order + section)
+            dynamic = struct.Struct(order + dynamic)
+            fields = header.unpack(f_in.read(header.size))
+            shoff, shentsize, shnum = fields[5], fields[10], fields[11]
+            if shnum == 0 or shentsize < section.size:
+                return False
+            sections = []
+            for i in range(shnum):
+                f_in.seek(shoff + i * shentsize)
+                sections.append(section.unpack(f_in.read(section.size)))
+            for sh_type, offset, size, link in (
+                    (i[1], i[4], i[5], i[6]) for i in sections):
+                if sh_type != 6:  # SHT_DYNAMIC
+                    continue
+                f_in.seek(offset)
+                data = f_in.read(size - size % dynamic.size)
+                strtab = sections[link]
+                for tag, value in dynamic.iter_unpack(data):
+                    if tag == 0:  # DT_NULL
+                        break
+                    if tag not in (15, 29):  # DT_RPATH, DT_RUNPATH
+                        continue
+                    f_in.seek(strtab[4] + value)
+                    rpath = f_in.read(strtab[5] - value).split(b'\0')[0]
+                    if b'ORIGIN' in rpath:
+                        return False
+            return True
+    except (OSError, KeyError, IndexError, struct.error):
+        return False
+
+
+def link_file(source, dest):
+    '''Hardlink a file, or copy it across file systems'''
+    dest = Path(dest)
+    if dest.is_symlink() or dest.exists():
+        dest.unlink()
+    try:
+        os.link(source, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(source, dest)
+
+
+class NodeCache(object):
+    '''Cache of decompressed buffers shared by the processes of a node'''
+
+    def __init__(self, root=None, max_size=None):
+        '''Constructor.
+
+        Args:
+            root (str/path): the cache folder, default_root() if None.
+            max_size (float): the size bound in MB, PYSIXDESK_CACHE_SIZE or
+            DEFAULT_SIZE if None.
+        '''
+        self.root = Path(root or default_root())
+        if max_size is None:
+            max_size = float(os.environ.get('PYSIXDESK_CACHE_SIZE',
+                                            DEFAULT_SIZE))
+        self.max_size = int(max_size * 1024 ** 2)
+        for sub in ['entries', 'aliases', 'locks', 'tmp']:
+            (self.root / sub).mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _lock(self, name, shared=False, blocking=True):
+        '''flock on a file of the lock folder, yields False if not blocking
+        and the lock is held by another process'''
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            mode |= fcntl.LOCK_NB
+        with open(self.root / 'locks' / name, 'a') as f_lock:
+            try:
+                fcntl.flock(f_lock, mode)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f_lock, fcntl.LOCK_UN)
+
+    def _resolve(self, alias):
+        '''The entry of an alias, None if unknown or evicted'''
+        try:
+            key = (self.root / 'aliases' / alias).read_text().strip()
+        except OSError:
+            return None
+        if key and (self.root / 'entries' / key).is_dir():
+            return key
+        return None
+
+    def _write_alias(self, alias, key):
+        tmp = self.root / 'tmp' / f'{alias}.{os.getpid()}'
+        tmp.write_text(key)
+        os.replace(tmp, self.root / 'aliases' / alias)
+
+    def _populate(self, key, names, bufs, raw=False):
+        '''Decompress (or write as they are if raw) the buffers into the
+        entry, by a single process'''
+        folder = self.root / 'entries' / key
+        with self._lock(key):
+            if folder.is_dir():
+                return
+            tmp = Path(tempfile.mkdtemp(prefix=key[:8],
+                                        dir=self.root / 'tmp'))
+            try:
+                for name, buf in zip(names, bufs):
+                    if raw:
+                        (tmp / name).write_bytes(buf)
+                        os.chmod(tmp / name, 0o555)
+                    else:
+                        utils.decompress_buf(buf, str(tmp / name))
+                        os.chmod(tmp / name, 0o444)
+                try:
+                    os.rename(tmp, folder)
+                except OSError:
+                    if not folder.is_dir():
+                        raise
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+        content = "Cached %s in %s." % (', '.join(names), folder)
+        logger.debug(content)
+
+    @contextmanager
+    def _entry(self, names, fetch, alias=None, raw=False):
+        '''Populate the entry of the buffers if needed, yields its key and
+        folder under a shared lock, so that it isn't evicted meanwhile'''
+        key = None if alias is None else self._resolve(alias)
+        for attempt in range(2):
+            if key is None:
+                bufs = fetch()
+                key = digest(names, bufs)
+                self._populate(key, names, bufs, raw)
+                if alias is not None:
+                    self._write_alias(alias, key)
+            folder = self.root / 'entries' / key
+            with self._lock(key, shared=True):
+                if folder.is_dir():
+                    # the modification time of the entry is its last use
+                    os.utime(folder)
+                    yield key, folder
+                    return
+            # evicted in the meantime
+            key = None
+        content = "Failed to cache %s in %s!" % (', '.join(names), self.root)
+        raise FileNotFoundError(content)
+
+    def get(self, names, fetch, dest='.', alias=None):
+        '''Hardlink the decompressed files into the dest folder.
+
+        Args:
+            names (list): the file names.
+            fetch (callable): returns the compressed buffers of the files.
+            dest (str/path): the folder where the files are linked.
+            alias (str): a key identifying the buffers without fetching
+            them, e.g. built from the task id and mtime of their row, so
+            that the buffers are fetched only once per node.
+
+        Returns:
+            str: the content hash of the files.
+        '''
+        with self._entry(names, fetch, alias) as (key, folder):
+            for name in names:
+                link_file(folder / name, Path(dest) / name)
+        self.evict(keep=key)
+        return key
+
+    @contextmanager
+    def executable(self, path):
+        '''A node-local copy of an executable, e.g. on AFS. The file is
+        read once per node and version (path, size and mtime), the copies
+        are shared by content. The copy isn't evicted while in use. The
+        executables which aren't cacheable, see cacheable(), run in place.
+
+        Args:
+            path (str/path): the executable, or its name in the PATH.
+
+        Yields:
+            str: the path of the copy, the given path if not found or not
+            cacheable.
+        '''
+        found = shutil.which(str(path))
+        if found is None:
+            yield str(path)
+            return
+        found = os.path.abspath(found)
+        if not cacheable(found):
+            yield found
+            return
+        stat = os.stat(found)
+        name = os.path.basename(found)
+
+        def fetch():
+            with open(found, 'rb') as f_in:
+                return [f_in.read()]
+        alias = alias_key('exe', found, stat.st_size, stat.st_mtime)
+        with self._entry([name], fetch, alias, raw=True) as (key, folder):
+            yield str(folder / name)
+        self.evict(keep=key)
+
+    def size(self):
+        '''The sizes of the entries (bytes), by entry'''
+        sizes = {}
+        for entry in os.scandir(self.root / 'entries'):
+            total = 0
+            for item in os.scandir(entry.path):
+                total += item.stat(follow_symlinks=False).st_size
+            sizes[entry.name] = (entry.stat().st_mtime, total)
+        return sizes
+
+    def evict(self, keep=None):
+        '''Remove the least recently used entries above the size bound, the
+        entries in use are skipped.
+
+        Returns:
+            int: the number of removed entries.
+        '''
+        with self._lock('evict', blocking=False) as locked:
+            if not locked:
+                return 0
+            sizes = self.size()
+            total = sum(i[1] for i in sizes.values())
+            removed = 0
+            for key, (mtime, size) in sorted(sizes.items(),
+                                             key=lambda x: x[1][0]):
+                if total <= self.max_size:
+                    break
+                if key == keep:
+                    continue
+                with self._lock(key, blocking=False) as free:
+                    if not free:
+                        continue
+                    shutil.rmtree(self.root / 'entries' / key,
+                                  ignore_errors=True)
+                total -= size
+                removed += 1
+            if removed:
+                self._clean_aliases()
+                content = "Evicted %d entries from the cache %s." % (
+                    removed, self.root)
+                logger.info(content)
+        return removed
+
+    def _clean_aliases(self, age=3600):
+        '''Remove the aliases of evicted entries and the stale temporary
+        files'''
+        for alias in os.scandir(self.root / 'aliases'):
+            if self._resolve(alias.name) is None:
+                Path(alias.path).unlink()
+        now = time.time()
+        for item in os.scandir(self.root / 'tmp'):
+            if now - item.stat(follow_symlinks=False).st_mtime > age:
+                if item.is_dir(follow_symlinks=False):
+                    shutil.rmtree(item.path, ignore_errors=True)
+                else:
+                    Path(item.path).unlink()
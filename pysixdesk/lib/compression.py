@@ -0,0 +1,227 @@
+'''Compression codecs for the blobs stored in the database.
+
+Blobs written with an explicit codec are prefixed with a small
+self-describing header::
+
+    magic (4s) | version (B) | codec id (B) | level (B) | size (Q) | crc32 (I)
+
+so that readers can pick the right decompressor and verify the content.
+Blobs without header are legacy gzip streams and are still understood.
+'''
+import io
+import gzip
+import zlib
+import struct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+MAGIC = b'PSXC'
+VERSION = 1
+HEADER = struct.Struct('>4sBBBQI')
+GZIP_MAGIC = b'\x1f\x8b'
+
+# the legacy codec, blobs are plain gzip streams without header
+LEGACY = 'gzip'
+
+
+class Codec(object):
+    '''Base class of the compression codecs'''
+
+    name = None
+    codec_id = None
+    default_level = None
+
+    def available(self):
+        return True
+
+    def compress(self, data, level):
+        raise NotImplementedError
+
+    def decompress(self, data, size):
+        raise NotImplementedError
+
+
+class NoneCodec(Codec):
+    '''Store the data uncompressed'''
+
+    name = 'none'
+    codec_id = 0
+    default_level = 0
+
+    def compress(self, data, level):
+        return data
+
+    def decompress(self, data, size):
+        return data
+
+
+class ZlibCodec(Codec):
+    '''Deflate, the same algorithm as gzip without the gzip framing'''
+
+    name = 'zlib'
+    codec_id = 1
+    default_level = 6
+
+    def compress(self, data, level):
+        return zlib.compress(data, level)
+
+    def decompress(self, data, size):
+        return zlib.decompress(data)
+
+
+class ZstdCodec(Codec):
+    '''Zstandard, requires the zstandard package'''
+
+    name = 'zstd'
+    codec_id = 2
+    default_level = 3
+
+    def available(self):
+        return zstandard is not None
+
+    def compress(self, data, level):
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data, size):
+        return zstandard.ZstdDecompressor().decompress(data,
+                                                      max_output_size=size)
+
+
+class LZ4Codec(Codec):
+    '''LZ4 frame format, requires the lz4 package'''
+
+    name = 'lz4'
+    codec_id = 3
+    default_level = 0
+
+    def available(self):
+        return lz4_frame is not None
+
+    def compress(self, data, level):
+        return lz4_frame.compress(data, compression_level=level)
+
+    def decompress(self, data, size):
+        return lz4_frame.decompress(data)
+
+
+CODECS = {}
+for _cls in (NoneCodec, ZlibCodec, ZstdCodec, LZ4Codec):
+    CODECS[_cls.name] = _cls()
+CODEC_IDS = dict((c.codec_id, c) for c in CODECS.values())
+
+
+def parse_spec(spec):
+    '''Split a codec specification into the codec name and the level.
+
+    Args:
+        spec (str/None): codec specification, e.g. 'zstd', 'zstd:9'. None
+        stands for the legacy gzip format.
+
+    Returns:
+        tuple: (name, level), level is None if not given.
+
+    Raises:
+        ValueError: If the codec or the level is invalid.
+    '''
+    if spec is None:
+        return LEGACY, None
+    spec = str(spec).strip().lower()
+    name, _, level = spec.partition(':')
+    if name != LEGACY and name not in CODECS:
+        raise ValueError("Unknown compression codec %s!" % name)
+    if level:
+        try:
+            level = int(level)
+        except ValueError:
+            raise ValueError("Invalid compression level in %s!" % spec)
+    else:
+        level = None
+    return name, level
+
+
+def get_codec(name):
+    '''Get the codec by name, check that the required package is installed'''
+    codec = CODECS[name]
+    if not codec.available():
+        content = "The compression codec %s isn't available, please install "\
+            "the corresponding python package!" % name
+        raise ImportError(content)
+    return codec
+
+
+def compress(data, spec=None):
+    '''Compress bytes with the given codec specification.
+
+    Args:
+        data (bytes): the data to compress.
+        spec (str/None): codec specification, see parse_spec.
+
+    Returns:
+        bytes: legacy gzip stream if spec is None or 'gzip', header-prefixed
+        blob otherwise.
+    '''
+    name, level = parse_spec(spec)
+    if name == LEGACY:
+        zbuf = io.BytesIO()
+        if level is None:
+            level = 9
+        with gzip.GzipFile(mode='wb', fileobj=zbuf,
+                           compresslevel=level) as zfile:
+            zfile.write(data)
+        return zbuf.getvalue()
+    codec = get_codec(name)
+    if level is None:
+        level = codec.default_level
+    header = HEADER.pack(MAGIC, VERSION, codec.codec_id, level & 0xff,
+                         len(data), zlib.crc32(data) & 0xffffffff)
+    return header + codec.compress(data, level)
+
+
+def decompress(buf):
+    '''Decompress a blob, detecting the codec from its header.
+
+    Args:
+        buf (bytes): header-prefixed blob or legacy gzip stream.
+
+    Returns:
+        bytes: the decompressed data.
+
+    Raises:
+        ValueError: If the format is unknown or the checksum doesn't match.
+    '''
+    buf = bytes(buf)
+    if buf[:len(MAGIC)] == MAGIC:
+        magic, version, codec_id, level, size, crc = HEADER.unpack_from(buf)
+        if version != VERSION:
+            raise ValueError("Unsupported blob version %s!" % version)
+        if codec_id not in CODEC_IDS:
+            raise ValueError("Unknown compression codec id %s!" % codec_id)
+        codec = get_codec(CODEC_IDS[codec_id].name)
+        data = codec.decompress(buf[HEADER.size:], size)
+        if len(data) != size or (zlib.crc32(data) & 0xffffffff) != crc:
+            raise ValueError("Checksum mismatch, the blob is corrupted!")
+        return data
+    elif buf[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return gzip.decompress(buf)
+    else:
+        raise ValueError("Unknown blob format!")
+
+
+def blob_codec(buf):
+    '''Return the name of the codec used for the given blob'''
+    buf = bytes(buf[:HEADER.size])
+    if buf[:len(MAGIC)] == MAGIC and len(buf) == HEADER.size:
+        codec_id = HEADER.unpack(buf)[2]
+        if codec_id in CODEC_IDS:
+            return CODEC_IDS[codec_id].name
+    elif buf[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return LEGACY
+    return None
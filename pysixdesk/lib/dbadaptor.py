@@ -1,6 +1,6 @@
 import sqlite3
-import pymysql
 import logging
+from collections import OrderedDict
 from collections.abc import Iterable
 from contextlib import closing
 from abc import ABC, abstractmethod
@@ -52,6 +52,39 @@ class DatabaseAdaptor(ABC):
         c.execute(sql_cmd)
         c.close()
         conn.commit()
+        if 'index' in keys.keys():
+            for col in keys['index']:
+                self.create_index(conn, name, [col])
+
+    def create_index(self, conn, table_name, columns, index_name=None):
+        '''Create an index on the given columns if it doesn't exist'''
+        if index_name is None:
+            index_name = 'idx_%s_%s' % (table_name, '_'.join(columns))
+        sql = 'CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+            index_name, table_name, ','.join(columns))
+        with closing(conn.cursor()) as c:
+            c.execute(sql)
+        conn.commit()
+
+    def execute(self, conn, sql):
+        '''Execute a statement, e.g. an INSERT ... SELECT done by the
+        database instead of moving the rows through python.
+
+        Returns:
+            int: the number of affected rows.
+        '''
+        with closing(conn.cursor()) as c:
+            c.execute(sql)
+            count = c.rowcount
+        conn.commit()
+        return count
+
+    def add_column(self, conn, table_name, column, dtype):
+        '''Add a new column to an existing table'''
+        sql = 'ALTER TABLE %s ADD COLUMN %s %s' % (table_name, column, dtype)
+        with closing(conn.cursor()) as c:
+            c.execute(sql)
+        conn.commit()
 
     def drop_table(self, conn, table_name):
         '''Drop an exist table'''
@@ -171,6 +204,73 @@ class DatabaseAdaptor(ABC):
 
 class SQLDatabaseAdaptor(DatabaseAdaptor):
 
+    # Named groups of pragmas which can be given to setting() instead of a
+    # dict. page_size and auto_vacuum only take effect on new databases (or
+    # after a VACUUM), setting() runs the VACUUM when an existing database
+    # without auto_vacuum is switched to it.
+    # The WAL journal needs all the connections to be on the same host and
+    # a local file system, so the WAL profiles are opt-in: the study
+    # database uses the 'rollback' profile by default since it usually lives
+    # on AFS/EOS.
+    profiles = {
+        # safe on power loss, every commit is synced
+        'durable': OrderedDict([
+            ('page_size', 16384),
+            ('auto_vacuum', 'incremental'),
+            ('journal_mode', 'wal'),
+            ('synchronous', 'full'),
+            ('foreign_keys', 'on'),
+            ('temp_store', 'memory'),
+            ('cache_size', -16384),
+            ('mmap_size', 0)]),
+        # safe on application crash, for a study database on a local disk
+        'interactive': OrderedDict([
+            ('page_size', 16384),
+            ('auto_vacuum', 'incremental'),
+            ('journal_mode', 'wal'),
+            ('synchronous', 'normal'),
+            ('foreign_keys', 'on'),
+            ('temp_store', 'memory'),
+            ('cache_size', -65536),
+            ('mmap_size', 268435456)]),
+        # on-disk rollback journal, safe on application crash and usable on
+        # network file systems, the default for the study database
+        'rollback': OrderedDict([
+            ('page_size', 16384),
+            ('auto_vacuum', 'incremental'),
+            ('journal_mode', 'delete'),
+            ('synchronous', 'normal'),
+            ('foreign_keys', 'on'),
+            ('temp_store', 'memory'),
+            ('cache_size', -65536),
+            ('mmap_size', 0)]),
+        # for heavy write phases, e.g. update_db and gathering. It only
+        # touches per-connection pragmas, so that it can be applied on top of
+        # any of the other profiles without changing the journal mode
+        'bulk-load': OrderedDict([
+            ('synchronous', 'off'),
+            ('temp_store', 'memory'),
+            ('cache_size', -262144),
+            ('mmap_size', 1073741824)]),
+        # self-contained file without side journal, e.g. for the
+        # databases transferred with the jobs
+        'portable': OrderedDict([
+            ('page_size', 16384),
+            ('auto_vacuum', 'none'),
+            ('journal_mode', 'delete'),
+            ('synchronous', 'off'),
+            ('foreign_keys', 'on'),
+            ('temp_store', 'memory')]),
+        # the historical settings, the journal is kept in memory so a crash
+        # in a transaction can corrupt the database
+        'legacy': OrderedDict([
+            ('foreign_keys', 'on'),
+            ('journal_mode', 'memory'),
+            ('auto_vacuum', 'full'),
+            ('temp_store', 'memory')]),
+    }
+    auto_vacuum_modes = {'none': 0, 'full': 1, 'incremental': 2}
+
     def __init__(self):
         super().__init__()
 
@@ -181,13 +281,79 @@ class SQLDatabaseAdaptor(DatabaseAdaptor):
         conn = sqlite3.connect(db_name)
         return conn
 
-    def setting(self, conn, settings):
-        '''Execute the settings of the database via pragma command'''
+    def profile(self, name):
+        '''Get the pragmas of a named profile'''
+        if name not in self.profiles:
+            content = "Unknown database profile %s! Must be one of %s." % (
+                name, ', '.join(self.profiles.keys()))
+            raise ValueError(content)
+        return OrderedDict(self.profiles[name])
+
+    def setting(self, conn, settings, schema=None):
+        '''Execute the settings of the database via pragma command
+        settings is either a dict of pragmas or the name of a profile,
+        schema is the name of an attached database, e.g. a shard'''
+        if isinstance(settings, str):
+            settings = self.profile(settings)
+        prefix = '' if schema is None else schema + '.'
+        conn.commit()
         with closing(conn.cursor()) as c:
             for key, value in settings.items():
-                sql = 'PRAGMA %s=%s' % (key, str(value))
+                sql = 'PRAGMA %s%s=%s' % (prefix, key, str(value))
                 c.execute(sql)
         conn.commit()
+        if 'auto_vacuum' in settings:
+            self._migrate_auto_vacuum(conn, settings['auto_vacuum'], schema)
+
+    def _migrate_auto_vacuum(self, conn, mode, schema=None):
+        '''Rebuild an existing database whose auto_vacuum mode is still not
+        the given one, the switch from none only takes effect after a
+        VACUUM'''
+        mode = self.auto_vacuum_modes.get(str(mode).lower(), mode)
+        prefix = '' if schema is None else schema + '.'
+        with closing(conn.cursor()) as c:
+            c.execute('PRAGMA %sauto_vacuum' % prefix)
+            current = c.fetchone()[0]
+            c.execute('PRAGMA %spage_count' % prefix)
+            pages = c.fetchone()[0]
+        if pages == 0 or current == int(mode):
+            return
+        content = "Rebuilding the database to switch auto_vacuum from %s to "\
+            "%s, it is done once." % (current, mode)
+        self._logger.info(content)
+        conn.execute('VACUUM' if schema is None else 'VACUUM %s' % schema)
+        conn.commit()
+
+    def current_settings(self, conn, keys, schema=None):
+        '''Get the current values of the given pragmas'''
+        if isinstance(keys, str):
+            keys = self.profile(keys).keys()
+        prefix = '' if schema is None else schema + '.'
+        values = OrderedDict()
+        with closing(conn.cursor()) as c:
+            for key in keys:
+                c.execute('PRAGMA %s%s' % (prefix, key))
+                out = c.fetchone()
+                if out is not None:
+                    values[key] = out[0]
+        return values
+
+    def vacuum(self, conn, pages=None):
+        '''Reclaim the free pages of the database. With auto_vacuum in
+        incremental mode only the given number of pages (all if None) is
+        released, otherwise a full VACUUM is run if pages is None.'''
+        conn.commit()
+        mode = self.current_settings(conn, ['auto_vacuum'])['auto_vacuum']
+        with closing(conn.cursor()) as c:
+            if mode == 2:
+                if pages is None:
+                    c.execute('PRAGMA incremental_vacuum')
+                else:
+                    c.execute('PRAGMA incremental_vacuum(%d)' % int(pages))
+                c.fetchall()
+            elif pages is None:
+                c.execute('VACUUM')
+        conn.commit()
 
     def create_table(self, conn, name, columns, keys, recreate):
         '''Create a new table'''
@@ -208,6 +374,13 @@ class SQLDatabaseAdaptor(DatabaseAdaptor):
             out = c.fetchall()
         return list(out)
 
+    def fetch_columns(self, conn, table_name):
+        '''Fetch the column names of a table'''
+        with closing(conn.cursor()) as c:
+            c.execute('PRAGMA table_info(%s)' % table_name)
+            out = c.fetchall()
+        return [i[1] for i in out]
+
     def insert(self, conn, table_name, values):
         '''Insert a row of values'''
         super(SQLDatabaseAdaptor, self).insert(conn, table_name, values, '?')
@@ -229,6 +402,7 @@ class MySQLDatabaseAdaptor(DatabaseAdaptor):
 
     def create_db(self, host, user, passwd, db_name, **kwargs):
         '''Create a new database'''
+        import pymysql
 
         conn = pymysql.connect(host, user, passwd, **kwargs)
         c = conn.cursor()
@@ -257,12 +431,20 @@ class MySQLDatabaseAdaptor(DatabaseAdaptor):
 
     def new_connection(self, host, user, passwd, db_name=None, **kwargs):
         '''Connect to an existing database'''
+        # imported here, the sqlite jobs don't need it
+        import pymysql
         conn = pymysql.connect(host, user, passwd, db_name, **kwargs)
         return conn
 
     def setting(self, conn, settings):
         pass
 
+    def current_settings(self, conn, keys):
+        return {}
+
+    def vacuum(self, conn, pages=None):
+        pass
+
     def create_user(self, conn, username, passwd, host='%'):
         '''Create a new user'''
         if self.check_user(conn, username):
@@ -331,6 +513,26 @@ class MySQLDatabaseAdaptor(DatabaseAdaptor):
             a = list(c)
         return a
 
+    def fetch_columns(self, conn, table_name):
+        '''Fetch the column names of a table'''
+        with conn.cursor() as c:
+            c.execute("show columns from %s" % table_name)
+            a = [i[0] for i in c]
+        return a
+
+    def create_index(self, conn, table_name, columns, index_name=None):
+        '''Create an index on the given columns if it doesn't exist'''
+        if index_name is None:
+            index_name = 'idx_%s_%s' % (table_name, '_'.join(columns))
+        with conn.cursor() as c:
+            c.execute("show index from %s where Key_name=%%s" % table_name,
+                      (index_name,))
+            if c.fetchall():
+                return
+            c.execute('CREATE INDEX %s ON %s (%s)' % (
+                index_name, table_name, ','.join(columns)))
+        conn.commit()
+
     def insert(self, conn, table_name, values):
         '''Insert a row of values'''
         super(MySQLDatabaseAdaptor, self).insert(conn, table_name, values,
@@ -1,3 +1,5 @@
+import ast
+import numbers
 from collections import OrderedDict
 
 from . import dbtypedict
@@ -53,6 +55,80 @@ class Table(object):
         else:
             raise TypeError("Unsupported input type!")
 
+    @staticmethod
+    def vector_params(params):
+        '''Get the parameters with vector values, e.g. amp=[(8, 10)], and
+        their number of components'''
+        vectors = OrderedDict()
+        for key, val in params.items():
+            if not isinstance(val, list):
+                val = [val]
+            sizes = [len(i) for i in val if isinstance(i, (tuple, list))]
+            if sizes:
+                vectors[key] = max(sizes)
+        return vectors
+
+    @staticmethod
+    def vector_columns(name, size):
+        '''The names of the component columns of a vector parameter'''
+        return ['%s_%d' % (name, i) for i in range(size)]
+
+    @staticmethod
+    def sql_number(value):
+        '''The value as a plain int or float, e.g. for a numpy scalar, None
+        if it isn't a real number'''
+        if isinstance(value, bool) or not isinstance(value, numbers.Real):
+            return None
+        if isinstance(value, numbers.Integral):
+            return int(value)
+        return float(value)
+
+    @staticmethod
+    def sql_literal(value):
+        '''The SQL literal of a value to be used in a where condition, the
+        strings are quoted and their quotes escaped'''
+        if isinstance(value, str):
+            return "'%s'" % value.replace("'", "''")
+        number = Table.sql_number(value)
+        if number is None:
+            content = "Can't use %r in a condition!" % (value,)
+            raise ValueError(content)
+        return repr(number)
+
+    @staticmethod
+    def split_vector(value, size):
+        '''Split a vector value, or its string representation as stored in
+        the parameter column, into its components'''
+        if isinstance(value, str):
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                value = None
+        if not isinstance(value, (tuple, list)):
+            value = [value]
+        comps = [Table.sql_number(i) for i in value]
+        return (comps + [None] * size)[:size]
+
+    def customize_vector_columns(self, table_name, params):
+        '''Add a numeric column per component of the vector parameters, e.g.
+        amp_0 and amp_1 for amp=[(8, 10), (10, 12)], and index the numeric
+        columns of the scanned parameters'''
+        index = self.table_keys[table_name].setdefault('index', [])
+        numeric = [self.type_dict[0], self.type_dict[0.0], 'BIGINT']
+        vectors = self.vector_params(params)
+        for key, val in params.items():
+            if key in vectors:
+                continue
+            if (isinstance(val, list) and len(val) > 1 and
+                    self.tables[table_name].get(key) in numeric and
+                    key not in index):
+                index.append(key)
+        for key, size in vectors.items():
+            for col in self.vector_columns(key, size):
+                self.tables[table_name][col] = self.type_dict[0.0]
+                if col not in index:
+                    index.append(col)
+
     def init_preprocess_tables(self):
         self.tables['preprocess_wu'] = OrderedDict([
             ('wu_id', 'INTEGER'),
@@ -0,0 +1,186 @@
+'''Assembly of the fort.3 input file of SixTrack.
+
+A fort.3 file is a sequence of blocks, each one opened by a keyword line
+(SixTrack reads the first four characters) and closed by a NEXT line, the
+input ends at the ENDE line. The fort.3 of a job is the rendered fort_file
+template followed by the blocks written by MAD-X in fort.3.mad; each part is
+taken up to its ENDE line, and the last ENDE line found closes the file.
+
+Fort3Builder keeps the compiled template and the parsed MAD-X blocks in
+memory, so that the several fort.3 of a job (one turn jobs, BOINC test and
+full runs) are built without temporary files and written once.
+'''
+import os
+import logging
+from pathlib import Path
+from collections import namedtuple, OrderedDict
+
+from . import template
+
+logger = logging.getLogger(__name__)
+
+END = 'ENDE'
+NEXT = 'NEXT'
+# the title line opening the file, not closed by NEXT
+TITLES = ('GEOM', 'FREE')
+
+# name is the upper case keyword of the block, None for the lines between
+# the blocks (comments, blank lines)
+Block = namedtuple('Block', ['name', 'lines'])
+
+# number of builders kept, see load
+CACHE_SIZE = 8
+
+# the machine lengths read in the fort.3.aux files and the builders, on the
+# identity of the files (device, inode, size, mtime)
+_aux_lengths = {}
+_builders = OrderedDict()
+
+
+def parse(text):
+    '''Split the text, up to its ENDE line, into blocks.
+
+    Returns:
+        tuple: (blocks, end), the list of Block and the ENDE line, None if
+        missing.
+    '''
+    blocks = []
+    lines = []
+    name = None
+    end = None
+    for line in text.splitlines(True):
+        if line.lower().startswith(END.lower()):
+            end = line
+            break
+        if name is None and line.strip() and not line.startswith('/'):
+            # a new block, the free lines before it are kept as is
+            if lines:
+                blocks.append(Block(None, lines))
+            name = line[:4].upper()
+            lines = []
+        lines.append(line)
+        if name is not None and (line.upper().startswith(NEXT) or
+                                 (name in TITLES and len(lines) == 1)):
+            blocks.append(Block(name, lines))
+            name = None
+            lines = []
+    if lines:
+        blocks.append(Block(name, lines))
+    return blocks, end
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def aux_length(path='fort.3.aux'):
+    '''The length of the machine, the fifth value of the second line of the
+    fort.3.aux file written by MAD-X'''
+    stamp = _stamp(path)
+    if stamp not in _aux_lengths:
+        with open(path, 'r') as f_in:
+            f_in.readline()
+            _aux_lengths[stamp] = f_in.readline().split()[4]
+    return _aux_lengths[stamp]
+
+
+class Fort3(object):
+    '''A fort.3 file assembled from parts'''
+
+    def __init__(self):
+        self.blocks = []
+        self.end = END + '\n'
+
+    def add(self, text=None, blocks=None, end=None):
+        '''Append a part, either a text or its parsed blocks and end line.
+
+        Returns:
+            Fort3: self.
+        '''
+        if text is not None:
+            blocks, end = parse(text)
+        self.blocks.extend(blocks)
+        if end is not None:
+            self.end = end
+        return self
+
+    def block(self, name):
+        '''The first block of the keyword, None if missing'''
+        name = name[:4].upper()
+        for block in self.blocks:
+            if block.name == name:
+                return block
+        return None
+
+    def text(self):
+        '''The content of the file'''
+        return ''.join(line for block in self.blocks
+                       for line in block.lines) + self.end
+
+    def write(self, path='fort.3'):
+        '''Write the file, replacing a link (e.g. to a cached input) instead
+        of writing through it'''
+        path = Path(path)
+        if path.is_symlink() or path.exists():
+            path.unlink()
+        with open(path, 'w') as f_out:
+            f_out.write(self.text())
+
+
+class Fort3Builder(object):
+    '''Build the fort.3 files of a job from the fort_file template and the
+    fort.3 written by MAD-X'''
+
+    def __init__(self, fort_file, madx_fc3):
+        '''Constructor.
+
+        Args:
+            fort_file (str): the content of the fort_file template.
+            madx_fc3 (str): the content of the fort.3.mad file.
+        '''
+        self.template = template.compile_text(fort_file)
+        self.madx_blocks, self.madx_end = parse(madx_fc3)
+
+    @classmethod
+    def from_files(cls, fort_file, madx_fc3):
+        '''A builder from the paths of the files'''
+        texts = []
+        for path in [fort_file, madx_fc3]:
+            with open(path, 'r') as f_in:
+                texts.append(f_in.read())
+        return cls(*texts)
+
+    def build(self, fort_cfg):
+        '''Render the template and append the MAD-X blocks.
+
+        Args:
+            fort_cfg (dict): the placeholder values of the template.
+
+        Returns:
+            Fort3: the assembled file.
+        '''
+        fort3 = Fort3().add(self.template.render(fort_cfg))
+        return fort3.add(blocks=self.madx_blocks, end=self.madx_end)
+
+
+def load(fort_file, madx_fc3):
+    '''The builder of the files, kept for the next tasks of the process
+    using the same files (e.g. hardlinked from the node cache).
+
+    Raises:
+        FileNotFoundError: if a file is missing.
+    '''
+    for path in [fort_file, madx_fc3]:
+        if not os.path.isfile(path):
+            raise FileNotFoundError("The file %s doesn't exist!" % path)
+    key = (_stamp(fort_file), _stamp(madx_fc3))
+    builder = _builders.get(key)
+    if builder is None:
+        builder = Fort3Builder.from_files(fort_file, madx_fc3)
+        _builders[key] = builder
+        if len(_builders) > CACHE_SIZE:
+            _builders.popitem(last=False)
+    else:
+        _builders.move_to_end(key)
+    return builder
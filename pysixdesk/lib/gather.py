@@ -50,13 +50,25 @@ def gather_results(jobtype, cf, cluster):
     set_sec = cf['db_setting']
     db_info = cf['db_info']
     db = SixDB(db_info, settings=set_sec, create=False)
+    bulk_set = cf.get('db_bulk_setting')
+    if bulk_set is not None:
+        # the connection is only used for gathering
+        db.setting(bulk_set)
     file_list = info_sec['outs']
+    codec = cf.get('codecs', {}).get(f'{jobtype}_task')
     where = "status='submitted'"
     job_ids = db.select(f'{jobtype}_wu', ['task_id', 'unique_id'], where)
     job_ids = [(str(i), str(j)) for i, j in job_ids]
     job_index = dict(job_ids)
     studypath = os.path.dirname(type_path)
-    unfin = cluster.check_running(studypath)#clusterId.processId
+    # one query to the scheduler for the whole gathering
+    snapshot = cluster.status_snapshot(studypath, list(job_index.values()))
+    if snapshot is None:
+        content = "Failed to get the status of the %s jobs!" % jobtype
+        logger.error(content)
+        db.close()
+        return
+    unfin = set(snapshot.unfinished())#clusterId.processId
     jbin = dict(job_index)
     running_jobs = [taid for taid, unid in jbin.items() if unid in unfin]
     [job_index.pop(taid) for taid in running_jobs]
@@ -95,16 +107,20 @@ def gather_results(jobtype, cf, cluster):
             if os.path.isdir(job_path) and os.listdir(job_path):
                 # parse the results
                 parse_results(jobtype, item, job_path, file_list, task_table,
-                              result_cf)
+                              result_cf, codec)
+                lost_turn = task_table.pop('lost_turn', None)
                 coll_action = True
                 where = 'task_id=%s' % item
                 db.update(f'{jobtype}_task', task_table, where)
                 for sec, vals in result_cf.items():
                     vals['task_id'] = [item]*len(vals['mtime'])
                     db.insertm(sec, vals)
-                if task_table['status'] == 'Success':
+                # the lost particles aren't tracked further
+                if task_table['status'] in ['Success', 'Lost']:
                     job_table['status'] = 'complete'
                     job_table['mtime'] = int(time.time() * 1E7)
+                    if lost_turn is not None:
+                        job_table['lost_turn'] = lost_turn
                     where = "task_id=%s" % item
                     db.update(f'{jobtype}_wu', job_table, where)
                     content = f"{jobtype} task {item} has completed normally!"
@@ -119,7 +135,9 @@ def gather_results(jobtype, cf, cluster):
                 db.update(f'{jobtype}_task', task_table, where)
                 content = "This is a failed job!"
                 logger.warning(content)
-            shutil.rmtree(os.path.join(job_path, 'results', item))
+            # the failed and removed jobs may have no results
+            shutil.rmtree(os.path.join(job_path, 'results', item),
+                          ignore_errors=True)
         res_path = os.path.join(job_path, 'results')
         if os.path.isdir(res_path) and (not os.listdir(res_path)):
             shutil.rmtree(job_path)
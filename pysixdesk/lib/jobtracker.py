@@ -0,0 +1,211 @@
+'''Tracking of the HTCondor jobs from their user (event) logs.
+
+The submit description writes an event log per job
+(<output>/<task>/htcondor.<ClusterId>.<ProcId>.log). The tracker reads the
+new events of these logs incrementally, remembering the byte offset of
+every log, and keeps the state of every job keyed by ClusterId.ProcId, so
+that the status of the jobs is known without querying the schedd.
+'''
+import os
+import re
+import glob
+import json
+import logging
+
+# the job states, the same values as the JobStatus attribute of HTCondor
+IDLE = 1
+RUNNING = 2
+REMOVED = 3
+COMPLETED = 4
+HELD = 5
+
+# event code -> job state, the other events don't change the state
+EVENT_STATES = {
+    0: IDLE,  # submit
+    1: RUNNING,  # execute
+    4: IDLE,  # evicted
+    5: COMPLETED,  # terminated
+    7: IDLE,  # shadow exception
+    9: REMOVED,  # aborted
+    10: IDLE,  # suspended
+    11: RUNNING,  # unsuspended
+    12: HELD,  # held
+    13: IDLE,  # released
+}
+# the states of the jobs still in the queue
+UNFINISHED = (IDLE, RUNNING, HELD)
+
+EVENT_RE = re.compile(r'^(\d{3}) \((\d+)\.(\d+)\.\d+\) (.*)$')
+RETURN_RE = re.compile(r'\(return value (-?\d+)\)')
+END_MARK = '...'
+
+
+def parse_events(text):
+    '''Parse the complete events of an event log.
+
+    Args:
+        text (str): content of the log, possibly ending with an incomplete
+        event.
+
+    Returns:
+        tuple: (events, length), events is a list of (code, job id, header,
+        body lines), length is the number of characters of the complete
+        events.
+    '''
+    events = []
+    length = 0
+    pos = 0
+    current = None
+    for line in text.splitlines(True):
+        pos += len(line)
+        if not line.endswith('\n'):
+            break
+        stripped = line.rstrip('\n')
+        if current is None:
+            match = EVENT_RE.match(stripped)
+            if match:
+                code, cluster, proc, header = match.groups()
+                job_id = '%d.%d' % (int(cluster), int(proc))
+                current = (int(code), job_id, header, [])
+            elif stripped.strip() == END_MARK:
+                length = pos
+        elif stripped.strip() == END_MARK:
+            events.append(current)
+            current = None
+            length = pos
+        else:
+            current[3].append(stripped.strip())
+    return events, length
+
+
+class EventLogTracker(object):
+    '''Job states of a study from the HTCondor event logs'''
+
+    state_name = '.htcondor_jobs.json'
+    log_pattern = os.path.join('*', '*', 'htcondor.*.log')
+
+    def __init__(self, study_path):
+        '''Constructor.
+        study_path (str): the study folder, the event logs are searched in
+        its output folders and the tracking state is stored in it
+        '''
+        self._logger = logging.getLogger(__name__)
+        self.study_path = study_path
+        self.state_file = os.path.join(study_path, self.state_name)
+        # log file -> byte offset of the first unread event
+        self.offsets = {}
+        # ClusterId.ProcId -> {'status':, 'return_value':, 'log':}
+        self.jobs = {}
+        self.load()
+
+    def load(self):
+        '''Load the tracking state stored in the study folder'''
+        if not os.path.isfile(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as f_in:
+                state = json.load(f_in)
+            self.offsets = state.get('offsets', {})
+            self.jobs = state.get('jobs', {})
+        except (ValueError, OSError):
+            content = "Corrupted job tracking state %s, starting over!" % (
+                self.state_file)
+            self._logger.warning(content)
+            self.offsets = {}
+            self.jobs = {}
+
+    def save(self):
+        '''Store the tracking state atomically'''
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f_out:
+            json.dump({'offsets': self.offsets, 'jobs': self.jobs}, f_out)
+        os.replace(tmp, self.state_file)
+
+    def update(self, logs=None):
+        '''Read the new events of the event logs.
+
+        Args:
+            logs (list): the event logs to read, by default all the logs of
+            the output folders of the study.
+
+        Returns:
+            int: the number of new events.
+        '''
+        if logs is None:
+            logs = glob.glob(os.path.join(self.study_path, self.log_pattern))
+        logs = set(logs)
+        n_events = 0
+        for log in logs:
+            n_events += self._read(log)
+        # forget the logs removed after gathering and their jobs
+        removed = set(i for i in self.offsets if i not in logs and
+                      not os.path.exists(i))
+        for log in removed:
+            self.offsets.pop(log)
+        if removed:
+            self.jobs = dict((key, job) for key, job in self.jobs.items()
+                             if job['log'] not in removed)
+        if n_events or removed:
+            self.save()
+        return n_events
+
+    def _read(self, log):
+        '''Read the new complete events of a log'''
+        offset = self.offsets.get(log, 0)
+        try:
+            size = os.path.getsize(log)
+            if size == offset:
+                return 0
+            if size < offset:
+                # the log was truncated or replaced
+                offset = 0
+            with open(log, 'rb') as f_in:
+                f_in.seek(offset)
+                data = f_in.read()
+        except OSError:
+            return 0
+        # latin-1 maps every byte to a character, so that the offsets match
+        events, length = parse_events(data.decode('latin-1'))
+        self.offsets[log] = offset + length
+        for code, job_id, header, body in events:
+            job = self.jobs.setdefault(job_id, {'status': None,
+                                                'return_value': None,
+                                                'log': log})
+            job['log'] = log
+            if code in EVENT_STATES:
+                job['status'] = EVENT_STATES[code]
+            if code == 5:
+                for line in body:
+                    match = RETURN_RE.search(line)
+                    if match:
+                        job['return_value'] = int(match.group(1))
+                        break
+        return len(events)
+
+    def status(self, unique_id):
+        '''The state of a job, None if unknown'''
+        job = self.jobs.get(str(unique_id))
+        if job is None:
+            return None
+        return job['status']
+
+    def select(self, states, unique_ids=None):
+        '''The jobs in the given states.
+
+        Args:
+            states (int/list): e.g. RUNNING or [IDLE, HELD].
+            unique_ids (list): restrict to these jobs.
+
+        Returns:
+            list: the ClusterId.ProcId of the jobs.
+        '''
+        if isinstance(states, int):
+            states = [states]
+        if unique_ids is None:
+            unique_ids = self.jobs.keys()
+        return [i for i in map(str, unique_ids)
+                if i in self.jobs and self.jobs[i]['status'] in states]
+
+    def unknown(self, unique_ids):
+        '''The jobs which don't appear in any event log'''
+        return [i for i in map(str, unique_ids) if i not in self.jobs]
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+'''Execution of the job batches of submission.LocalCluster.
+
+A batch is described by a json file written by LocalCluster.submit. Every
+task runs in its own temporary folder with a copy of the transferred input
+files, like on a HTCondor node, and its results are moved to the output
+folder of the task. The state of the jobs is kept in a json file next to
+the batch description, with the JobStatus values of jobtracker.
+'''
+import os
+import sys
+import json
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import jobtracker
+
+logger = logging.getLogger(__name__)
+
+
+def read_state(state_file):
+    '''Read the state of a batch: the pid of its runner and the jobs,
+    unique_id -> [state, batch, task]'''
+    try:
+        with open(state_file, 'r') as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return {'pid': None, 'jobs': {}}
+
+
+def write_state(state_file, state):
+    '''Write the state of a batch atomically'''
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w') as f_out:
+        json.dump(state, f_out)
+    os.replace(tmp, state_file)
+
+
+class BatchRunner(object):
+    '''Run the tasks of a batch in a pool of processes'''
+
+    def __init__(self, batch_file):
+        with open(batch_file, 'r') as f_in:
+            self.batch = json.load(f_in)
+        self.state_file = self.batch['state_file']
+        self.cancel_file = self.batch['cancel_file']
+        self.state = read_state(self.state_file)
+        self.jobs = self.state['jobs']
+        self.lock = threading.Lock()
+        self.cpus = None
+        if self.batch.get('pin_cpus') and hasattr(os, 'sched_setaffinity'):
+            self.cpus = queue.Queue()
+            for cpu in sorted(os.sched_getaffinity(0)):
+                self.cpus.put(cpu)
+
+    def set_state(self, unique_id, state):
+        with self.lock:
+            self.jobs[unique_id][0] = state
+            write_state(self.state_file, self.state)
+
+    def cancelled(self):
+        return os.path.exists(self.cancel_file)
+
+    def run(self):
+        '''Run all the tasks, blocks until they are finished'''
+        with self.lock:
+            self.state['pid'] = os.getpid()
+            write_state(self.state_file, self.state)
+        workers = max(1, int(self.batch['max_workers']))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(pool.submit(self.run_task, unique_id), unique_id)
+                       for unique_id in self.batch['order']]
+        for future, unique_id in futures:
+            error = future.exception()
+            if error is None:
+                continue
+            logger.error(error, exc_info=error)
+            content = "The job %s failed to run, it is held!" % unique_id
+            logger.error(content)
+            try:
+                self.set_state(unique_id, jobtracker.HELD)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def run_task(self, unique_id):
+        '''Run a task in its own temporary folder. The task is held, as by
+        HTCondor, if it can't be run or its results can't be transferred,
+        the held tasks of a finished batch are reported as removed.'''
+        if self.cancelled():
+            self.set_state(unique_id, jobtracker.REMOVED)
+            return
+        task = self.jobs[unique_id][2]
+        out_path = os.path.join(self.batch['output_path'], task)
+        os.makedirs(out_path, exist_ok=True)
+        work = tempfile.mkdtemp(prefix='pysixdesk_%s_' % task,
+                                dir=self.batch.get('scratch'))
+        cpu = None
+        state = jobtracker.COMPLETED
+        try:
+            for src in self.batch['trans'] + [self.batch['exe']]:
+                dest = os.path.join(work, os.path.basename(src))
+                if os.path.isdir(src):
+                    # the python package, read only
+                    os.symlink(src, dest)
+                else:
+                    shutil.copy2(src, dest)
+            exe = os.path.join(work, os.path.basename(self.batch['exe']))
+            cmd = [sys.executable, exe, task] + self.batch['exe_args'].split()
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(
+                [work] + [i for i in [env.get('PYTHONPATH')] if i])
+            if self.cpus is not None:
+                cpu = self.cpus.get()
+            self.set_state(unique_id, jobtracker.RUNNING)
+            stdout = os.path.join(out_path, '_condor_stdout')
+            stderr = os.path.join(out_path, '_condor_stderr')
+            with open(stdout, 'wb') as f_out, open(stderr, 'wb') as f_err:
+                # pinned once started, preexec_fn isn't safe in threads
+                process = subprocess.Popen(cmd, cwd=work, env=env,
+                                           stdout=f_out, stderr=f_err)
+                if cpu is not None:
+                    try:
+                        os.sched_setaffinity(process.pid, {cpu})
+                    except OSError as e:
+                        content = "The task %s isn't pinned to cpu %d: %s" % (
+                            task, cpu, e)
+                        logger.warning(content)
+                while True:
+                    try:
+                        process.wait(timeout=1)
+                        break
+                    except subprocess.TimeoutExpired:
+                        if self.cancelled():
+                            process.kill()
+            if self.cancelled() and process.returncode < 0:
+                self.set_state(unique_id, jobtracker.REMOVED)
+                return
+            # transfer the results back, as transfer_output_files = results
+            results = os.path.join(work, 'results')
+            if os.path.isdir(results):
+                dest = os.path.join(out_path, 'results')
+                os.makedirs(dest, exist_ok=True)
+                for item in os.listdir(results):
+                    target = os.path.join(dest, item)
+                    if os.path.isdir(target):
+                        shutil.rmtree(target)
+                    shutil.move(os.path.join(results, item), target)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            content = "The task %s of job %s is held!" % (task, unique_id)
+            logger.error(content)
+            state = jobtracker.HELD
+        finally:
+            if cpu is not None:
+                self.cpus.put(cpu)
+            shutil.rmtree(work, ignore_errors=True)
+        self.set_state(unique_id, state)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    BatchRunner(sys.argv[1]).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''Memoization of the results of the preprocess (MAD-X) jobs.
+
+A preprocess job only depends on its rendered mask, the templates sent with
+it, the executables and the preprocess settings (one turn sixtrack,
+collimation). The digest of these inputs is stored in the madx_key column of
+preprocess_wu: a work unit whose key matches a complete task of the study
+points to that preprocess_task row instead of submitting a new job.
+
+The results can also be shared between studies through a cache folder, an
+entry per key, <key[:2]>/<key>/, holds a file per stored blob column of
+preprocess_task, as stored (compressed, self-describing), and an index.json
+with the rows of the result tables (e.g. oneturn_sixtrack_results). The
+entries are written in a temporary folder renamed into place, so that the
+studies can fill the folder concurrently.
+'''
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+# content hash of the executables, on (path, size, mtime)
+_exe_digests = {}
+
+
+def exe_digest(exe):
+    '''The content hash of an executable, of its name if it can't be read,
+    e.g. not on this machine.'''
+    path = shutil.which(exe) or exe
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return hashlib.sha256(exe.encode()).hexdigest()
+    stamp = (path, stat.st_size, stat.st_mtime)
+    if stamp not in _exe_digests:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f_in:
+            for chunk in iter(lambda: f_in.read(1 << 20), b''):
+                sha.update(chunk)
+        _exe_digests[stamp] = sha.hexdigest()
+    return _exe_digests[stamp]
+
+
+def madx_key(mask, inputs, exes, settings):
+    '''The key of a preprocess job.
+
+    Args:
+        mask (str): the rendered mask.
+        inputs (dict): name -> content (bytes) of the other input files.
+        exes (list): the executables run by the job.
+        settings (dict): the settings of the job, json serializable.
+
+    Returns:
+        str: the hex digest.
+    '''
+    names = ['mask', 'settings']
+    bufs = [mask.encode(),
+            json.dumps(settings, sort_keys=True, default=str).encode()]
+    for name in sorted(inputs):
+        names.append(name)
+        bufs.append(inputs[name])
+    for i, exe in enumerate(exes):
+        names.append(f'exe_{i}')
+        bufs.append(exe_digest(exe).encode())
+    return cache.digest(names, bufs)
+
+
+class ResultCache(object):
+    '''Folder of preprocess results shared between studies'''
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _path(self, key):
+        return self.root / key[:2] / key
+
+    def __contains__(self, key):
+        return (self._path(key) / 'index.json').is_file()
+
+    def get(self, key):
+        '''Read an entry.
+
+        Returns:
+            tuple: (blobs, results), the column -> blob dict of
+            preprocess_task and the table -> columns -> values dict of the
+            results, None if missing.
+        '''
+        path = self._path(key)
+        try:
+            with open(path / 'index.json', 'r') as f_in:
+                index = json.load(f_in)
+            blobs = dict((col, (path / col).read_bytes())
+                         for col in index['columns'])
+        except (OSError, ValueError, KeyError):
+            return None
+        return blobs, index['results']
+
+    def put(self, key, blobs, results):
+        '''Store an entry, kept if it already exists.
+
+        Args:
+            key (str): the madx_key.
+            blobs (dict): column -> blob of the preprocess_task row.
+            results (dict): table -> columns -> values of the results.
+
+        Returns:
+            bool: whether the entry was written.
+        '''
+        path = self._path(key)
+        if key in self:
+            return False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix='.tmp_', dir=path.parent))
+        try:
+            for col, buf in blobs.items():
+                (tmp / col).write_bytes(buf)
+            index = {'columns': list(blobs.keys()), 'results': results,
+                     'time': time.time()}
+            with open(tmp / 'index.json', 'w') as f_out:
+                json.dump(index, f_out)
+            os.rename(tmp, path)
+        except OSError:
+            # e.g. stored meanwhile by another study
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        return True
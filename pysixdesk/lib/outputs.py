@@ -0,0 +1,158 @@
+'''Compression of the job outputs before their transfer.
+
+The outputs of a job (fort.10, state files, checkpoint files, fort.6...) are
+gzipped in parallel threads, zlib releases the GIL while compressing. The
+level depends on the file type: the text results are compressed well, the
+binary checkpoint files poorly, so they are compressed quickly; the files
+already compressed are copied as they are.
+
+A manifest (manifest.json) is written next to the outputs with, for each
+file, the stored name, the original size and crc32 and the stored size. The
+crc32 and size (modulo 2**32) are also those of the gzip trailer, so gather
+verifies a transferred output from its size and its last 8 bytes, without
+decompressing it.
+'''
+import os
+import json
+import zlib
+import gzip
+import shutil
+import struct
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST = 'manifest.json'
+CHUNK = 1024**2
+GZIP_MAGIC = b'\x1f\x8b'
+
+# the extensions of the files already compressed
+COMPRESSED = ('.gz', '.zip', '.bz2', '.xz', '.zst', '.lz4')
+
+# (pattern, level) of the file types, the first match wins, level 0 copies
+# the file without compression
+LEVELS = [
+    ('crpoint_*', 1),
+    ('singletrackfile*', 1),
+    ('fort.6', 4),
+    ('*', 6),
+]
+
+
+def file_level(name, levels=None):
+    '''The compression level of a file, 0 if it is already compressed'''
+    if name.endswith(COMPRESSED):
+        return 0
+    with open(name, 'rb') as f_in:
+        if f_in.read(2) == GZIP_MAGIC:
+            return 0
+    for pattern, level in (levels or LEVELS):
+        if fnmatch.fnmatch(os.path.basename(name), pattern):
+            return level
+    return 6
+
+
+def compress_file(filename, dest, level):
+    '''Gzip (or copy if level is 0) a file in the dest folder.
+
+    Returns:
+        dict: the manifest entry of the file.
+    '''
+    name = os.path.basename(filename)
+    if level == 0:
+        if not name.endswith(COMPRESSED):
+            # a gzip stream, named as the other outputs
+            name += '.gz'
+        out_name = os.path.join(dest, name)
+        shutil.copyfile(filename, out_name)
+        entry = {'name': name, 'level': 0}
+    else:
+        out_name = os.path.join(dest, name + '.gz')
+        crc = 0
+        size = 0
+        with open(filename, 'rb') as f_in, gzip.GzipFile(
+                out_name, 'wb', compresslevel=level) as f_out:
+            for chunk in iter(lambda: f_in.read(CHUNK), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                f_out.write(chunk)
+        entry = {'name': name + '.gz', 'level': level, 'size': size,
+                 'crc32': crc}
+    entry['stored'] = os.path.getsize(out_name)
+    return entry
+
+
+def compress_files(filenames, dest, workers=1, levels=None):
+    '''Compress the files in the dest folder and write the manifest.
+
+    Args:
+        filenames (list): the files to compress.
+        dest (str/path): the destination folder.
+        workers (int): the number of compression threads.
+        levels (list): (pattern, level) of the file types, see LEVELS.
+
+    Returns:
+        dict: the manifest entries, on the original file names.
+    '''
+    plan = [(i, file_level(i, levels)) for i in filenames]
+    # the largest files first, to balance the threads
+    plan.sort(key=lambda x: -os.path.getsize(x[0]))
+    workers = max(min(workers, len(plan)), 1)
+    if workers == 1:
+        entries = [compress_file(i, dest, level) for i, level in plan]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            entries = list(executor.map(
+                lambda x: compress_file(x[0], dest, x[1]), plan))
+    files = {os.path.basename(i): j for (i, _), j in zip(plan, entries)}
+    write_manifest(dest, files)
+    return files
+
+
+def write_manifest(dest, files):
+    '''Add the entries to the manifest of the folder'''
+    path = os.path.join(dest, MANIFEST)
+    manifest = read_manifest(path) or {}
+    manifest.update(files)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f_out:
+        json.dump(manifest, f_out, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def read_manifest(path):
+    '''The entries of a manifest, None if missing or unreadable'''
+    try:
+        with open(path, 'r') as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return None
+
+
+def verify(path):
+    '''Verify the files of a manifest from their sizes and gzip trailers.
+
+    Args:
+        path (str/path): the manifest file.
+
+    Returns:
+        list: the stored names of the missing or corrupted files.
+    '''
+    folder = os.path.dirname(path)
+    manifest = read_manifest(path) or {}
+    bad = []
+    for entry in manifest.values():
+        name = os.path.join(folder, entry['name'])
+        try:
+            if os.path.getsize(name) != entry['stored']:
+                bad.append(entry['name'])
+                continue
+            if entry['level']:
+                with open(name, 'rb') as f_in:
+                    f_in.seek(-8, os.SEEK_END)
+                    crc, size = struct.unpack('<II', f_in.read(8))
+                if (crc, size) != (entry['crc32'],
+                                   entry['size'] & 0xffffffff):
+                    bad.append(entry['name'])
+        except OSError:
+            bad.append(entry['name'])
+    return bad
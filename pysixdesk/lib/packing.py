@@ -0,0 +1,176 @@
+'''Packing of the sixtrack tasks into HTCondor jobs of a target wall time.
+
+The cost of a task is estimated from the number of tracked turns and
+particles, and converted to seconds with a rate calibrated on the tracking
+times of the tasks already gathered. The tasks are then packed into jobs
+with a decreasing worst-fit heuristic, in O(n log n). The tasks of a job
+run concurrently on its workers (see sixtrack.main), so a job is filled
+until the makespan of its tasks on the workers reaches the target.
+'''
+import heapq
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def task_cost(params):
+    '''The cost of a sixtrack task in particle turns.
+
+    Args:
+        params (dict): the columns of the task in the sixtrack_wu table.
+
+    Returns:
+        float: turns x particle pairs x momentum variations.
+    '''
+    last_turn = params.get('last_turn')
+    if last_turn:
+        turns = last_turn - (params.get('first_turn') or 1) + 1
+    else:
+        turns = params.get('turnss') or 1
+    nss = params.get('nss') or 1
+    imc = params.get('imc') or 1
+    return float(max(turns, 1) * nss * imc)
+
+
+class RuntimeModel(object):
+    '''Estimate the running time of the sixtrack tasks'''
+
+    # seconds per particle turn if no task was gathered yet
+    default_rate = 1E-3
+    # columns of sixtrack_wu needed by task_cost
+    columns = ['turnss', 'nss', 'imc', 'first_turn', 'last_turn']
+
+    def __init__(self, rate=None):
+        '''Constructor.
+        rate (float): seconds per particle turn, default_rate if None
+        '''
+        self.rate = rate or self.default_rate
+
+    @classmethod
+    def calibrate(cls, db, samples=None):
+        '''Calibrate the rate on the tracking times (trttime) of the
+        gathered tasks.
+
+        Args:
+            db (SixDB): the study database.
+            samples (int): use only this number of tasks.
+
+        Returns:
+            RuntimeModel: the calibrated model, default_rate without data.
+        '''
+        if 'six_results' not in db.fetch_tables():
+            return cls()
+        times = db.select('six_results', ['task_id', 'sum(trttime)'],
+                          'trttime is not null', groupby=['task_id'],
+                          limit=samples)
+        times = dict((i, j) for i, j in times if j)
+        if not times:
+            return cls()
+        cols = [i for i in cls.columns if i in db.fetch_columns('sixtrack_wu')]
+        total_time = 0.0
+        total_cost = 0.0
+        task_ids = list(times.keys())
+        for i in range(0, len(task_ids), 500):
+            where = 'task_id in (%s)' % ','.join(map(str,
+                                                     task_ids[i:i + 500]))
+            rows = db.select('sixtrack_wu', ['task_id'] + cols, where)
+            for row in rows:
+                total_time += times[row[0]]
+                total_cost += task_cost(dict(zip(cols, row[1:])))
+        if not total_cost:
+            return cls()
+        model = cls(total_time / total_cost)
+        content = "Calibrated the runtime model on %d tasks: %.3g s per "\
+            "particle turn." % (len(task_ids), model.rate)
+        logger.info(content)
+        return model
+
+    def estimate(self, params):
+        '''The estimated running time (s) of a task'''
+        return task_cost(params) * self.rate
+
+
+def pack(items, capacity, max_items=None, workers=1):
+    '''Pack the items into bins of the given capacity.
+
+    The items are placed by decreasing cost into the least loaded bin where
+    they fit, or into a new bin, so that the bins are balanced. Each bin has
+    the given number of workers, an item goes to the least loaded worker of
+    its bin, so the load of a bin is the makespan of its items. The items
+    larger than the capacity get a worker of their own.
+
+    Args:
+        items (list): (key, cost) tuples.
+        capacity (float): the target load of a bin.
+        max_items (int): the maximum number of items per bin.
+        workers (int): the number of workers of a bin.
+
+    Returns:
+        list: the bins, lists of keys.
+    '''
+    bins = []
+    # the loads of the workers of each bin
+    loads = []
+    # (load of the least loaded worker, index) of the bins which can still
+    # take items
+    heap = []
+    for key, cost in sorted(items, key=lambda x: x[1], reverse=True):
+        if heap and heap[0][0] + cost <= capacity:
+            index = heapq.heappop(heap)[1]
+        else:
+            index = len(bins)
+            bins.append([])
+            loads.append([0.0] * max(workers, 1))
+        bins[index].append(key)
+        heapq.heapreplace(loads[index], loads[index][0] + cost)
+        if loads[index][0] < capacity and (max_items is None or
+                                           len(bins[index]) < max_items):
+            heapq.heappush(heap, (loads[index][0], index))
+    return bins
+
+
+def makespan(costs, workers=1):
+    '''The running time of tasks of the given costs run by a pool of
+    workers, each task going to the first free worker by decreasing cost'''
+    loads = [0.0] * max(min(workers, len(costs)), 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def pack_tasks(groups, costs, capacity, max_items=None, workers=1):
+    '''Pack groups of tasks into jobs, the groups aren't split.
+
+    Args:
+        groups (dict): the tasks which can be packed together, e.g. per
+        preprocess task, key -> list of units, a unit is a list of task ids
+        which must stay together.
+        costs (dict): task id -> estimated running time.
+        capacity (float): the target running time of a job.
+        max_items (int): the maximum number of units per job.
+        workers (int): the number of tasks a job runs concurrently.
+
+    Returns:
+        list: the jobs, lists of task ids.
+    '''
+    jobs = []
+    for units in groups.values():
+        items = [(i, sum(costs[j] for j in unit))
+                 for i, unit in enumerate(units)]
+        for packed in pack(items, capacity, max_items, workers):
+            jobs.append([task for i in sorted(packed) for task in units[i]])
+    return jobs
+
+
+def summary(jobs, costs, workers=1):
+    '''Statistics of the packed jobs, for logging'''
+    times = sorted(makespan([costs[i] for i in job], workers)
+                   for job in jobs)
+    if not times:
+        return OrderedDict()
+    return OrderedDict([('jobs', len(times)),
+                        ('tasks', sum(len(i) for i in jobs)),
+                        ('min', times[0]),
+                        ('median', times[len(times) // 2]),
+                        ('max', times[-1])])
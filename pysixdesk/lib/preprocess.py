@@ -8,8 +8,14 @@ import argparse
 
 from pathlib import Path
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from pysixdesk.lib import utils
+from pysixdesk.lib import runner
+from pysixdesk.lib import fort3
+from pysixdesk.lib import template
+from pysixdesk.lib.workdir import WorkDir
+from pysixdesk.lib.cache import NodeCache, default_root
 from pysixdesk.lib.dbtable import Table
 from pysixdesk.lib import generate_fort2
 from pysixdesk.lib.pysixdb import SixDB
@@ -17,12 +23,18 @@ from pysixdesk.lib.resultparser import parse_results
 
 
 class PreprocessJob:
-    def __init__(self, task_id, input_info):
+    def __init__(self, task_id, input_info, workers=None, cache_dir=None):
         '''Class to handle the execution of the preprocessing job.
 
         Args:
             task_id (int): Current task ID.
             input_info (str/path): Path to the database configuration file.
+            workers (int, optional): Number of one turn sixtrack jobs run
+            concurrently, the cpus of the slot by default.
+            cache_dir (str/path, optional): if provided, the templates are
+            decompressed once in this node cache folder and hardlinked in
+            the current folder, and MAD-X and SixTrack are run from their
+            copies in the cache, see cache.NodeCache.
 
         Raises:
             FileNotFoundError: If required input file is not found in database.
@@ -30,6 +42,12 @@ class PreprocessJob:
         self._logger = utils.condor_logger('preprocess')
         self._dest_path = Path('results', str(task_id))
         self._dest_path.mkdir(parents=True, exist_ok=True)
+        # progress of the running executable, see runner.ProcessRunner
+        self._heartbeat = self._dest_path.absolute() / 'heartbeat.json'
+        self.workers = workers or utils.slot_cpus()
+        self.cache = None if cache_dir is None else NodeCache(cache_dir)
+        # the fort.3 builder, the template and the madx fc.3 are read once
+        self._fort3 = None
 
         self.task_id = task_id
         # read database config
@@ -80,55 +98,76 @@ class PreprocessJob:
             FileNotFoundError: If buffer is not found in db.
         """
         templates = self.cf['templates']
-        temp_buf = self.db.select('templates', templates.keys())[0]
-        if not temp_buf:
-            raise FileNotFoundError('Templates not found in DB.')
-        else:
+
+        def fetch():
+            temp_buf = self.db.select('templates', templates.keys())[0]
+            if not temp_buf:
+                raise FileNotFoundError('Templates not found in DB.')
             for temp, temp_name in zip(temp_buf, templates.values()):
                 if not temp:
                     raise FileNotFoundError(f'{temp_name} not found in DB.')
-                else:
-                    utils.decompress_buf(temp, temp_name)
+            return temp_buf
+        names = list(templates.values())
+        if self.cache is None:
+            for name, buf in zip(names, fetch()):
+                utils.decompress_buf(buf, name)
+        else:
+            self.cache.get(names, fetch)
+
+    @contextmanager
+    def _executable(self, exe):
+        '''The executable to run, its copy in the node cache if any, kept
+        while in the context.
+
+        Args:
+            exe (str): the path of the executable.
+
+        Yields:
+            str: the path to run.
+        '''
+        if self.cache is None:
+            yield exe
+            return
+        with self.cache.executable(exe) as local:
+            yield local
 
     @contextmanager
     def sixtrack_temp_folder(self, folder='temp', symlink_parent=True,
-                             extra=[]):
-        """Helper context manager to deal with the temp folder and symlinking
-        the input files. On release, moves back to the orignal folder and
-        deletes the temp folder.
+                             extra=[], chdir=True):
+        """Helper context manager to deal with the temp folder and staging
+        the input files, see workdir.WorkDir. On release, moves back to the
+        orignal folder and deletes the temp folder.
 
         Args:
             folder (str, optional): name of temp folder.
-            symlink_parent (bool, optional): controls whether to symlink input
+            symlink_parent (bool, optional): controls whether to stage input
             files and extra files from the parent dir to the temporary folder.
-            extra (list, optional): list of extra files to symlink.
+            extra (list, optional): list of extra files to stage.
+            chdir (bool, optional): whether to move into the temp folder,
+            the concurrent jobs stay in the current folder.
+
+        Yields:
+            WorkDir: the temp folder, the outputs are moved back to the
+            parent folder with its move_out.
 
         Raises:
-            FileNotFoundError: if input file not found during symlinking.
+            FileNotFoundError: if input file not found during staging.
         """
-        # quick context manager to handle the temporary folder
         cwd = Path.cwd()
-        temp_folder = Path(folder)
-        if temp_folder.is_dir():
-            shutil.rmtree(temp_folder, ignore_errors=True)
-        temp_folder.mkdir()
-        try:
-            os.chdir(temp_folder)
-            # symlink input files to temp folder.
-            if symlink_parent:
-                input_files = json.loads(self.six_cfg["input_files"])
-                # make symlinks to the other input files in the parent folder
-                for file in [Path(f) for f in list(input_files.values()) + extra]:
-                    target = Path.cwd().parent / file
-                    if target.is_file():
-                        file.symlink_to(target)
-                    else:
-                        msg = f"The required input file {file} was not found!"
-                        raise FileNotFoundError(msg)
-            yield
-        finally:
-            os.chdir(cwd)
-            shutil.rmtree(temp_folder, ignore_errors=True)
+        inputs = []
+        if symlink_parent:
+            input_files = json.loads(self.six_cfg["input_files"])
+            inputs = list(input_files.values()) + extra
+        size = self.six_cfg.get('work_dir_size')
+        size = None if size in [None, 'None'] else float(size)
+        with WorkDir(folder, inputs, self.six_cfg.get('work_dir', 'scratch'),
+                     size, cwd, self._logger) as work:
+            try:
+                if chdir:
+                    os.chdir(work.path)
+                yield work
+            finally:
+                os.chdir(cwd)
 
     def sixtrack_prep_cfg(self, **kwargs):
         """Prepares sixtrack's fort.3 config, by adding the length of the
@@ -142,13 +181,8 @@ class PreprocessJob:
         """
         # make a dict copy of fort_cfg
         fort_dic = dict(self.fort_cfg.items())
-        # reads the length from fort.3.aux
-        with open('fort.3.aux', 'r') as fc3aux:
-            fc3aux_lines = fc3aux.readlines()
-        fc3aux_2 = fc3aux_lines[1]
-        c = fc3aux_2.split()
-        lhc_length = c[4]
-        fort_dic['length'] = lhc_length
+        # the length from fort.3.aux
+        fort_dic['length'] = fort3.aux_length('fort.3.aux')
         # adds additional kwargs to fort_dic
         fort_dic.update(kwargs)
         return fort_dic
@@ -165,60 +199,43 @@ class PreprocessJob:
             output_file (str, optional): name of the prepared fort.3 file.
 
         """
-        # get the fort file patterns and values
-        if source_prefix is not None:
-            source_prefix = Path(source_prefix)
         # touch fort.6
         open('fort.6', 'a').close()
+        self.render_fort3(fort_cfg, source_prefix).write(output_file)
 
-        fort_file = Path(self.six_cfg["fort_file"])
-        patterns = ['%' + a for a in fort_cfg.keys()]
-        values = list(fort_cfg.values())
-        dest = fort_file.with_suffix('.temp')
-
-        source = fort_file
-        if source_prefix is not None:
-            source = source_prefix / source
-
-        utils.replace(patterns, values, source, dest)
-
-        # prepare the other input files
-        input_files = json.loads(self.six_cfg["input_files"])
+    def render_fort3(self, fort_cfg, source_prefix=None):
+        """Builds the fort.3 file in memory, the fort_file template and the
+        madx fc.3 are only read once.
 
-        madx_fc3 = input_files['fc.3']
-        if source_prefix is not None:
-            madx_fc3 = source_prefix / madx_fc3
-
-        # concatenate
-        utils.concatenate_files([dest, madx_fc3], output_file)
-        # if not source.samefile(output_file):
-        #     utils.diff(source, output_file, logger=self._logger)
+        Args:
+            fort_cfg (dict): dict containing the placeholder/value pairs.
+            source_prefix (str/path, optional): folder of the fort_file and
+            fc.3 files, the current folder if None.
 
-    def sixtrack_run(self, output_file):
+        Returns:
+            fort3.Fort3: the fort.3 file.
+        """
+        if self._fort3 is None:
+            prefix = Path(source_prefix or '.')
+            input_files = json.loads(self.six_cfg["input_files"])
+            self._fort3 = fort3.load(prefix / self.six_cfg["fort_file"],
+                                     prefix / input_files['fc.3'])
+        return self._fort3.build(fort_cfg)
+
+    def sixtrack_run(self, output_file, cwd=None):
         """Runs sixtrack.
 
         Args:
             output_file (str): File in which to write sixtrack's stdout.
+            cwd (str/path, optional): folder of the run, the current one if
+            None.
         """
-        # actually run
-        six_output = os.popen(self.six_cfg["sixtrack_exe"])
         self._logger.info('Sixtrack is running...')
-        # write stdout to file
-        outputlines = six_output.readlines()
+        # stream stdout to file
+        heartbeat = self._heartbeat.with_name(f'heartbeat_{output_file}.json')
+        with self._executable(self.six_cfg["sixtrack_exe"]) as exe:
+            runner.run_sixtrack(exe, output_file, heartbeat, cwd=cwd)
         self._logger.info('Sixtrack is done!')
-        # output_name = Path.cwd().parent / (job_name + '.output')
-
-        if outputlines and output_file is not None:
-            with open(output_file, 'w') as six_out:
-                six_out.writelines(outputlines)
-        elif output_file != 'fort.6':
-            # For some sixtrack version, the stdout will be automatically
-            # written to fort.6
-            shutil.copy2('fort.6', output_file)
-        # else:
-        #     self.output_files.append('fort.6')
-
-        # print(''.join(outputlines))
 
     def dl_output(self):
         """Downloads the output of the job.
@@ -253,8 +270,11 @@ class PreprocessJob:
         for sec in self.cf:
             result_cf[sec] = dict(self.cf[sec])
         filelist = Table.result_table(self.madx_out.values())
+        codec = None
+        if 'codecs' in self.cf:
+            codec = self.cf['codecs'].get('preprocess_task')
         parse_results('preprocess', self.task_id, self._dest_path, filelist,
-                      task_table, result_cf)
+                      task_table, result_cf, codec)
 
         self.db.update(f'preprocess_task', task_table,
                        f'task_id={self.task_id}')
@@ -332,10 +352,9 @@ class PreprocessJob:
         Args:
             output_file (str, optional): Name of the prepared mask_file.
         '''
-        patterns = ['%' + a for a in self.mask_cfg.keys()]
-        values = list(self.mask_cfg.values())
-        utils.replace(patterns, values, self.madx_cfg["mask_file"],
-                      output_file)
+        mask = template.load(self.madx_cfg["mask_file"])
+        with open(output_file, 'w') as f_out:
+            f_out.write(mask.render(self.mask_cfg))
         # show diff
         # utils.diff(self.madx_cfg["mask_file"], output_file, logger=self._logger)
 
@@ -349,14 +368,13 @@ class PreprocessJob:
             Exception: If 'finished normally' is not in Madx output.
         """
         exe = self.madx_cfg['madx_exe']
-        command = exe + " " + mask
         self._logger.info("Calling madx %s" % exe)
         self._logger.info("MADX job is running...")
-        output = os.popen(command)
-        output = output.readlines()
-        with open('madx_stdout', 'w') as mad_out:
-            mad_out.writelines(output)
-        if 'finished normally' not in output[-2]:
+        with self._executable(exe) as local:
+            result = runner.run(local + " " + mask, 'madx_stdout',
+                                heartbeat=self._heartbeat)
+        # the closing banner of MAD-X, followed by a few lines
+        if not any('finished normally' in i for i in result.tail[-5:]):
             content = "MADX has not completed properly!"
             raise Exception(content)
         else:
@@ -388,66 +406,73 @@ class PreprocessJob:
         # generate fort2
         generate_fort2.run(fc2, aperture, survery)
 
-    def sixtrack_check(self, job_name):
-        """Checks for fort.10 and moves it out of temp folder.
-        fort.10 --> ../fort.10_job_name
+    def sixtrack_check(self, job_name, folder='.'):
+        """Checks for fort.10 and renames it in the temp folder.
+        fort.10 --> fort.10_job_name
 
         Args:
             job_name (str): name of the sixtrack job.
+            folder (str/path, optional): the temp folder of the job.
 
         Raises:
             FileNotFoundError: if fort.10 is not found.
         """
         # check for fort.10
-        # output_name = Path.cwd().parent / (job_name + '.output')
-        if not Path('fort.10').is_file:
+        folder = Path(folder).absolute()
+        if not (folder / 'fort.10').is_file():
             self._logger.error("The %s sixtrack job FAILED!" % job_name)
             self._logger.error("Check the file %s which contains the SixTrack fort.6 output." % job_name)
             raise FileNotFoundError('"fort.10" not found.')
         else:
-            # move fort.10 out of temp folder
-            result_name = Path.cwd().parent / ('fort.10' + '_' + job_name)
-            shutil.move('fort.10', result_name)
+            os.replace(folder / 'fort.10', folder / ('fort.10_' + job_name))
             self._logger.info('Sixtrack job %s has completed normally!' % job_name)
 
-    def _sixtrack_job(self, job_name, **kwargs):
-        '''One turn sixtrack job.
+    def _sixtrack_job(self, job_name, fort_3):
+        '''One turn sixtrack job, in its own temp folder.
 
         Args:
             job_name (str): name of the sixtrack job.
-            **kwargs: forwarded to sixtrack_prep_cfg, used as key value pairs
-            in fort_cfg.
+            fort_3 (fort3.Fort3): the fort.3 file, see render_fort3.
         '''
-        fort_dic = self.sixtrack_prep_cfg(**kwargs)
-        with self.sixtrack_temp_folder(symlink_parent=True):
-            self.sixtrack_prep_job(fort_dic,
-                                   source_prefix=Path.cwd().parent,
-                                   output_file='fort.3')
-            self.sixtrack_run(job_name)
+        with self.sixtrack_temp_folder(f'temp_{job_name}',
+                                       chdir=False) as work:
+            # touch fort.6
+            (work.path / 'fort.6').touch()
+            fort_3.write(work.path / 'fort.3')
+            self.sixtrack_run(job_name, cwd=work.path)
             # check and move fort.10 file
-            self.sixtrack_check(job_name)
+            self.sixtrack_check(job_name, work.path)
+            work.move_out(['fort.10_' + job_name])
 
     def sixtrack_job(self):
-        ''''Controls sixtrack job execution.
+        ''''Controls sixtrack job execution. The one turn jobs are
+        independent, they run concurrently if the slot has several cpus.
         '''
-
-        try:
-            self._sixtrack_job('first_oneturn', dp1='.0', dp2='.0', ition='0')
-        except Exception as e:
-            self._logger.error('SixTrack first oneturn failed.')
-            raise e
-
-        try:
-            self._sixtrack_job('second_oneturn', ition='0')
-        except Exception as e:
-            self._logger.error('SixTrack second oneturn failed.')
-            raise e
-
-        try:
-            self._sixtrack_job('beta_oneturn', dp1='.0', dp2='.0')
-        except Exception as e:
-            self._logger.error('SixTrack beta oneturn failed.')
-            raise e
+        jobs = [('first', dict(dp1='.0', dp2='.0', ition='0')),
+                ('second', dict(ition='0')),
+                ('beta', dict(dp1='.0', dp2='.0'))]
+        fort_3s = [self.render_fort3(self.sixtrack_prep_cfg(**kwargs))
+                   for _, kwargs in jobs]
+        names = [f'{name}_oneturn' for name, _ in jobs]
+        workers = min(self.workers, len(jobs))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(self._sixtrack_job, name, fort_3)
+                           for name, fort_3 in zip(names, fort_3s)]
+                errors = [future.exception() for future in futures]
+        else:
+            errors = []
+            for name, fort_3 in zip(names, fort_3s):
+                try:
+                    self._sixtrack_job(name, fort_3)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(e)
+                    break
+        for (name, _), error in zip(jobs, errors):
+            if error is not None:
+                self._logger.error(f'SixTrack {name} oneturn failed.')
+                raise error
 
     def write_oneturnresult(self):
         '''Writes the oneturnresult file.
@@ -477,15 +502,28 @@ class PreprocessJob:
             f_out.write('\n')
 
 
-if __name__ == '__main__':
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('task_id', type=int,
                         help='Current work unit ID')
     parser.add_argument('input_info', type=str,
                         help='Path to the config file.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of one turn sixtrack jobs run at once, '
+                        'the cpus of the slot by default.')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Node cache of the templates and executables, '
+                        'PYSIXDESK_CACHE or a folder in /tmp by default.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Decompress the templates and run the '
+                        'executables in place.')
     args = parser.parse_args()
 
-    job = PreprocessJob(args.task_id, args.input_info)
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or default_root()
+    job = PreprocessJob(args.task_id, args.input_info, args.workers,
+                        cache_dir)
     try:
         job.run()
     except Exception as e:
@@ -494,5 +532,9 @@ if __name__ == '__main__':
         where = f"task_id={job.task_id}"
         job_table['status'] = 'incomplete'
         job_table['mtime'] = int(time.time() * 1E7)
-        job.db.update('preprocess_wu'. job_table, where)
+        job.db.update('preprocess_wu', job_table, where)
         raise e
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,28 @@
 import os
 import logging
+from contextlib import contextmanager
+
 from . import dbadaptor
+from .sharding import ShardManager
 
 
 class SixDB(object):
 
-    def __init__(self, db_info, settings=None, create=False):
+    def __init__(self, db_info, settings=None, create=False, shard=None):
         '''Constructor.
         db_info(dict): contain the information of the database,
                        such as db_name, type, user, password, host and so on
         For sqlite db only db_name is needed which should be an absolute path,
         For MySQL db db_info should contain db_name(just name), user,
         password, host, port and other optional arguments.
+        shard(dict): sharded layout of a sqlite db, e.g. {'size': 10000}, see
+        the shard method. An existing layout is loaded in any case.
         '''
         self._logger = logging.getLogger(__name__)
         self.settings = settings
+        self.overlays = []
+        self.shards = None
+        self.shard_layout = shard
         info = {}
         info.update(db_info)
         self.info = info
@@ -51,10 +59,66 @@ class SixDB(object):
         self.conn = self.adaptor.new_connection(**self.info)
         if self.settings is not None:
             self.setting(self.settings)
+        if self.db_type == 'sql':
+            self.shards = ShardManager(self)
+            if self.shard_layout is not None:
+                self.shard(**self.shard_layout)
+        elif self.shard_layout is not None:
+            content = "The sharded layout is only supported by sqlite!"
+            raise ValueError(content)
+
+    def shard(self, tables=None, key='task_id', size=10000):
+        '''Store the given tables in per-shard files by ranges of the key,
+        see ShardManager. It should be done before any row is inserted in the
+        tables, the existing rows stay in the main database.
+
+        Args:
+            tables (list): the tables to shard, by default the result tables
+            and the sixtrack_task table holding the blobs.
+            key (str): integer column used to route the rows.
+            size (int): number of key values per shard.
+        '''
+        if self.shards is None:
+            content = "The sharded layout is only supported by sqlite!"
+            raise ValueError(content)
+        if tables is None:
+            tables = ShardManager.default_tables
+        self.shards.configure(tables, key, size)
 
     def setting(self, settings):
-        '''Execute the settings of the database'''
+        '''Execute the settings of the database, settings is either a dict
+        or the name of a profile, e.g. 'interactive' or 'bulk-load' '''
         self.adaptor.setting(self.conn, settings)
+        if self.shards is not None:
+            for alias in self.shards.attached.values():
+                self.adaptor.setting(self.conn, settings, schema=alias)
+
+    @contextmanager
+    def profile(self, settings):
+        '''Apply temporarily the given settings, e.g. the 'bulk-load' profile
+        around heavy write phases, the previous values are restored on exit.
+        '''
+        if settings is None:
+            yield
+            return
+        if isinstance(settings, str):
+            keys = settings
+        else:
+            keys = list(settings.keys())
+        previous = self.adaptor.current_settings(self.conn, keys)
+        self.setting(settings)
+        self.overlays.append(settings)
+        try:
+            yield
+        finally:
+            self.overlays.pop()
+            self.setting(previous)
+
+    def vacuum(self, pages=None):
+        '''Reclaim the space of the deleted rows, see the adaptor'''
+        self.adaptor.vacuum(self.conn, pages)
+        if self.shards is not None:
+            self.shards.vacuum(pages)
 
     def info_check(self):
         '''Check if all the necessary information for database is there.
@@ -101,35 +165,75 @@ class SixDB(object):
                 key_info = tables_keys[key]
             self.create_table(key, value, key_info, recreate)
 
+    def fetch_columns(self, table_name):
+        '''Get the column names of a table'''
+        return self.adaptor.fetch_columns(self.conn, table_name)
+
+    def add_column(self, table_name, column, dtype):
+        '''Add a new column to an existing table'''
+        self.adaptor.add_column(self.conn, table_name, column, dtype)
+        if self.is_sharded(table_name):
+            self.shards.add_column(table_name, column, dtype)
+
+    def execute(self, sql):
+        '''Execute a statement on the main database, the sharded tables
+        aren't reachable this way. Returns the number of affected rows.'''
+        return self.adaptor.execute(self.conn, sql)
+
+    def create_index(self, table_name, columns, index_name=None):
+        '''Create an index on the given columns if it doesn't exist'''
+        self.adaptor.create_index(self.conn, table_name, columns, index_name)
+
     def drop_table(self, table_name):
         '''Drop a table'''
         self.adaptor.drop_table(self.conn, table_name)
 
+    def is_sharded(self, table_name):
+        '''Check if the rows of the table are stored in shards'''
+        return self.shards is not None and self.shards.is_sharded(table_name)
+
     def insert(self, table_name, values):
         '''Insert a row of values'''
+        if self.is_sharded(table_name):
+            self.shards.insert(table_name, values)
+            return
         self.adaptor.insert(self.conn, table_name, values)
 
     def insertm(self, table_name, values):
         '''Insert multiple rows'''
+        if self.is_sharded(table_name):
+            self.shards.insertm(table_name, values)
+            return
         self.adaptor.insertm(self.conn, table_name, values)
 
     def select(self, table_name, columns='*', where=None, orderby=None, **kwargs):
         '''Select values with specified conditions'''
+        if self.is_sharded(table_name):
+            return self.shards.select(table_name, columns, where, orderby,
+                                      **kwargs)
         r = self.adaptor.select(self.conn, table_name, columns, where, orderby,
                                 **kwargs)
         return r
 
     def update(self, table_name, values, where=None):
         '''Update data in a table'''
+        if self.is_sharded(table_name):
+            self.shards.update(table_name, values, where)
+            return
         self.adaptor.update(self.conn, table_name, values, where)
 
     def remove(self, table_name, where):
         '''Reomve rows based on specified conditions'''
+        if self.is_sharded(table_name):
+            self.shards.delete(table_name, where)
+            return
         self.adaptor.delete(self.conn, table_name, where)
 
     def close(self):
         '''Disconnect the database'''
         self.conn.commit()
+        if self.shards is not None:
+            self.shards.close()
         self.conn.close()
 
     def __del__(self):
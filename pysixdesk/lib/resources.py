@@ -0,0 +1,301 @@
+'''Resource requests of the jobs from the measured usage of the tasks.
+
+The wall time, cpu time and peak memory of every task are parsed from the
+HTCondor event log of its job (the job_stdlog blob) and stored in the task
+tables. A simple model fitted on these measurements (a linear model of the
+wall time against the particle turns for the sixtrack tasks) chooses the
+JobFlavour, request_memory and request_cpus of the next jobs.
+
+The tasks of a grouped job run concurrently, on as many workers as the cpus
+of the slot (see sixtrack.main). Their shared usage is split between them
+when it is recorded, and the requests of a grouped job are those of its
+tasks run on the requested cpus.
+'''
+import re
+import math
+import logging
+from datetime import datetime
+from collections import OrderedDict
+
+from . import compression
+from . import jobtracker
+from .packing import task_cost, makespan
+
+logger = logging.getLogger(__name__)
+
+# the columns of the measured usage in the task tables, -1 if unknown
+USAGE_COLUMNS = ['wall_time', 'cpu_time', 'peak_memory']
+
+# the JobFlavours of the CERN batch service and their maximal wall time (s)
+FLAVOURS = OrderedDict([
+    ('espresso', 20 * 60),
+    ('microcentury', 60 * 60),
+    ('longlunch', 2 * 3600),
+    ('workday', 8 * 3600),
+    ('tomorrow', 24 * 3600),
+    ('testmatch', 3 * 24 * 3600),
+    ('nextweek', 7 * 24 * 3600)])
+
+USAGE_RE = r'Usr (\d+) (\d+):(\d+):(\d+), Sys (\d+) (\d+):(\d+):(\d+)'
+
+
+def _seconds(groups):
+    days, hours, minutes, seconds = map(int, groups)
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def _event_time(header):
+    '''The time of an event from its header, e.g. "2020-03-02 10:00:00 ..."
+    or "03/02 10:00:00 ..." for the old format without year'''
+    stamp = ' '.join(header.split()[:2])
+    for frmt in ['%Y-%m-%d %H:%M:%S', '%m/%d %H:%M:%S']:
+        try:
+            return datetime.strptime(stamp, frmt)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_usage(text):
+    '''Parse the usage of a job from its event log.
+
+    Args:
+        text (str): the content of the event log.
+
+    Returns:
+        dict: wall_time (s), cpu_time (s) and peak_memory (MB) of the last
+        run of the job, None if unknown.
+    '''
+    usage = dict.fromkeys(USAGE_COLUMNS)
+    events = jobtracker.parse_events(text)[0]
+    start = None
+    for code, job_id, header, body in events:
+        if code == 1:
+            start = _event_time(header)
+        elif code == 6:
+            for line in body:
+                if 'MemoryUsage of job' in line:
+                    mem = float(line.split()[0])
+                    usage['peak_memory'] = max(usage['peak_memory'] or 0, mem)
+        elif code == 5:
+            end = _event_time(header)
+            if start is not None and end is not None:
+                usage['wall_time'] = (end - start).total_seconds()
+            for line in body:
+                match = re.search(USAGE_RE, line)
+                if match and 'Run Remote Usage' in line:
+                    usr = _seconds(match.groups()[:4])
+                    sys_ = _seconds(match.groups()[4:])
+                    usage['cpu_time'] = float(usr + sys_)
+                elif line.startswith('Memory (MB)'):
+                    # Memory (MB) : usage request allocated
+                    fields = line.split(':')[1].split()
+                    if fields and fields[0].replace('.', '', 1).isdigit():
+                        usage['peak_memory'] = max(
+                            usage['peak_memory'] or 0, float(fields[0]))
+    return usage
+
+
+def _job_id(text):
+    '''The id of the job of an event log, None if unknown'''
+    events = jobtracker.parse_events(text)[0]
+    return events[0][1] if events else None
+
+
+def split_usage(usage, tasks):
+    '''The usage of each of the tasks of a grouped job, from the usage of
+    the job. The tasks ran concurrently on about cpu_time / wall_time
+    workers, each of them using its share of the cpu time and memory.'''
+    if tasks <= 1:
+        return dict(usage)
+    wall, cpu, memory = [usage[i] for i in USAGE_COLUMNS]
+    workers = 1
+    if wall and cpu and wall > 0 and cpu > 0:
+        workers = min(max(int(round(cpu / wall)), 1), tasks)
+    share = dict(usage)
+    if wall is not None and wall > 0:
+        share['wall_time'] = wall * workers / tasks
+    if cpu is not None and cpu > 0:
+        share['cpu_time'] = cpu / tasks
+    if memory is not None and memory > 0:
+        share['peak_memory'] = memory / workers
+    return share
+
+
+def record_usage(db, table_name, batch_size=200):
+    '''Store the usage of the tasks parsed from their job_stdlog blobs, for
+    the tasks without it yet.
+
+    The tasks of a grouped job share its event log, the usage of the job is
+    split between them, see split_usage.
+
+    Returns:
+        int: the number of updated tasks.
+    '''
+    where = 'wall_time is null and job_stdlog is not null'
+    rows = db.select(table_name, ['task_id'], where)
+    task_ids = [i[0] for i in rows]
+    usages = OrderedDict()
+    jobs = {}
+    for i in range(0, len(task_ids), batch_size):
+        batch = task_ids[i:i + batch_size]
+        where = 'task_id in (%s)' % ','.join(map(str, batch))
+        for task_id, blob in db.select(table_name, ['task_id', 'job_stdlog'],
+                                       where):
+            job_id = None
+            try:
+                text = compression.decompress(blob).decode('latin-1')
+                usage = parse_usage(text)
+                job_id = _job_id(text)
+            except Exception:
+                usage = dict.fromkeys(USAGE_COLUMNS)
+            usages[task_id] = (job_id, usage)
+            if job_id is not None:
+                jobs[job_id] = jobs.get(job_id, 0) + 1
+    for task_id, (job_id, usage) in usages.items():
+        usage = split_usage(usage, jobs.get(job_id, 1))
+        # -1 marks the logs without usage, so that they aren't parsed again
+        usage = dict((k, -1 if v is None else v) for k, v in usage.items())
+        db.update(table_name, usage, f'task_id={task_id}')
+    if task_ids:
+        content = "Recorded the usage of %d tasks of %s." % (len(task_ids),
+                                                             table_name)
+        logger.info(content)
+    return len(task_ids)
+
+
+def choose_flavour(seconds):
+    '''The shortest JobFlavour for the given wall time'''
+    for name, limit in FLAVOURS.items():
+        if seconds <= limit:
+            return name
+    return next(reversed(FLAVOURS))
+
+
+class ResourceModel(object):
+    '''Predict the resources of the jobs from the measured usage'''
+
+    # the wall time and memory requests are the predictions times margin
+    margin = 1.5
+    # granularity of the memory requests (MB)
+    memory_step = 250
+    min_memory = 500
+    max_cpus = 8
+    # minimal number of measurements to trust the model
+    min_samples = 3
+
+    def __init__(self):
+        # wall time = intercept + slope * cost
+        self.intercept = None
+        self.slope = 0.0
+        self.peak_memory = None
+        self.cpus = 1
+        self.samples = 0
+
+    @classmethod
+    def fit(cls, db, table_name, params_table=None, columns=None):
+        '''Fit the model on the measured tasks of a table.
+
+        Args:
+            db (SixDB): the study database.
+            table_name (str): 'preprocess_task' or 'sixtrack_task'.
+            params_table (str): the table with the parameters of the tasks,
+            e.g. 'sixtrack_wu', the cost is constant without it.
+            columns (list): the parameter columns used by task_cost.
+
+        Returns:
+            ResourceModel: the model, None without enough measurements.
+        '''
+        rows = db.select(table_name, ['task_id'] + USAGE_COLUMNS,
+                         'wall_time > 0')
+        if len(rows) < cls.min_samples:
+            return None
+        costs = dict((i[0], 1.0) for i in rows)
+        if params_table is not None:
+            existing = db.fetch_columns(params_table)
+            cols = [i for i in columns if i in existing]
+            task_ids = list(costs.keys())
+            costs = {}
+            for i in range(0, len(task_ids), 500):
+                where = 'task_id in (%s)' % ','.join(
+                    map(str, task_ids[i:i + 500]))
+                for row in db.select(params_table, ['task_id'] + cols,
+                                     where):
+                    costs[row[0]] = task_cost(dict(zip(cols, row[1:])))
+            # the parameters of the resubmitted tasks point to the new task
+            rows = [i for i in rows if i[0] in costs]
+            if len(rows) < cls.min_samples:
+                return None
+        model = cls()
+        model.samples = len(rows)
+        xs = [costs[i[0]] for i in rows]
+        ys = [i[1] for i in rows]
+        mean_x = sum(xs) / len(xs)
+        mean_y = sum(ys) / len(ys)
+        var_x = sum((x - mean_x) ** 2 for x in xs)
+        if var_x > 0:
+            cov = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+            model.slope = max(cov / var_x, 0.0)
+        model.intercept = mean_y - model.slope * mean_x
+        # the worst residual, so that the long tasks aren't underestimated
+        model.intercept += max(y - model.predict_wall(x) for x, y in
+                               zip(xs, ys))
+        memories = [i[3] for i in rows if i[3] and i[3] > 0]
+        if memories:
+            model.peak_memory = max(memories)
+        ratios = sorted(i[2] / i[1] for i in rows if i[2] and i[2] > 0)
+        if ratios:
+            median = ratios[len(ratios) // 2]
+            model.cpus = min(max(int(math.ceil(median - 0.25)), 1),
+                             cls.max_cpus)
+        return model
+
+    def predict_wall(self, cost):
+        '''The predicted wall time (s) of a task of the given cost'''
+        return max(self.intercept + self.slope * cost, 0.0)
+
+    def concurrency(self):
+        '''The number of tasks a full grouped job runs at the same time and
+        their slowdown, the factor on their running time when they use
+        several cpus each, consistent with request.
+
+        Returns:
+            tuple: (workers, slowdown).
+        '''
+        return self.max_cpus, max(float(self.cpus), 1.0)
+
+    def _cpus(self, costs):
+        '''The requested cpus of a job running tasks of the given costs and
+        the number of tasks it runs at the same time'''
+        cpus = min(max(len(costs), self.cpus), self.max_cpus)
+        return cpus, max(min(len(costs), cpus), 1)
+
+    def predict_job_wall(self, costs):
+        '''The predicted wall time (s) of a job running tasks of the given
+        costs concurrently on the requested cpus, without margin'''
+        cpus, workers = self._cpus(costs)
+        walls = [self.predict_wall(i) for i in costs]
+        # the tasks using several cpus slow each other down
+        slowdown = max(self.cpus * workers / cpus, 1.0)
+        return makespan(walls, workers) * slowdown
+
+    def request(self, costs):
+        '''The resources of a job running tasks of the given costs.
+
+        The tasks of a grouped job run concurrently, one per requested cpu:
+        a job of several tasks requests up to max_cpus cpus, its wall time
+        is the one of the tasks shared between them and its memory the one
+        of the concurrent tasks.
+
+        Returns:
+            tuple: (flavour, memory in MB, cpus).
+        '''
+        cpus, workers = self._cpus(costs)
+        wall = self.predict_job_wall(costs) * self.margin
+        memory = None
+        if self.peak_memory is not None:
+            memory = self.peak_memory * workers * self.margin
+            memory = int(math.ceil(memory / self.memory_step) *
+                         self.memory_step)
+            memory = max(memory, self.min_memory)
+        return choose_flavour(wall), memory, cpus
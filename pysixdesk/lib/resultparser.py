@@ -2,8 +2,11 @@ import os
 import re
 import time
 import gzip
+import json
 import logging
 
+from pysixdesk.lib import outputs
+from pysixdesk.lib import compression
 from pysixdesk.lib.utils import compress_buf
 
 '''Parse the results of preprocess jobs and sixtrack jobs'''
@@ -11,8 +14,13 @@ from pysixdesk.lib.utils import compress_buf
 logger = logging.getLogger(__name__)
 
 
-def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
-    '''parse the results'''
+def parse_results(jobtype, item, job_path, file_list, task_table, result_cf,
+                  codec=None):
+    '''parse the results
+    The codec is the specification of the compression codec used for the
+    blobs stored in the task table, None keeps the legacy gzip format.
+    '''
+    legacy = compression.parse_spec(codec)[0] == compression.LEGACY
     task_table['mtime'] = int(time.time() * 1E7)
     contents = []
     for a in os.walk(job_path):
@@ -20,11 +28,25 @@ def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
             for b in a[2]:
                 contents.append(os.path.join(a[0], b))
 
+    # verify the transferred outputs against the manifest written by the job
+    manifests = [s for s in contents
+                 if os.path.basename(s) == outputs.MANIFEST]
+    for manifest in manifests:
+        contents.remove(manifest)
+        bad = outputs.verify(manifest)
+        if bad:
+            task_table['status'] = 'Failed'
+            content = "The output files %s of task %s are corrupted!" % (
+                ', '.join(bad), item)
+            logger.warning(content)
+            bad = [os.path.join(os.path.dirname(manifest), i) for i in bad]
+            contents = [s for s in contents if s not in bad]
+
     def search_store(key, name):
         search_re = [s for s in contents if name in os.path.basename(s)]
         if search_re:
             search_re = search_re[0]
-            task_table[key] = compress_buf(search_re, 'gzip')
+            task_table[key] = compress_buf(search_re, 'gzip', codec)
 
     if jobtype == 'preprocess':
         search_store('madx_in', 'madx_in')
@@ -45,28 +67,41 @@ def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
         os.path.basename(s)) or re.match(r'_condor_stdout', os.path.basename(s)))]
     if job_stdout:
         job_stdout = job_stdout[0]
-        task_table['job_stdout'] = compress_buf(job_stdout)
+        task_table['job_stdout'] = compress_buf(job_stdout, codec=codec)
 
     job_stderr = [s for s in contents if (re.match(r'htcondor\..+\.err',
         os.path.basename(s)) or re.match(r'_condor_stderr', os.path.basename(s)))]
     if job_stderr:
         job_stderr = job_stderr[0]
-        task_table['job_stderr'] = compress_buf(job_stderr)
+        task_table['job_stderr'] = compress_buf(job_stderr, codec=codec)
 
     job_stdlog = [s for s in contents if re.match(r'htcondor\..+\.log',
         os.path.basename(s))]
     if job_stdlog:
         job_stdlog = job_stdlog[0]
-        task_table['job_stdlog'] = compress_buf(job_stdlog)
+        task_table['job_stdlog'] = compress_buf(job_stdlog, codec=codec)
+
+    # the tracking stopped early since the particles were lost, see
+    # runner.survival_stop, the outputs are expected to be missing
+    early_stop = []
+    if jobtype == 'sixtrack':
+        early_stop = [s for s in contents
+                      if os.path.basename(s) == 'early_stop.json']
 
     valid_tname = []
     for out, tname in file_list.items():
         out_f = [s for s in contents if out in os.path.basename(s)]
         if out_f:
             out_f = out_f[0]
+            raw = None
+            if not legacy:
+                # decompress once, for both the parsing and the re-encoding
+                with gzip.open(out_f, 'rb') as f_in:
+                    raw = f_in.read()
             if tname is not None:
                 try:
-                    parse_file(out_f, task_table, result_cf[tname], tname)
+                    parse_file(out_f, task_table, result_cf[tname], tname,
+                               raw)
                     valid_tname.append(tname)
                 except Exception as e:
                     task_table['status'] = 'Failed'
@@ -74,12 +109,21 @@ def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
                         "file %s for task %s!" % (out, item)
                     logger.error(content)
                     logger.error(e, exc_info=True)
-            task_table[out] = compress_buf(out_f, 'gzip')
-        else:
+            if raw is None:
+                task_table[out] = compress_buf(out_f, 'gzip')
+            else:
+                task_table[out] = compress_buf(raw, 'bytes', codec)
+        elif not early_stop:
             task_table['status'] = 'Failed'
             content = f"The {jobtype} output file {out} for task {item} "\
                       "doesn't exist! The job failed!"
             logger.warning(content)
+    if early_stop and task_table['status'] != 'Failed':
+        # the outputs of a failed task can't be trusted
+        with open(early_stop[0], 'r') as f_in:
+            lost = json.load(f_in)
+        task_table['status'] = 'Lost'
+        task_table['lost_turn'] = lost.get('turn')
     # clean the redundant sections
     keys = list(result_cf.keys())
     for tname in keys:
@@ -87,12 +131,16 @@ def parse_results(jobtype, item, job_path, file_list, task_table, result_cf):
             result_cf.pop(tname)
 
 
-def parse_file(out_f, task_table, result_table, tname):
-    '''parse the files'''
+def parse_file(out_f, task_table, result_table, tname, raw=None):
+    '''parse the files
+    If raw is given, it's the already decompressed content of out_f'''
     countl = 0
     mtime = int(os.path.getmtime(out_f) * 1E7)
-    with gzip.open(out_f, 'rt') as f_in:
-        raw_lines = f_in.readlines()
+    if raw is None:
+        with gzip.open(out_f, 'rt') as f_in:
+            raw_lines = f_in.readlines()
+    else:
+        raw_lines = raw.decode().splitlines(True)
     lines = []
     postlines = []
     for lin in raw_lines:
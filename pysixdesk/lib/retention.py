@@ -0,0 +1,241 @@
+'''Retention of the blobs stored in the study database.
+
+The blobs which aren't needed anymore (superseded checkpoints, logs of the
+finished tasks, ...) are moved to tar archives outside of the database, one
+archive per table and compaction. The location of every archived blob is
+recorded in the blob_archive table, so that they can be restored on demand.
+'''
+import io
+import os
+import time
+import tarfile
+import logging
+from collections import OrderedDict
+
+# the checkpoint files of a segment, only needed to start the next segment
+CHECKPOINT_COLUMNS = ['crpoint_pri_bin', 'crpoint_sec_bin', 'fort_6',
+                      'singletrackfile_dat']
+# the logs of the jobs
+LOG_COLUMNS = {
+    'preprocess_task': ['madx_stdout', 'job_stdout', 'job_stderr',
+                        'job_stdlog'],
+    'sixtrack_task': ['job_stdout', 'job_stderr', 'job_stdlog', 'cr_stdout',
+                      'cr_stderr']}
+
+# the rules applied by each policy, see Study.compact
+POLICIES = {
+    'default': ['superseded_checkpoints', 'completed_logs'],
+    'all': ['superseded_checkpoints', 'completed_logs', 'finished_preprocess'],
+}
+
+
+def policy_rules(policy):
+    '''Get the rules of a policy, policy is either the name of a policy or a
+    list of rule names'''
+    if isinstance(policy, str):
+        if policy not in POLICIES:
+            content = "Unknown retention policy %s! Must be one of %s." % (
+                policy, ', '.join(POLICIES.keys()))
+            raise ValueError(content)
+        return list(POLICIES[policy])
+    rules = list(policy)
+    known = set(r for rules_i in POLICIES.values() for r in rules_i)
+    for rule in rules:
+        if rule not in known:
+            raise ValueError("Unknown retention rule %s!" % rule)
+    return rules
+
+
+def superseded_checkpoints(db):
+    '''The sixtrack tasks whose checkpoint files were used by a later
+    complete segment of the same job.
+
+    Returns:
+        list: task ids.
+    '''
+    rows = db.select('sixtrack_wu', ['wu_id', 'last_turn', 'task_id'],
+                     "status='complete'")
+    latest = {}
+    for wu_id, last_turn, task_id in rows:
+        if last_turn > latest.get(wu_id, -1):
+            latest[wu_id] = last_turn
+    return [task_id for wu_id, last_turn, task_id in rows
+            if task_id is not None and last_turn < latest[wu_id]]
+
+
+def completed_tasks(db, table_name):
+    '''The tasks of the given table which were successfully gathered'''
+    rows = db.select(table_name, ['task_id'], "status in ('Success','Lost')")
+    return [i[0] for i in rows]
+
+
+def finished_preprocess(db):
+    '''The preprocess tasks whose sixtrack jobs are all complete.
+
+    Returns:
+        list: task ids.
+    '''
+    rows = db.select('sixtrack_wu', ['preprocess_id', 'status'])
+    finished = OrderedDict()
+    for pre_id, status in rows:
+        finished[pre_id] = finished.get(pre_id, True) and status == 'complete'
+    pre_ids = [i for i, done in finished.items() if done]
+    if not pre_ids:
+        return []
+    where = "status='complete' and wu_id in (%s)" % ','.join(map(str, pre_ids))
+    rows = db.select('preprocess_wu', ['task_id'], where)
+    return [i[0] for i in rows if i[0] is not None]
+
+
+class BlobArchive(object):
+    '''Move blobs between the database and the tar archives'''
+
+    index_table = 'blob_archive'
+    # number of rows loaded at once from the database
+    batch_size = 100
+
+    def __init__(self, db, archive_path, base_path=None):
+        '''Constructor.
+        db (SixDB): the study database
+        archive_path (str): the folder of the archives
+        base_path (str): the archive locations are recorded relative to it,
+        e.g. the study path, so that the study can be moved
+        '''
+        self._logger = logging.getLogger(__name__)
+        self.db = db
+        self.archive_path = archive_path
+        self.base_path = base_path or archive_path
+        cols = OrderedDict([
+            ('table_name', 'text'),
+            ('task_id', 'int'),
+            ('column_name', 'text'),
+            ('archive', 'text'),
+            ('member', 'text'),
+            ('size', 'int'),
+            ('mtime', 'bigint')])
+        keys = {'primary': ['table_name', 'task_id', 'column_name']}
+        self.db.create_table(self.index_table, cols, keys)
+
+    def archive(self, table_name, task_ids, columns):
+        '''Move the given blobs of the tasks to a new archive.
+
+        Args:
+            table_name (str): the task table, e.g. 'sixtrack_task'.
+            task_ids (list): the tasks to archive.
+            columns (list): the blob columns to archive.
+
+        Returns:
+            int: the number of archived bytes.
+        '''
+        task_ids = sorted(set(task_ids))
+        if not task_ids or not columns:
+            return 0
+        if not os.path.isdir(self.archive_path):
+            os.makedirs(self.archive_path)
+        stamp = int(time.time() * 1E7)
+        name = os.path.join(self.archive_path, f'{table_name}_{stamp}.tar')
+        rel_name = os.path.relpath(name, self.base_path)
+        archived = []
+        n_bytes = 0
+        with tarfile.open(name, 'w') as tar:
+            for i in range(0, len(task_ids), self.batch_size):
+                batch = task_ids[i:i + self.batch_size]
+                where = 'task_id in (%s)' % ','.join(map(str, batch))
+                rows = self.db.select(table_name, ['task_id'] + columns, where)
+                for row in rows:
+                    for col, buf in zip(columns, row[1:]):
+                        if buf is None:
+                            continue
+                        buf = bytes(buf)
+                        member = f'{table_name}/{row[0]}/{col}'
+                        info = tarfile.TarInfo(member)
+                        info.size = len(buf)
+                        info.mtime = time.time()
+                        tar.addfile(info, io.BytesIO(buf))
+                        archived.append((row[0], col, member, len(buf)))
+                        n_bytes += len(buf)
+            tar.fileobj.flush()
+            os.fsync(tar.fileobj.fileno())
+        if not archived:
+            os.remove(name)
+            return 0
+        # record the locations before releasing the blobs, the blobs written
+        # again since a previous compaction replace the old records
+        where = "table_name='%s' and task_id in (%s)" % (
+            table_name, ','.join(str(i) for i in set(i[0] for i in archived)))
+        where += " and column_name in (%s)" % ','.join(
+            "'%s'" % i for i in columns)
+        self.db.remove(self.index_table, where)
+        index = OrderedDict()
+        index['table_name'] = [table_name] * len(archived)
+        index['task_id'] = [i[0] for i in archived]
+        index['column_name'] = [i[1] for i in archived]
+        index['archive'] = [rel_name] * len(archived)
+        index['member'] = [i[2] for i in archived]
+        index['size'] = [i[3] for i in archived]
+        index['mtime'] = [stamp] * len(archived)
+        self.db.insertm(self.index_table, index)
+        released = OrderedDict()
+        for task_id, col, _, _ in archived:
+            released.setdefault(task_id, OrderedDict())[col] = None
+        for task_id, values in released.items():
+            self.db.update(table_name, values, f'task_id={task_id}')
+        content = "Archived %d blobs (%d bytes) of %s to %s." % (
+            len(archived), n_bytes, table_name, rel_name)
+        self._logger.info(content)
+        return n_bytes
+
+    def archived(self, table_name, task_ids=None, columns=None):
+        '''Get the archive records of the given tasks and columns.
+
+        Returns:
+            list: (task_id, column_name, archive, member) tuples.
+        '''
+        where = f"table_name='{table_name}'"
+        if task_ids is not None:
+            where += ' and task_id in (%s)' % ','.join(map(str, task_ids))
+        if columns is not None:
+            where += " and column_name in (%s)" % ','.join(
+                "'%s'" % i for i in columns)
+        return self.db.select(self.index_table, ['task_id', 'column_name',
+                                                 'archive', 'member'], where)
+
+    def restore(self, table_name, task_ids=None, columns=None):
+        '''Put the archived blobs back in the database.
+
+        Args:
+            table_name (str): the task table, e.g. 'sixtrack_task'.
+            task_ids (list): the tasks to restore, all if None.
+            columns (list): the columns to restore, all if None.
+
+        Returns:
+            int: the number of restored blobs.
+        '''
+        if task_ids is not None and len(task_ids) == 0:
+            return 0
+        records = self.archived(table_name, task_ids, columns)
+        archives = OrderedDict()
+        for task_id, col, archive, member in records:
+            archives.setdefault(archive, []).append((task_id, col, member))
+        n_restored = 0
+        for archive, items in archives.items():
+            name = os.path.join(self.base_path, archive)
+            if not os.path.isfile(name):
+                content = "The archive %s doesn't exist!" % name
+                raise FileNotFoundError(content)
+            values = OrderedDict()
+            with tarfile.open(name, 'r') as tar:
+                for task_id, col, member in items:
+                    buf = tar.extractfile(member).read()
+                    values.setdefault(task_id, OrderedDict())[col] = buf
+            for task_id, vals in values.items():
+                self.db.update(table_name, vals, f'task_id={task_id}')
+                where = "table_name='%s' and task_id=%s and column_name in "\
+                    "(%s)" % (table_name, task_id,
+                              ','.join("'%s'" % i for i in vals.keys()))
+                self.db.remove(self.index_table, where)
+                n_restored += len(vals)
+        if n_restored:
+            content = "Restored %d blobs of %s." % (n_restored, table_name)
+            self._logger.info(content)
+        return n_restored
@@ -0,0 +1,288 @@
+'''Execution of the executables (MAD-X, SixTrack) of the jobs.
+
+The standard output and error of the process are streamed to files as they
+are produced, only a bounded tail of the output is kept in memory. The exit
+code and the resource usage of the process are collected with wait4, and
+the progress lines (e.g. the TRACKING> lines of SixTrack) are parsed into a
+small heartbeat json file, rewritten atomically every few seconds, which can
+be read to monitor the running jobs cheaply.
+'''
+import os
+import re
+import json
+import time
+import shutil
+import signal
+import logging
+import threading
+import subprocess
+from collections import deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# size of the chunks read from the pipe, and maximal length of a line kept
+# for the tail and the progress parser
+CHUNK_SIZE = 64 * 1024
+MAX_LINE = 4096
+
+# e.g. "TRACKING> Turn 512 / 1000, Particles: 58 / 60"
+TURN_RE = r'[Tt]urns?\W*(\d+)\s*(?:/|of)\s*(\d+)'
+PARTICLE_RE = r'[Pp]articles?\W*(\d+)\s*(?:/|of)\s*(\d+)'
+
+# time given to a stopped process to exit before it is killed (s)
+STOP_GRACE = 10.0
+
+RunResult = namedtuple('RunResult', ['returncode', 'usage', 'tail',
+                                     'progress', 'stopped'])
+
+
+def parse_tracking(line):
+    '''Parse a TRACKING> line of SixTrack.
+
+    Returns:
+        dict: turn, turns, particles (surviving) and total_particles, None if
+        not a tracking line.
+    '''
+    if 'TRACKING>' not in line:
+        return None
+    turns = re.search(TURN_RE, line)
+    particles = re.search(PARTICLE_RE, line)
+    if turns and particles:
+        return {'turn': int(turns.group(1)),
+                'turns': int(turns.group(2)),
+                'particles': int(particles.group(1)),
+                'total_particles': int(particles.group(2))}
+    # the layout read by the older versions of the check
+    try:
+        info = re.split(r':|,', line)
+        turn_info = info[1].split()
+        part_info = info[-1].split()
+        return {'turn': int(float(turn_info[1])),
+                'turns': int(float(turn_info[-1])),
+                'particles': int(float(part_info[0])),
+                'total_particles': int(float(part_info[-1]))}
+    except (IndexError, ValueError):
+        return None
+
+
+def survival_stop(threshold=0.0):
+    '''A stop condition of the tracking, when the ratio of surviving
+    particles is zero or below the threshold before the last turn.
+
+    Returns:
+        callable: progress dict -> the reason to stop, or None.
+    '''
+    def stop(progress):
+        if progress['turn'] >= progress['turns']:
+            return None
+        total = progress['total_particles']
+        ratio = progress['particles'] / total if total else 0.0
+        if progress['particles'] == 0 or ratio < threshold:
+            return "%d of %d particles left at turn %d" % (
+                progress['particles'], total, progress['turn'])
+        return None
+    return stop
+
+
+def _exit_code(status):
+    '''The exit code of a wait status, -signal if killed'''
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def read_heartbeat(path):
+    '''Read a heartbeat file, None if missing or being replaced'''
+    try:
+        with open(path, 'r') as f_in:
+            return json.load(f_in)
+    except (OSError, ValueError):
+        return None
+
+
+class ProcessRunner(object):
+    '''Run a command and stream its output to files'''
+
+    def __init__(self, command, stdout, stderr=None, heartbeat=None,
+                 parser=None, tail=50, interval=5.0, stop=None, cwd=None):
+        '''Constructor.
+
+        Args:
+            command (str/list): the command, a string is run by the shell
+            like with os.popen.
+            stdout (str/path): file of the standard output.
+            stderr (str/path): file of the standard error, the one of the
+            job (e.g. _condor_stderr) if None.
+            heartbeat (str/path): the heartbeat file, not written if None.
+            parser (callable): parses a line of the output into a progress
+            dict, or returns None.
+            tail (int): the number of last lines kept.
+            interval (float): minimal time between two heartbeats (s).
+            stop (callable): called with each new progress, the process
+            (and its children) is terminated if it returns a reason.
+            cwd (str/path): the working directory of the process.
+        '''
+        self.command = command
+        self.stdout = stdout
+        self.stderr = stderr
+        self.heartbeat = heartbeat
+        self.parser = parser
+        self.tail = deque(maxlen=tail)
+        self.interval = interval
+        self.stop = stop
+        self.cwd = cwd
+        self.stopped = None
+        self.progress = None
+        self.lines = 0
+        self.pid = None
+        self.start = None
+        self._beat = 0
+        self._killer = None
+
+    def _write_heartbeat(self, status, returncode=None, usage=None):
+        if self.heartbeat is None:
+            return
+        now = time.time()
+        beat = {'pid': self.pid,
+                'status': status,
+                'start': self.start,
+                'update': now,
+                'elapsed': now - self.start,
+                'lines': self.lines,
+                'progress': self.progress}
+        if returncode is not None:
+            beat['returncode'] = returncode
+        if usage is not None:
+            beat['usage'] = usage
+        tmp = f'{self.heartbeat}.tmp'
+        try:
+            with open(tmp, 'w') as f_out:
+                json.dump(beat, f_out)
+            os.replace(tmp, self.heartbeat)
+        except OSError as e:
+            logger.warning("Failed to write the heartbeat: %s" % e)
+        self._beat = now
+
+    def _feed(self, line):
+        line = line[:MAX_LINE].decode('utf-8', 'replace')
+        self.lines += 1
+        self.tail.append(line)
+        if self.parser is not None:
+            progress = self.parser(line)
+            if progress is not None:
+                self.progress = progress
+                if self.stop is not None and self.stopped is None:
+                    reason = self.stop(progress)
+                    if reason:
+                        self._terminate(reason)
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:
+            pass
+
+    def _terminate(self, reason):
+        '''Stop the process group, killed after STOP_GRACE seconds'''
+        self.stopped = reason
+        content = "Stopping %s: %s." % (self._name(), reason)
+        logger.info(content)
+        self._signal(signal.SIGTERM)
+        self._killer = threading.Timer(STOP_GRACE, self._signal,
+                                       [signal.SIGKILL])
+        self._killer.daemon = True
+        self._killer.start()
+
+    def run(self):
+        '''Run the command until it exits.
+
+        Returns:
+            RunResult: the return code, the usage (wall_time, cpu_time in s
+            and peak_memory in MB), the last lines and the last progress.
+        '''
+        shell = isinstance(self.command, str)
+        self.start = time.time()
+        with open(self.stdout, 'wb') as f_out:
+            f_err = None
+            if self.stderr is not None:
+                f_err = open(self.stderr, 'wb')
+            try:
+                # in its own process group to stop the children of the shell
+                process = subprocess.Popen(
+                    self.command, shell=shell, stdout=subprocess.PIPE,
+                    stderr=f_err, cwd=self.cwd,
+                    start_new_session=self.stop is not None)
+                self.pid = process.pid
+                self._write_heartbeat('running')
+                pending = b''
+                while True:
+                    chunk = process.stdout.read1(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+                    lines = (pending + chunk).split(b'\n')
+                    # bound the partial line, e.g. progress bars without
+                    # newline
+                    pending = lines.pop()[-MAX_LINE:]
+                    for line in lines:
+                        self._feed(line)
+                    if time.time() - self._beat >= self.interval:
+                        f_out.flush()
+                        self._write_heartbeat('running')
+                if pending:
+                    self._feed(pending)
+                process.stdout.close()
+                _, status, rusage = os.wait4(process.pid, 0)
+                # the process is reaped, tell it to Popen
+                process.returncode = _exit_code(status)
+            finally:
+                if self._killer is not None:
+                    self._killer.cancel()
+                if f_err is not None:
+                    f_err.close()
+        usage = {'wall_time': time.time() - self.start,
+                 'cpu_time': rusage.ru_utime + rusage.ru_stime,
+                 # ru_maxrss is in kB on linux
+                 'peak_memory': rusage.ru_maxrss / 1024.}
+        self._write_heartbeat('stopped' if self.stopped else 'finished',
+                              process.returncode, usage)
+        content = "%s exited with %d after %.1f s." % (
+            self._name(), process.returncode, usage['wall_time'])
+        logger.info(content)
+        return RunResult(process.returncode, usage, list(self.tail),
+                         self.progress, self.stopped)
+
+    def _name(self):
+        if isinstance(self.command, str):
+            return self.command.split()[0]
+        return self.command[0]
+
+
+def run(command, stdout, **kwargs):
+    '''Run a command, see ProcessRunner'''
+    return ProcessRunner(command, stdout, **kwargs).run()
+
+
+def run_sixtrack(command, output_file, heartbeat=None, stop=None, cwd=None):
+    '''Run SixTrack, its standard output is written to output_file. Some
+    versions write it to fort.6 themselves, which is then copied to
+    output_file. stop is the early stop condition, see survival_stop, and
+    cwd the folder of the run, the current one if None.
+
+    Returns:
+        RunResult: see ProcessRunner.run.
+    '''
+    folder = cwd or '.'
+    output_file = os.path.join(folder, output_file)
+    fort_6 = os.path.join(folder, 'fort.6')
+    stream = f'{output_file}.stdout'
+    result = run(command, stream, heartbeat=heartbeat, parser=parse_tracking,
+                 stop=stop, cwd=cwd)
+    if os.path.getsize(stream):
+        os.replace(stream, output_file)
+    else:
+        os.remove(stream)
+        stopped = result.stopped and not os.path.isfile(fort_6)
+        if output_file != fort_6 and not stopped:
+            shutil.copy2(fort_6, output_file)
+    return result
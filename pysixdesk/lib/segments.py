@@ -0,0 +1,91 @@
+'''Chaining of the checkpoint/restart segments of the sixtrack jobs.
+
+A long tracking is split in segments of turns, every segment restarting from
+the checkpoint files of the previous one, see TrackingJob. A segment is a
+row (wu_id, last_turn) of the sixtrack_wu table. When a segment of a work
+unit is complete and it is the last one of the work unit, the next segment
+is inserted with the 'incomplete' status, so that it is prepared and
+submitted with the other incomplete jobs.
+
+The ready segments are found and inserted by the database in a single
+INSERT ... SELECT, the primary key (wu_id, last_turn) makes the lookup of
+the following segments an index search.
+'''
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def insert_next(db, columns, where, last_turn):
+    '''Insert the segments following the complete last segments of the work
+    units.
+
+    Args:
+        db (SixDB): the study database.
+        columns (list): the columns of the sixtrack_wu table.
+        where (str): extra condition on the previous segment, with the table
+        alias s, e.g. "s.last_turn<1000".
+        last_turn (str): SQL expression of the last turn of the new segment,
+        from the previous one.
+
+    Returns:
+        int: the number of inserted segments.
+    '''
+    values = {
+        'first_turn': 's.last_turn+1',
+        'last_turn': last_turn,
+        'turnss': last_turn,
+        'status': "'incomplete'",
+        'task_id': 'NULL',
+        'unique_id': 'NULL',
+        'batch_name': 'NULL',
+        'lost_turn': 'NULL',
+        'mtime': str(int(time.time() * 1E7))}
+    columns = [i.replace('.', '_') for i in columns]
+    if 'lost_turn' in columns:
+        # no next segment once the particles are lost
+        where += ' AND s.lost_turn IS NULL'
+    exprs = [values.get(i, f's.{i}') for i in columns]
+    sql = (f"INSERT INTO sixtrack_wu ({','.join(columns)}) "
+           f"SELECT {','.join(exprs)} FROM sixtrack_wu s "
+           f"WHERE s.status='complete' AND {where} AND NOT EXISTS "
+           f"(SELECT 1 FROM sixtrack_wu n WHERE n.wu_id=s.wu_id AND "
+           f"n.last_turn>s.last_turn)")
+    return db.execute(sql)
+
+
+def chain(db, columns, segment_turns, final_turn):
+    '''Insert the next segment of the work units whose last segment is
+    complete, until the final turn.
+
+    Args:
+        db (SixDB): the study database.
+        columns (list): the columns of the sixtrack_wu table.
+        segment_turns (int): the number of turns of a segment.
+        final_turn (int): the last turn of the tracking.
+
+    Returns:
+        int: the number of inserted segments.
+    '''
+    segment_turns = int(segment_turns)
+    final_turn = int(final_turn)
+    last_turn = (f"CASE WHEN s.last_turn+{segment_turns}<{final_turn} "
+                 f"THEN s.last_turn+{segment_turns} ELSE {final_turn} END")
+    count = insert_next(db, columns, f's.last_turn<{final_turn}', last_turn)
+    if count:
+        content = "Queued %d new tracking segments." % count
+        logger.info(content)
+    return count
+
+
+def pending(db, final_turn):
+    '''The number of work units which didn't reach the final turn yet'''
+    done = f"n.last_turn>={int(final_turn)}"
+    if 'lost_turn' in db.fetch_columns('sixtrack_wu'):
+        done = f"({done} OR n.lost_turn IS NOT NULL)"
+    where = (f"NOT EXISTS (SELECT 1 FROM sixtrack_wu n WHERE "
+             f"n.wu_id=sixtrack_wu.wu_id AND {done} AND "
+             f"n.status='complete')")
+    out = db.select('sixtrack_wu', ['count(DISTINCT wu_id)'], where)
+    return out[0][0] if out else 0
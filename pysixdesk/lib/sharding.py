@@ -0,0 +1,449 @@
+import os
+import re
+import glob
+import logging
+from collections import OrderedDict
+
+
+class ShardManager(object):
+    '''Split some tables of a sqlite database over several files.
+
+    The rows of a sharded table are stored in per-shard files
+    (<db_name>.shard_<n>.db) according to ranges of the shard key, e.g.
+    task_id 1 to size in shard 0, size+1 to 2*size in shard 1 and so on. The
+    shard files are attached to the connection on demand. The table of the
+    main database keeps the schema (and the rows written before the table was
+    sharded), the selects are transparently run over the main table and all
+    the shards.
+
+    The layout is recorded in the shard_info table of the main database, so
+    that every connection to the database picks it up. The new key values are
+    allocated from the counter of the table in the shard_keys table of the
+    main database, so that concurrent writers never get the same key. Each
+    connection reserves them by blocks of key_block values, the main
+    database is only locked once per block, the unused values of a block
+    are lost. The rows inserted with an explicit key (e.g. the tasks
+    gathered with the key allocated at their preparation) only move the
+    counter when the key is past it. The updates and deletions selecting a
+    single key value (key=N) only write to its shard, the main table is only
+    written when it can hold the rows, so concurrent writers working on
+    different shards don't wait for each other.
+
+    Foreign keys towards tables which aren't sharded are dropped in the shard
+    files, since sqlite doesn't support them across database files: removing
+    a row of e.g. the wu table does not cascade to the sharded tables, the
+    rows referencing it have to be removed explicitly. The foreign keys
+    between sharded tables are kept and cascade inside each shard.
+    '''
+
+    info_table = 'shard_info'
+    keys_table = 'shard_keys'
+    default_tables = ['sixtrack_task', 'six_results', 'aperture_losses',
+                      'collimation_losses', 'init_state', 'final_state']
+    # sqlite attaches at most 10 databases by default
+    max_attached = 8
+    # the number of key values reserved at once by a connection
+    key_block = 100
+
+    def __init__(self, db):
+        '''Constructor.
+        db (SixDB): the sqlite database holding the main tables
+        '''
+        self._logger = logging.getLogger(__name__)
+        self.db = db
+        name = db.info['db_name']
+        if name.endswith('.db'):
+            name = name[:-3]
+        self.prefix = name
+        self.tables = OrderedDict()
+        self.attached = OrderedDict()
+        # table -> [next, end] of the key values reserved by the connection
+        self.pools = {}
+        # table -> the last value of the counter read
+        self.known = {}
+        # table -> the largest key of the rows in the main table
+        self.main_last = {}
+        self.load()
+
+    @property
+    def conn(self):
+        return self.db.conn
+
+    @property
+    def adaptor(self):
+        return self.db.adaptor
+
+    def load(self):
+        '''Load the layout recorded in the main database'''
+        self.tables.clear()
+        if (self.info_table,) not in self.adaptor.fetch_tables(self.conn):
+            return
+        rows = self.adaptor.select(self.conn, self.info_table,
+                                   ['table_name', 'shard_key', 'shard_size'])
+        for table, key, size in rows:
+            self.tables[table] = (key, int(size))
+        if (self.keys_table,) not in self.adaptor.fetch_tables(self.conn):
+            self._create_keys()
+
+    def _create_keys(self):
+        cols = OrderedDict([('table_name', 'text'), ('next_key', 'int')])
+        self.adaptor.create_table(self.conn, self.keys_table, cols,
+                                  {'primary': ['table_name']}, False)
+
+    def configure(self, tables, key='task_id', size=10000):
+        '''Record the sharded layout for the given tables.
+
+        Args:
+            tables (list): names of the tables to shard.
+            key (str): integer column used to route the rows.
+            size (int): number of key values per shard.
+        '''
+        size = int(size)
+        if size <= 0:
+            raise ValueError("The shard size must be positive!")
+        cols = OrderedDict([('table_name', 'text'), ('shard_key', 'text'),
+                            ('shard_size', 'int')])
+        self.adaptor.create_table(self.conn, self.info_table, cols,
+                                  {'primary': ['table_name']}, False)
+        self._create_keys()
+        for table in tables:
+            if table in self.tables:
+                if self.tables[table] != (key, size):
+                    content = "The table %s is already sharded by %s with "\
+                        "size %s!" % (table, *self.tables[table])
+                    raise ValueError(content)
+                continue
+            self.adaptor.insert(self.conn, self.info_table,
+                                {'table_name': table, 'shard_key': key,
+                                 'shard_size': size})
+            self.tables[table] = (key, size)
+
+    def is_sharded(self, table):
+        return table in self.tables
+
+    def shard_path(self, index):
+        return '%s.shard_%d.db' % (self.prefix, index)
+
+    def existing(self):
+        '''The indices of the existing shard files'''
+        indices = []
+        for path in glob.glob(self.prefix + '.shard_*.db'):
+            match = re.search(r'\.shard_(\d+)\.db$', path)
+            if match:
+                indices.append(int(match.group(1)))
+        return sorted(indices)
+
+    def index(self, table, value):
+        '''The shard index of the given key value'''
+        size = self.tables[table][1]
+        return max(int(value) - 1, 0) // size
+
+    def alias(self, index, create=False):
+        '''Attach the shard on demand, returns the schema name'''
+        if index in self.attached:
+            self.attached.move_to_end(index)
+            return self.attached[index]
+        path = self.shard_path(index)
+        new = not os.path.exists(path)
+        if new and not create:
+            return None
+        self.conn.commit()
+        while len(self.attached) >= self.max_attached:
+            _, old = self.attached.popitem(last=False)
+            self.conn.execute('DETACH DATABASE %s' % old)
+        alias = 'shard_%d' % index
+        self.conn.execute('ATTACH DATABASE ? AS %s' % alias, (path,))
+        self.attached[index] = alias
+        if self.db.settings is not None:
+            self.adaptor.setting(self.conn, self.db.settings, schema=alias)
+        for overlay in self.db.overlays:
+            self.adaptor.setting(self.conn, overlay, schema=alias)
+        self._create_schema(alias)
+        return alias
+
+    def _create_schema(self, alias):
+        '''Create the sharded tables in the shard file from the schema of the
+        main tables'''
+        names = ','.join("'%s'" % t for t in self.tables)
+        rows = self.adaptor.select(self.conn, 'sqlite_master',
+                                   ['name', 'sql'],
+                                   "type='table' and name in (%s)" % names)
+        fk_re = re.compile(r',\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+'
+                           r'(\w+)\s*\([^)]*\)[^,)]*', re.IGNORECASE)
+        for name, sql in rows:
+            def strip_fk(match):
+                if match.group(1) in self.tables:
+                    return match.group(0)
+                content = "The foreign key of %s towards %s isn't kept in "\
+                    "the shards, the deletions don't cascade!" % (
+                        name, match.group(1))
+                self._logger.debug(content)
+                return ''
+            sql = fk_re.sub(strip_fk, sql)
+            sql = re.sub(r'^\s*CREATE TABLE\s+(IF NOT EXISTS\s+)?"?%s"?' % name,
+                         'CREATE TABLE IF NOT EXISTS %s.%s' % (alias, name),
+                         sql, flags=re.IGNORECASE)
+            self.conn.execute(sql)
+        self.conn.commit()
+
+    def vacuum(self, pages=None):
+        '''Reclaim the free pages of every shard file'''
+        for index in self.existing():
+            alias = self.alias(index)
+            mode = self.adaptor.current_settings(self.conn, ['auto_vacuum'],
+                                                 schema=alias)['auto_vacuum']
+            if mode == 2:
+                sql = 'PRAGMA %s.incremental_vacuum' % alias
+                if pages is not None:
+                    sql += '(%d)' % int(pages)
+                self.conn.execute(sql).fetchall()
+            elif pages is None:
+                self.conn.commit()
+                self.conn.execute('VACUUM %s' % alias)
+        self.conn.commit()
+
+    def close(self):
+        self.attached.clear()
+
+    def _routed_value(self, table, where):
+        '''The key value if the condition selects a single one'''
+        if where is None:
+            return None
+        key = self.tables[table][0]
+        match = re.match(r"^\s*%s\s*=\s*'?(\d+)'?\s*$" % key, str(where))
+        if match:
+            return int(match.group(1))
+        return None
+
+    def _routed_index(self, table, where):
+        '''The shard index if the condition selects a single key value'''
+        value = self._routed_value(table, where)
+        if value is None:
+            return None
+        return self.index(table, value)
+
+    def _targets(self, table, where):
+        '''The shard indices concerned by the condition'''
+        index = self._routed_index(table, where)
+        if index is None:
+            return self.existing()
+        if os.path.exists(self.shard_path(index)):
+            return [index]
+        return []
+
+    def _in_main(self, table, where):
+        '''Whether the rows of the condition can be in the main table, which
+        only keeps the rows written before the table was sharded'''
+        if table not in self.main_last:
+            key = self.tables[table][0]
+            out = self.adaptor.select(self.conn, table, ['max(%s)' % key])
+            self.main_last[table] = out[0][0]
+        last = self.main_last[table]
+        if last is None:
+            return False
+        value = self._routed_value(table, where)
+        return value is None or value <= last
+
+    def _last_key(self, table):
+        '''The largest key value stored, the shards hold ranges of the key so
+        only the last non empty shard is looked at'''
+        key = self.tables[table][0]
+        out = self.adaptor.select(self.conn, table, ['max(%s)' % key])
+        last = out[0][0] or 0
+        for index in reversed(self.existing()):
+            out = self.adaptor.select(self.conn,
+                                      '%s.%s' % (self.alias(index), table),
+                                      ['max(%s)' % key])
+            if out[0][0] is not None:
+                return max(last, out[0][0])
+        return last
+
+    def _counter(self, table):
+        '''The next key value of the counter of the table, read without
+        locking the main database, None if the counter doesn't exist yet'''
+        out = self.conn.execute('SELECT next_key FROM %s WHERE table_name=?'
+                                % self.keys_table, (table,)).fetchone()
+        if out is None:
+            return None
+        self.known[table] = out[0]
+        return out[0]
+
+    def _reserve(self, table, count, used=None):
+        '''Move the counter of the table in a transaction of the main
+        database, it is initialised from the stored rows the first time.
+        When the connection is already in a transaction the counter is
+        moved in a savepoint of it, which isn't committed here.
+
+        Returns:
+            int: the first reserved value.
+        '''
+        start = None
+        if self._counter(table) is None:
+            start = self._last_key(table) + 1
+        nested = self.conn.in_transaction
+        self.conn.execute('SAVEPOINT shard_keys' if nested else
+                          'BEGIN IMMEDIATE')
+        try:
+            if start is not None:
+                self.conn.execute('INSERT OR IGNORE INTO %s VALUES (?, ?)'
+                                  % self.keys_table, (table, start))
+            if used is not None:
+                self.conn.execute('UPDATE %s SET next_key=max(next_key, ?) '
+                                  'WHERE table_name=?' % self.keys_table,
+                                  (int(used) + 1, table))
+            first = self.conn.execute('SELECT next_key FROM %s WHERE '
+                                      'table_name=?' % self.keys_table,
+                                      (table,)).fetchone()[0]
+            self.conn.execute('UPDATE %s SET next_key=? WHERE table_name=?'
+                              % self.keys_table, (first + count, table))
+        except Exception:
+            if nested:
+                self.conn.execute('ROLLBACK TO shard_keys')
+                self.conn.execute('RELEASE shard_keys')
+            else:
+                self.conn.rollback()
+            raise
+        if nested:
+            self.conn.execute('RELEASE shard_keys')
+        else:
+            self.conn.commit()
+        self.known[table] = first + count
+        return first
+
+    def allocate(self, table, count=1, used=None):
+        '''Get new key values, from the block reserved by the connection or
+        from a new block.
+
+        Args:
+            table (str): the sharded table.
+            count (int): the number of values to get.
+            used (int): a key value inserted explicitly, the counter is moved
+            past it if needed, nothing is allocated.
+
+        Returns:
+            int: the first value, None with used.
+        '''
+        pool = self.pools.get(table)
+        if used is not None:
+            used = int(used)
+            if pool is not None and pool[0] <= used < pool[1]:
+                pool[0] = used + 1
+            if used < self.known.get(table, 0):
+                return None
+            counter = self._counter(table)
+            # without counter, it starts after the stored keys anyway
+            if counter is not None and used >= counter:
+                self._reserve(table, 0, used)
+            return None
+        if pool is not None and pool[1] - pool[0] >= count:
+            first = pool[0]
+            pool[0] += count
+            return first
+        if self.conn.in_transaction:
+            # the reservation is rolled back with the transaction of the
+            # caller, no block is kept
+            return self._reserve(table, count)
+        block = max(count, self.key_block)
+        first = self._reserve(table, block)
+        self.pools[table] = [first + count, first + block]
+        return first
+
+    def insert(self, table, values):
+        '''Insert a row in the shard of its key, a new key is allocated if
+        the row doesn't have one'''
+        key = self.tables[table][0]
+        values = OrderedDict(values)
+        if values.get(key) is None:
+            values[key] = self.allocate(table)
+        else:
+            self.allocate(table, 0, used=values[key])
+        alias = self.alias(self.index(table, values[key]), create=True)
+        self.adaptor.insert(self.conn, '%s.%s' % (alias, table), values)
+
+    def insertm(self, table, values):
+        '''Insert multiple rows, grouped by shard'''
+        if len(values) == 0:
+            return
+        key = self.tables[table][0]
+        names = list(values.keys())
+        rows = list(zip(*[values[name] for name in names]))
+        start = None
+        if key not in names:
+            names.append(key)
+            start = self.allocate(table, len(rows))
+            rows = [row + (start + i,) for i, row in enumerate(rows)]
+        ind = names.index(key)
+        if start is None:
+            self.allocate(table, 0, used=max(row[ind] for row in rows))
+        groups = OrderedDict()
+        for row in rows:
+            groups.setdefault(self.index(table, row[ind]), []).append(row)
+        for index, group in groups.items():
+            alias = self.alias(index, create=True)
+            group_values = OrderedDict(zip(names, zip(*group)))
+            self.adaptor.insertm(self.conn, '%s.%s' % (alias, table),
+                                 group_values)
+
+    def update(self, table, values, where):
+        '''Update the rows in the concerned shards, and in the main table if
+        it can hold them'''
+        if self._in_main(table, where):
+            self.adaptor.update(self.conn, table, values, where)
+        for index in self._targets(table, where):
+            alias = self.alias(index)
+            self.adaptor.update(self.conn, '%s.%s' % (alias, table), values,
+                                where)
+
+    def add_column(self, table, column, dtype):
+        '''Add a column to the table of the existing shards, the new shards
+        copy the schema of the main table'''
+        for index in self.existing():
+            alias = self.alias(index)
+            self.adaptor.add_column(self.conn, '%s.%s' % (alias, table),
+                                    column, dtype)
+
+    def delete(self, table, where):
+        '''Remove the rows in the concerned shards, and in the main table if
+        it can hold them'''
+        if self._in_main(table, where):
+            self.adaptor.delete(self.conn, table, where)
+        for index in self._targets(table, where):
+            alias = self.alias(index)
+            self.adaptor.delete(self.conn, '%s.%s' % (alias, table), where)
+
+    def select(self, table, columns='*', where=None, orderby=None, **kwargs):
+        '''Select over the main table and the concerned shards. When the
+        shards can't all be attached at once, they are read by groups of at
+        most max_attached files in a temporary table, on which the ordering,
+        grouping, aggregates and limit are applied.'''
+        indices = self._targets(table, where)
+        if len(indices) <= self.max_attached:
+            source = self._union(table, indices)
+            return self.adaptor.select(self.conn, source, columns, where,
+                                       orderby, **kwargs)
+        merged = 'temp.shard_merge_%s' % table
+        self.conn.execute('DROP TABLE IF EXISTS %s' % merged)
+        self.conn.execute('CREATE TABLE %s AS SELECT * FROM %s WHERE 0'
+                          % (merged, table))
+        cond = '' if where is None else ' WHERE %s' % where
+        try:
+            for i in range(0, len(indices), self.max_attached):
+                group = indices[i:i + self.max_attached]
+                source = self._union(table, group, main=(i == 0))
+                self.conn.execute('INSERT INTO %s SELECT * FROM %s%s'
+                                  % (merged, source, cond))
+            source = '%s AS %s' % (merged, table)
+            return self.adaptor.select(self.conn, source, columns, None,
+                                       orderby, **kwargs)
+        finally:
+            self.conn.execute('DROP TABLE IF EXISTS %s' % merged)
+
+    def _union(self, table, indices, main=True):
+        '''The union of the main table and the given shards, as a source of
+        a select'''
+        names = [table] if main else []
+        for index in indices:
+            names.append('%s.%s' % (self.alias(index), table))
+        source = ' UNION ALL '.join('SELECT * FROM %s' % name
+                                    for name in names)
+        return '(%s) AS %s' % (source, table)
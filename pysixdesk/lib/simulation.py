@@ -0,0 +1,504 @@
+'''Simulation of a HTCondor pool for scale-testing the orchestration.
+
+SimulatedCluster implements the Cluster interface without running anything:
+the jobs go through the HTCondor states (idle, running, held, evicted,
+completed) on a simulated clock, with configurable latency and failure
+distributions, and the completed jobs get fake outputs in the layout of the
+real workers when they are transferred from the spool. LifecycleHarness
+drives a whole study (submission, polling, gathering and resubmission) on
+such a cluster and measures the time spent in each phase of the
+orchestration.
+'''
+import os
+import json
+import gzip
+import math
+import time
+import random
+import logging
+import configparser
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from . import jobtracker
+from .submission import Cluster, StatusSnapshot
+
+# the parameters of the simulation, see SimulatedCluster
+DEFAULT_PROFILE = {
+    'queue_delay': 60.0,  # mean waiting time in the queue (s), exponential
+    'runtime': 600.0,  # median running time (s), lognormal
+    'runtime_sigma': 0.5,  # shape of the running time distribution
+    'hold_rate': 0.0,  # probability that a job is held when starting
+    'evict_rate': 0.0,  # probability that a run is evicted
+    'fail_rate': 0.0,  # probability that a completed job has no results
+    'submit_latency': 0.0,  # wall time of a submission (s)
+    'query_latency': 0.0,  # wall time of a status query (s)
+    'seed': None,
+}
+
+# the number of columns of the result files parsed by resultparser
+RESULT_COLUMNS = {
+    'fort.10': 60,
+    'oneturnresult': 21,
+    'aperture_losses.dat': 15,
+    'Coll_Scatter.dat': 7,
+    'initial_state.dat': 12,
+    'final_state.dat': 12,
+}
+
+EVENT_TEXT = {
+    0: 'Job submitted from host: <127.0.0.1:9618>',
+    1: 'Job executing on host: <127.0.0.1:9618>',
+    4: 'Job was evicted.',
+    5: 'Job terminated.',
+    9: 'Job was aborted.',
+    12: 'Job was held.',
+    13: 'Job was released.',
+}
+STATE_EVENTS = {jobtracker.IDLE: 0, jobtracker.RUNNING: 1,
+                jobtracker.COMPLETED: 5, jobtracker.REMOVED: 9,
+                jobtracker.HELD: 12}
+
+
+def fake_output(name, rng, lines=2):
+    '''Fake content of an output file, the result files have the number of
+    columns expected by resultparser'''
+    columns = RESULT_COLUMNS.get(name)
+    if columns is None:
+        return b'simulated %s\n' % name.encode()
+    rows = []
+    for _ in range(lines):
+        rows.append(' '.join('%.6e' % rng.random() for _ in range(columns)))
+    return ('\n'.join(rows) + '\n').encode()
+
+
+class SimulatedJob(object):
+    '''A simulated job, its future is drawn when it is (re)queued'''
+
+    def __init__(self, unique_id, batch, task, output_path, outputs):
+        self.unique_id = unique_id
+        self.batch = batch
+        self.task = task
+        self.output_path = output_path
+        self.outputs = outputs
+        # (time, event code), the states follow EVENT_STATES
+        self.events = []
+        self.failed = False
+        self.transferred = False
+
+    def state(self, now):
+        '''The state of the job at the given time'''
+        state = None
+        for when, code in self.events:
+            if when > now:
+                break
+            state = jobtracker.EVENT_STATES.get(code, state)
+        return state
+
+
+class SimulatedCluster(Cluster):
+    '''A HTCondor pool on a simulated clock.
+
+    The clock only moves with advance, so that a polling loop sees the jobs
+    progress without waiting. Every job waits in the queue, runs, and
+    completes unless it is held (it stays held until released) or evicted
+    (it goes back to the queue). The fake outputs are written to the output
+    folder of the job by download_from_spool, like condor_transfer_data.
+    '''
+
+    def __init__(self, temp_path=None, **profile):
+        '''Constructor.
+        profile: the parameters of the simulation, see DEFAULT_PROFILE
+        '''
+        super().__init__(temp_path)
+        unknown = set(profile) - set(DEFAULT_PROFILE)
+        if unknown:
+            content = "Unknown simulation parameters %s!" % ', '.join(unknown)
+            raise ValueError(content)
+        self.profile = dict(DEFAULT_PROFILE)
+        self.profile.update(profile)
+        self.check_profile(self.profile)
+        self.rng = random.Random(self.profile['seed'])
+        self.now = 0.0
+        self.epoch = datetime(2020, 1, 1)
+        self.jobs = OrderedDict()
+        self._prepared = {}
+        self._cluster_id = 0
+        # number of calls of the scheduler interface
+        self.calls = dict.fromkeys(['submit', 'query', 'transfer',
+                                    'remove'], 0)
+
+    @staticmethod
+    def check_profile(profile):
+        '''Check the parameters of the simulation: the rates are
+        probabilities below 1, otherwise a job would be evicted or held
+        forever, and the times aren't negative'''
+        for key in ['hold_rate', 'evict_rate', 'fail_rate']:
+            if not 0 <= profile[key] < 1:
+                content = "The %s must be in [0, 1), got %s!" % (
+                    key, profile[key])
+                raise ValueError(content)
+        for key in ['queue_delay', 'runtime', 'runtime_sigma',
+                    'submit_latency', 'query_latency']:
+            if profile[key] < 0:
+                content = "The %s can't be negative, got %s!" % (
+                    key, profile[key])
+                raise ValueError(content)
+
+    def prepare(self, task_ids, trans, exe, exe_args, input_path, output_path,
+                *args, **kwargs):
+        '''Prepare the job list and the output folders, see
+        HTCondor.prepare'''
+        job_list = os.path.join(input_path, 'job_id.list')
+        with open(job_list, 'w') as f_out:
+            for i in task_ids:
+                if isinstance(i, list):
+                    i = '-'.join(map(str, i))
+                f_out.write(str(i))
+                f_out.write('\n')
+                out_f = os.path.join(output_path, str(i))
+                if not os.path.exists(out_f):
+                    os.makedirs(out_f)
+        config = configparser.ConfigParser()
+        config.read(os.path.join(input_path, exe_args))
+        self._prepared[str(input_path)] = (output_path,
+                                           self._outputs(config))
+
+    @staticmethod
+    def _outputs(config):
+        '''The output files of a job, from its input.ini'''
+        if config.has_section('madx'):
+            madx = config['madx']
+            outputs = list(json.loads(madx['output_files']).values())
+            outputs += ['madx_in', 'madx_stdout']
+            if madx.getboolean('oneturn'):
+                outputs.append('oneturnresult')
+            if madx.getboolean('collimation'):
+                outputs.append('fort3.limi')
+            return outputs
+        if config.has_section('sixtrack'):
+            outputs = json.loads(config['sixtrack']['output_files'])
+            return list(outputs) + ['fort.3']
+        return []
+
+    def submit(self, input_path, job_name, limit=None, trials=5, *args,
+               **kwargs):
+        '''Queue the jobs of the job list.
+        Args:
+            input_path (string): The input path to hold the input files
+            job_name (string): The job name, the study path is its folder
+            limit (int): Not used, all the jobs are queued at once
+            trials (int): Not used
+            return(tuple): (status, out), out maps the tasks to their job id
+        '''
+        input_path = str(input_path)
+        joblist = os.path.join(input_path, 'job_id.list')
+        if not os.path.isfile(joblist) or input_path not in self._prepared:
+            content = "There isn't %s job for submission!" % job_name
+            self._logger.warning(content)
+            return False, None
+        with open(joblist, 'r') as f_in:
+            task_ids = f_in.read().split()
+        output_path, outputs = self._prepared.pop(input_path)
+        self._latency('submit_latency')
+        self.calls['submit'] += 1
+        self._cluster_id += 1
+        out = {}
+        for proc, task in enumerate(task_ids):
+            unique_id = '%d.%d' % (self._cluster_id, proc)
+            job = SimulatedJob(unique_id, job_name, task,
+                               os.path.join(output_path, task), outputs)
+            job.events.append((self.now, 0))
+            self._schedule(job, self.now)
+            self.jobs[unique_id] = job
+            out[task] = unique_id
+        self._snapshots.clear()
+        os.remove(joblist)
+        content = "Queued %d simulated jobs in cluster %d." % (
+            len(task_ids), self._cluster_id)
+        self._logger.info(content)
+        return True, out
+
+    def _schedule(self, job, start):
+        '''Draw the future of a job queued at the given time'''
+        prof = self.profile
+        when = start
+        while True:
+            when += self.rng.expovariate(1 / prof['queue_delay']) if \
+                prof['queue_delay'] > 0 else 0
+            if self.rng.random() < prof['hold_rate']:
+                job.events.append((when, 12))
+                return
+            job.events.append((when, 1))
+            runtime = prof['runtime'] * math.exp(
+                self.rng.gauss(0, prof['runtime_sigma']))
+            if self.rng.random() < prof['evict_rate']:
+                when += runtime * self.rng.random()
+                job.events.append((when, 4))
+                continue
+            job.events.append((when + runtime, 5))
+            job.failed = self.rng.random() < prof['fail_rate']
+            return
+
+    def _latency(self, key):
+        if self.profile[key] > 0:
+            time.sleep(self.profile[key])
+
+    def advance(self, seconds):
+        '''Move the simulated clock forward'''
+        self.now += seconds
+        self._snapshots.clear()
+
+    def drain(self):
+        '''Move the clock to the end of the last scheduled event, the held
+        jobs stay held.
+
+        Returns:
+            float: the simulated time.
+        '''
+        ends = [job.events[-1][0] for job in self.jobs.values()]
+        self.advance(max([0.0] + [i - self.now for i in ends]))
+        return self.now
+
+    def release(self, study_path, *args, **kwargs):
+        '''Release the held jobs of the study, like condor_release.
+
+        Returns:
+            int: the number of released jobs.
+        '''
+        released = 0
+        for job in self._study_jobs(study_path):
+            if job.state(self.now) == jobtracker.HELD:
+                job.events.append((self.now, 13))
+                self._schedule(job, self.now)
+                released += 1
+        self._snapshots.clear()
+        return released
+
+    def _study_jobs(self, study_path):
+        prefix = os.path.join(str(study_path), '')
+        return [job for job in self.jobs.values()
+                if job.batch.startswith(prefix)]
+
+    def _snapshot(self, study_path, unique_ids=None):
+        '''The states of the jobs of the study in the queue'''
+        self._latency('query_latency')
+        self.calls['query'] += 1
+        jobs = dict((job.unique_id, (job.state(self.now), job.batch,
+                                     job.task))
+                    for job in self._study_jobs(study_path))
+        return StatusSnapshot(jobs)
+
+    def check_running(self, studypath, unique_ids=None):
+        '''Check the unfinished jobs
+        Args:
+            studypath (string): The absolute path of the study
+            return(list): The unique id (cluster.index) list
+        '''
+        return self.status_snapshot(studypath, unique_ids).unfinished()
+
+    def download_from_spool(self, study_path, *args, **kwargs):
+        '''Write the outputs of the completed jobs, like
+        condor_transfer_data'''
+        self.calls['transfer'] += 1
+        for job in self._study_jobs(study_path):
+            if job.transferred or job.state(self.now) != jobtracker.COMPLETED:
+                continue
+            self._write_outputs(job)
+            job.transferred = True
+        return True
+
+    def _write_outputs(self, job):
+        '''The outputs of a job, as written by the workers and HTCondor'''
+        os.makedirs(job.output_path, exist_ok=True)
+        name = os.path.join(job.output_path, 'htcondor.%s' % job.unique_id)
+        with open(name + '.out', 'w') as f_out:
+            f_out.write('simulated job %s\n' % job.unique_id)
+        open(name + '.err', 'w').close()
+        self._write_log(job, name + '.log')
+        if job.failed or job.state(self.now) != jobtracker.COMPLETED:
+            return
+        for task in job.task.split('-'):
+            dest = os.path.join(job.output_path, 'results', task)
+            os.makedirs(dest, exist_ok=True)
+            for out in job.outputs:
+                with gzip.open(os.path.join(dest, out + '.gz'), 'wb') as f_out:
+                    f_out.write(fake_output(out, self.rng))
+
+    def _write_log(self, job, log):
+        '''The event log of the job, in the format read by jobtracker'''
+        cluster, proc = job.unique_id.split('.')
+        with open(log, 'w') as f_out:
+            for when, code in job.events:
+                if when > self.now:
+                    break
+                stamp = self.epoch + timedelta(seconds=when)
+                f_out.write('%03d (%s.%03d.000) %s %s\n' % (
+                    code, cluster, int(proc),
+                    stamp.strftime('%Y-%m-%d %H:%M:%S'), EVENT_TEXT[code]))
+                if code == 5:
+                    f_out.write('\t(1) Normal termination (return value '
+                                '%d)\n' % int(job.failed))
+                f_out.write('...\n')
+
+    def remove(self, study_path, status, *args, **kwargs):
+        '''Remove the jobs with the given status from the queue, the
+        completed jobs only once they are transferred'''
+        if status not in [0, 1, 2, 3, 4, 5, 6]:
+            self._logger.error("Unknown job status %s!" % status)
+            return False
+        self.calls['remove'] += 1
+        for job in self._study_jobs(study_path):
+            state = job.state(self.now)
+            if state != status:
+                continue
+            if state == jobtracker.COMPLETED and not job.transferred:
+                continue
+            if state != jobtracker.COMPLETED:
+                job.events = [i for i in job.events if i[0] <= self.now]
+                job.events.append((self.now, STATE_EVENTS[jobtracker.REMOVED]))
+                self._write_outputs(job)
+            self.jobs.pop(job.unique_id)
+        self._snapshots.clear()
+        return True
+
+
+class LifecycleHarness(object):
+    '''Drive the lifecycle of a study on a SimulatedCluster and measure the
+    wall time of each phase of the orchestration'''
+
+    def __init__(self, study, cluster=None, step=60.0, max_rounds=3,
+                 release_held=True):
+        '''Constructor.
+        study (Study): a customized study, its cluster is replaced by the
+        simulated one
+        cluster (SimulatedCluster): the simulated pool, a default one if None
+        step (float): simulated seconds between two polls of the jobs
+        max_rounds (int): number of submissions of the failed jobs, the
+        first one included
+        release_held (bool): release the held jobs once only held jobs are
+        left (at most max_rounds times), otherwise they are removed
+        '''
+        self._logger = logging.getLogger(__name__)
+        self.study = study
+        if cluster is None:
+            cluster = SimulatedCluster()
+        self.cluster = cluster
+        study.submission = cluster
+        self.step = step
+        self.max_rounds = max_rounds
+        self.release_held = release_held
+        # phase -> [wall time, calls]
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        '''Accumulate the wall time of a phase'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.phases.setdefault(name, [0.0, 0])
+            record[0] += time.perf_counter() - start
+            record[1] += 1
+
+    def run(self, stages=(0, 1)):
+        '''Run the lifecycle of the study.
+
+        Args:
+            stages (tuple): the job types to run, 0 for preprocess and 1 for
+            sixtrack.
+
+        Returns:
+            dict: the report, see report.
+        '''
+        with self.phase('update_db'):
+            self.study.update_db()
+        for typ in stages:
+            self.run_stage(typ)
+        return self.report()
+
+    def run_stage(self, typ):
+        '''Submit, poll, gather and resubmit the jobs of a type'''
+        if typ == 0:
+            name, table = 'preprocess', 'preprocess_wu'
+            prepare = self.study.prepare_preprocess_input
+        else:
+            name, table = 'sixtrack', 'sixtrack_wu'
+            prepare = self.study.prepare_sixtrack_input
+        study_path = self.study.study_path
+        resubmit = [False]
+        for i in range(self.max_rounds):
+            for flag in resubmit:
+                with self.phase(f'prepare_{name}'):
+                    prepare(resubmit=flag)
+                with self.phase(f'submit_{name}'):
+                    self.study.submit(typ)
+            releases = 0
+            while True:
+                with self.phase(f'poll_{name}'):
+                    running = self.cluster.check_running(study_path)
+                    snapshot = self.cluster.status_snapshot(study_path)
+                    held = [i for i in running
+                            if snapshot.state(i) == jobtracker.HELD]
+                if not running:
+                    break
+                if len(running) == len(held):
+                    # only held jobs are left
+                    with self.phase(f'held_{name}'):
+                        if self.release_held and releases < self.max_rounds:
+                            self.cluster.release(study_path)
+                            releases += 1
+                        else:
+                            self.cluster.remove(study_path, jobtracker.HELD)
+                    continue
+                self.cluster.advance(self.step)
+            with self.phase(f'collect_{name}'):
+                self.study.collect_result(typ)
+            # the failed jobs are incomplete, the jobs without any output
+            # are still submitted
+            rows = self.study.db.select(table, ['status'],
+                                        "status!='complete'")
+            left = [i[0] for i in rows]
+            resubmit = [flag for flag, status in
+                        [(True, 'submitted'), (False, 'incomplete')]
+                        if status in left]
+            if not left:
+                break
+            content = "%d %s jobs failed in round %d." % (len(left), name,
+                                                          i + 1)
+            self._logger.info(content)
+
+    def report(self):
+        '''The measurements of the lifecycle.
+
+        Returns:
+            dict: 'phases' maps each phase to its wall time and number of
+            calls, 'simulated' is the simulated time, 'calls' the calls of
+            the scheduler interface and 'jobs' the final job states.
+        '''
+        jobs = {}
+        for table in ['preprocess_wu', 'sixtrack_wu']:
+            rows = self.study.db.select(table, ['status'])
+            counts = {}
+            for (status,) in rows:
+                counts[status] = counts.get(status, 0) + 1
+            jobs[table] = counts
+        phases = OrderedDict((name, {'wall': wall, 'calls': calls})
+                             for name, (wall, calls) in self.phases.items())
+        return {'phases': phases, 'simulated': self.cluster.now,
+                'calls': dict(self.cluster.calls), 'jobs': jobs}
+
+    def summary(self):
+        '''The report as text'''
+        report = self.report()
+        lines = ['%-28s %10s %7s' % ('phase', 'wall (s)', 'calls')]
+        for name, vals in report['phases'].items():
+            lines.append('%-28s %10.3f %7d' % (name, vals['wall'],
+                                                vals['calls']))
+        lines.append('simulated time: %.0f s' % report['simulated'])
+        for table, counts in report['jobs'].items():
+            lines.append('%s: %s' % (table, ', '.join(
+                '%s=%d' % i for i in sorted(counts.items()))))
+        return '\n'.join(lines)
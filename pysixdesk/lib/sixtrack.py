@@ -4,21 +4,28 @@ import re
 import time
 import json
 import shutil
+import logging
 import zipfile
 import argparse
 import configparser
 
 from pathlib import Path
 from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 from pysixdesk.lib.pysixdb import SixDB
 from pysixdesk.lib import utils
+from pysixdesk.lib import runner
+from pysixdesk.lib import fort3
+from pysixdesk.lib.workdir import WorkDir
+from pysixdesk.lib.cache import NodeCache, alias_key, default_root
 from pysixdesk.lib.dbtable import Table
 from pysixdesk.lib.resultparser import parse_results
 
 
 class TrackingJob:
-    def __init__(self, task_id, input_info, group_name, logger):
+    def __init__(self, task_id, input_info, group_name, logger,
+                 cache_dir=None):
         '''Class to handle the execution of the tracking job.
 
         Args:
@@ -26,6 +33,11 @@ class TrackingJob:
             input_info (str/path): Path to the database configuration file.
             group_name (str): The group name when submitting multi-jobs to one node
             logger: The logger
+            cache_dir (str/path, optional): if provided, the templates and
+            the preprocess outputs are decompressed once in this node cache
+            folder, and hardlinked in the current folder, to be shared by
+            the tasks running on the node. SixTrack is run from its copy in
+            the cache.
 
         Raises:
             FileNotFoundError: If required input file is not found in database.
@@ -34,7 +46,12 @@ class TrackingJob:
         self._logger = logger
         self._dest_path = Path('results', str(task_id))
         self._dest_path.mkdir(parents=True, exist_ok=True)
+        # progress of the tracking, see runner.ProcessRunner
+        self._heartbeat = self._dest_path.absolute() / 'heartbeat.json'
+        # the progress at which the tracking was stopped early
+        self.lost = None
         self.group_name = group_name
+        self.cache = None if cache_dir is None else NodeCache(cache_dir)
 
         self.task_id = task_id
         # read database config
@@ -129,15 +146,49 @@ class TrackingJob:
             FileNotFoundError: If buffer is not found in db.
         """
         templates = self.cf['templates']
-        temp_buf = self.db.select('templates', templates.keys())[0]
-        if not temp_buf:
-            raise FileNotFoundError('Templates not found in DB.')
-        else:
+
+        def fetch():
+            temp_buf = self.db.select('templates', templates.keys())[0]
+            if not temp_buf:
+                raise FileNotFoundError('Templates not found in DB.')
             for temp, temp_name in zip(temp_buf, templates.values()):
                 if not temp:
                     raise FileNotFoundError(f'{temp_name} not found in DB.')
-                else:
-                    utils.decompress_buf(temp, temp_name)
+            return temp_buf
+        self._decomp_shared(list(templates.values()), fetch)
+
+    def _decomp_shared(self, names, fetch, alias=None):
+        '''Decompresses buffers into files in the current folder. With the
+        node cache, they are decompressed only once per node and hardlinked.
+
+        Args:
+            names (list): the file names.
+            fetch (callable): returns the buffers of the files.
+            alias (str, optional): identifies the buffers without fetching
+            them.
+        '''
+        if self.cache is None:
+            for name, buf in zip(names, fetch()):
+                utils.decompress_buf(buf, name)
+            return
+        self.cache.get(names, fetch, alias=alias)
+
+    @contextmanager
+    def _executable(self, exe):
+        '''The executable to run, its copy in the node cache if any, kept
+        while in the context.
+
+        Args:
+            exe (str): the path of the executable.
+
+        Yields:
+            str: the path to run.
+        '''
+        if self.cache is None:
+            yield exe
+            return
+        with self.cache.executable(exe) as local:
+            yield local
 
     def _decomp_files(self):
         '''This decompresses the buffers in the database into files.
@@ -152,13 +203,26 @@ class TrackingJob:
         input_files = json.loads(inp)
         inputs = list(input_files.values())
 
-        input_buf = self.db.select('preprocess_task',
-                                   inputs,
-                                   f'task_id={self.pre_task_id}')
-        if not input_buf:
-            raise FileNotFoundError("The required files were not found!")
-
-        input_buf = list(input_buf[0])
+        def fetch():
+            input_buf = self.db.select('preprocess_task',
+                                       inputs,
+                                       f'task_id={self.pre_task_id}')
+            if not input_buf:
+                raise FileNotFoundError("The required files were not found!")
+            return list(input_buf[0])
+        # the mtime of the preprocess task changes with its outputs
+        mtime = self.db.select('preprocess_task', ['mtime'],
+                               f'task_id={self.pre_task_id}')
+        alias = None
+        if mtime and mtime[0][0]:
+            # the task ids and the name of the sub.db are the same in all
+            # the studies, the study path tells them apart
+            db_info = self.cf['db_info']
+            alias = alias_key(self.six_cfg.get('study_path', ''),
+                              db_info.get('host', ''),
+                              db_info.get('db_name', ''), self.pre_task_id,
+                              mtime[0][0], *inputs)
+        self._decomp_shared(inputs, fetch, alias)
 
         cr_inputs = []
         if self.first_turn is not None:
@@ -172,56 +236,45 @@ class TrackingJob:
             if (not cr_input_buf) or (cr_input_buf[0][0] is None):
                 raise FileNotFoundError("checkpoint files were not found!")
 
-            inputs += cr_inputs
-            input_buf += cr_input_buf[0]
-
-        for infile in inputs:
-            i = inputs.index(infile)
-            buf = input_buf[i]
-
-            utils.decompress_buf(buf, infile, des='file')
+            for infile, buf in zip(cr_inputs, cr_input_buf[0]):
+                utils.decompress_buf(buf, infile, des='file')
 
         return cr_inputs
 
     @contextmanager
     def sixtrack_temp_folder(self, folder='temp', symlink_parent=True,
                              extra=[]):
-        """Helper context manager to deal with the temp folder and symlinking
-        the input files. On release, moves back to the orignal folder and
-        deletes the temp folder.
+        """Helper context manager to deal with the temp folder and staging
+        the input files, see workdir.WorkDir. On release, moves back to the
+        orignal folder and deletes the temp folder.
 
         Args:
             folder (str, optional): name of temp folder.
-            symlink_parent (bool, optional): controls whether to symlink input
+            symlink_parent (bool, optional): controls whether to stage input
             files and extra files from the parent dir to the temporary folder.
-            extra (list, optional): list of extra files to symlink.
+            extra (list, optional): list of extra files to stage.
+
+        Yields:
+            WorkDir: the temp folder, the outputs are moved back to the
+            parent folder with its move_out.
 
         Raises:
-            FileNotFoundError: if input file not found during symlinking.
+            FileNotFoundError: if input file not found during staging.
         """
-        # quick context manager to handle the temporary folder
         cwd = Path.cwd()
-        temp_folder = Path(folder)
-        if temp_folder.is_dir():
-            shutil.rmtree(temp_folder, ignore_errors=True)
-        temp_folder.mkdir()
-        try:
-            os.chdir(temp_folder)
-            # symlink input files to temp folder.
-            if symlink_parent:
-                input_files = json.loads(self.six_cfg["input_files"])
-                # make symlinks to the other input files in the parent folder
-                for file in [Path(f) for f in list(input_files.values()) + extra]:
-                    target = Path.cwd().parent / file
-                    if target.is_file():
-                        file.symlink_to(target)
-                    else:
-                        msg = f"The required input file {file} was not found!"
-                        raise FileNotFoundError(msg)
-            yield
-        finally:
-            os.chdir(cwd)
-            shutil.rmtree(temp_folder, ignore_errors=True)
+        inputs = []
+        if symlink_parent:
+            input_files = json.loads(self.six_cfg["input_files"])
+            inputs = list(input_files.values()) + extra
+        size = self.six_cfg.get('work_dir_size')
+        size = None if size in [None, 'None'] else float(size)
+        with WorkDir(folder, inputs, self.six_cfg.get('work_dir', 'scratch'),
+                     size, cwd, self._logger) as work:
+            try:
+                os.chdir(work.path)
+                yield work
+            finally:
+                os.chdir(cwd)
 
     def sixtrack_prep_cfg(self, **kwargs):
         """Prepares sixtrack's fort.3 config, by adding the length of the
@@ -235,13 +288,8 @@ class TrackingJob:
         """
         # make a dict copy of fort_cfg
         fort_dic = dict(self.fort_cfg.items())
-        # reads the length from fort.3.aux
-        with open('fort.3.aux', 'r') as fc3aux:
-            fc3aux_lines = fc3aux.readlines()
-        fc3aux_2 = fc3aux_lines[1]
-        c = fc3aux_2.split()
-        lhc_length = c[4]
-        fort_dic['length'] = lhc_length
+        # the length from fort.3.aux
+        fort_dic['length'] = fort3.aux_length('fort.3.aux')
         # adds additional kwargs to fort_dic
         fort_dic.update(kwargs)
         return fort_dic
@@ -258,32 +306,15 @@ class TrackingJob:
             output_file (str, optional): name of the prepared fort.3 file.
 
         """
-        # get the fort file patterns and values
-        if source_prefix is not None:
-            source_prefix = Path(source_prefix)
+        prefix = Path(source_prefix or '.')
         # touch fort.6
         open('fort.6', 'a').close()
 
-        fort_file = Path(self.six_cfg["fort_file"])
-        patterns = ['%' + a for a in fort_cfg.keys()]
-        values = list(fort_cfg.values())
-        dest = fort_file.with_suffix('.temp')
-
-        source = fort_file
-        if source_prefix is not None:
-            source = source_prefix / source
-
-        utils.replace(patterns, values, source, dest)
-
-        # prepare the other input files
         input_files = json.loads(self.six_cfg["input_files"])
-
-        madx_fc3 = input_files['fc.3']
-        if source_prefix is not None:
-            madx_fc3 = source_prefix / madx_fc3
-
-        # concatenate
-        utils.concatenate_files([dest, madx_fc3], output_file)
+        # the parsed files are kept for the next tasks of the process
+        builder = fort3.load(prefix / self.six_cfg["fort_file"],
+                             prefix / input_files['fc.3'])
+        builder.build(fort_cfg).write(output_file)
 
     def sixtrack_run(self, output_file):
         """Runs sixtrack.
@@ -291,20 +322,27 @@ class TrackingJob:
         Args:
             output_file (str): file in which to write sixtrack's stdout.
         """
-        # actually run
-        six_output = os.popen(self.six_cfg["sixtrack_exe"])
+        stop = None
+        threshold = self.six_cfg.get('stop_survival')
+        if threshold and threshold != 'None' and not self.boinc:
+            # stop when the particles are lost, not for the boinc test run
+            stop = runner.survival_stop(float(threshold))
         self._logger.info('Sixtrack is running...')
-        # write stdout to file
-        outputlines = six_output.readlines()
+        # stream stdout to file
+        with self._executable(self.six_cfg["sixtrack_exe"]) as exe:
+            result = runner.run_sixtrack(exe, output_file, self._heartbeat,
+                                         stop)
         self._logger.info('Sixtrack is done!')
-
-        if outputlines:
-            with open(output_file, 'w') as six_out:
-                six_out.writelines(outputlines)
-        elif output_file != 'fort.6':
-            # For some sixtrack version, the stdout will be automatically
-            # written to fort.6
-            shutil.copy2('fort.6', output_file)
+        if result.stopped:
+            self.lost = dict(result.progress, reason=result.stopped)
+            with open(self._heartbeat.with_name('early_stop.json'),
+                      'w') as f_out:
+                json.dump(self.lost, f_out)
+            content = "Sixtrack was stopped early, %s!" % result.stopped
+            self._logger.info(content)
+        elif result.returncode != 0:
+            content = "Sixtrack exited with %d!" % result.returncode
+            self._logger.warning(content)
 
     def dl_output(self):
         """Downloads the output of the job.
@@ -318,6 +356,9 @@ class TrackingJob:
         for cr_f in self.cr_files:
             if Path(cr_f).exists():
                 down_list.append(cr_f)
+        if self.lost is not None:
+            # the outputs of a stopped tracking may be missing
+            down_list = [i for i in down_list if Path(i).is_file()]
 
         if self.db_type == 'mysql':
             down_list.extend(['_condor_stdout', '_condor_stderr'])
@@ -341,8 +382,12 @@ class TrackingJob:
         for sec in self.cf:
             result_cf[sec] = dict(self.cf[sec])
         filelist = Table.result_table(self.six_out)
+        codec = None
+        if 'codecs' in self.cf:
+            codec = self.cf['codecs'].get('sixtrack_task')
         parse_results('sixtrack', self.task_id, self._dest_path, filelist,
-                      task_table, result_cf)
+                      task_table, result_cf, codec)
+        lost_turn = task_table.pop('lost_turn', None)
 
         self.db.update('sixtrack_task', task_table,
                        f'task_id={self.task_id}')
@@ -352,9 +397,11 @@ class TrackingJob:
             self.db.insertm(sec, val)
 
         job_table = {}
-        if task_table['status'] == 'Success':
+        if task_table['status'] in ['Success', 'Lost']:
             job_table['status'] = 'complete'
             job_table['mtime'] = int(time.time() * 1E7)
+            if lost_turn is not None:
+                job_table['lost_turn'] = lost_turn
             content = f" sixtrack task {self.task_id} has completed normally!"
             self._logger.info(content)
         else:
@@ -393,15 +440,10 @@ class TrackingJob:
         try:
             track_lines = filter(lambda x: re.search(r'TRACKING>', x), lines)
             last_line = list(track_lines)[-1]
-            info = re.split(r':|,', last_line)
-            turn_info = info[1].split()
-            part_info = info[-1].split()
-            total_turn = float(turn_info[-1])
-            track_turn = float(turn_info[1])
-            total_part = float(part_info[-1])
-            surv_part = float(part_info[0])
-            surv_ratio = surv_part / total_part
-            return track_turn >= total_turn and surv_ratio >= self.surv_percent
+            info = runner.parse_tracking(last_line)
+            surv_ratio = info['particles'] / info['total_particles']
+            return (info['turn'] >= info['turns'] and
+                    surv_ratio >= self.surv_percent)
 
         except Exception as e:
             self._logger.error(e)
@@ -472,11 +514,12 @@ class TrackingJob:
 
         # create and enter temp folder
         with self.sixtrack_temp_folder(symlink_parent=True,
-                                       extra=add_inputs + self.cr_inputs):
+                                       extra=add_inputs + self.cr_inputs
+                                       ) as work:
             self._logger.info("Preparing the sixtrack input files!")
             # replace placeholders and concatenate
             self.sixtrack_prep_job(fort_dic,
-                                   source_prefix=Path.cwd().parent,
+                                   source_prefix=work.parent,
                                    output_file='fort.3')
             # run sixtrack
             self.sixtrack_run('fort.6')
@@ -484,19 +527,14 @@ class TrackingJob:
 
             # check and move output files
             if utils.check(self.six_out):
-                for out in self.six_out:
-                    shutil.copy2(out, Path.cwd().parent / out)
+                work.move_out(self.six_out)
 
-            # move checkpoint files out of temp folder, if files are not
-            # symlinks
-            for cr_f in self.cr_files:
-                cr_f = Path(cr_f)
-                cr_f_parent = Path.cwd().parent / cr_f
-                if cr_f.exists() and not cr_f_parent.exists():
-                    shutil.copy2(cr_f, cr_f_parent)
+            # move checkpoint files out of temp folder, the ones written in
+            # place through a hardlink are already there
+            work.move_out(self.cr_files)
 
             if not self.boinc:
-                shutil.copy2(Path('fort.3'), Path.cwd().parent / 'fort.3')
+                work.move_out(['fort.3'])
         # leave and delete temp folder
 
         if self.boinc:
@@ -512,30 +550,99 @@ class TrackingJob:
             self.boinc_submit(job_name)
 
 
-if __name__ == '__main__':
+def run_task(task_id, input_info, group_name, cache_dir=None,
+             work_dir=None):
+    '''Runs a task of the group. With a work_dir, the task runs in its own
+    folder, where the files of the current folder are symlinked, and its
+    results are moved back to the results folder of the current folder.
+
+    Returns:
+        bool: True if the task ran without exception.
+    '''
+    logger = logging.getLogger('sixtrack')
+    if not logger.handlers:
+        logger = utils.condor_logger('sixtrack')
+    top = Path.cwd()
+    if work_dir is not None:
+        work_dir = Path(work_dir).absolute()
+        work_dir.mkdir(parents=True, exist_ok=True)
+        for item in top.iterdir():
+            if item.is_file():
+                (work_dir / item.name).symlink_to(item)
+        input_info = Path(input_info).absolute()
+        os.chdir(work_dir)
+    job = None
+    try:
+        job = TrackingJob(task_id, input_info, group_name, logger, cache_dir)
+        job.run()
+        return True
+    except Exception:
+        logger.error(f'Sixtrack task {task_id} failed!', exc_info=True)
+        if job is not None and job.db_type == 'mysql':
+            job.db.open()
+            job_table = {}
+            job_table['status'] = 'incomplete'
+            job_table['mtime'] = int(time.time() * 1E7)
+            job.db.update('sixtrack_wu', job_table,
+                          where=f'task_id={job.task_id}')
+        return False
+    finally:
+        if job is not None and job.db_type == 'mysql':
+            job.db.remove('sixtrack_wu_tmp', where=f'task_id={job.task_id}')
+        if work_dir is not None:
+            os.chdir(top)
+            results = work_dir / 'results' / str(task_id)
+            if results.is_dir():
+                dest = top / 'results' / str(task_id)
+                shutil.rmtree(dest, ignore_errors=True)
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(results), str(dest))
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('task_id', type=str,
                         help='Current work unit ID')
     parser.add_argument('input_info', type=str,
                         help='Path to the db config file.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of tasks of the group run concurrently, '
+                        'the cpus of the slot by default.')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Node cache of the decompressed inputs, '
+                        'PYSIXDESK_CACHE or a folder in /tmp by default.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Decompress the inputs of every task.')
     args = parser.parse_args()
     group_name = args.task_id
     task_ids = group_name.split('-')
-    LOGGER = utils.condor_logger('sixtrack')
-    for task_id in task_ids:
-        job = TrackingJob(task_id, args.input_info, group_name, LOGGER)
-        try:
-            job.run()
-        except Exception as e:
-            if job.db_type == 'mysql':
-                job.db.open()
-                job_table = {}
-                where = "task_id"
-                job_table['status'] = 'incomplete'
-                job_table['mtime'] = int(time.time() * 1E7)
-                job.db.update('sixtrack_wu', job_table,
-                              where=f'task_id={job.task_id}')
-            raise e
-        finally:
-            if job.db_type == 'mysql':
-                job.db.remove('sixtrack_wu_tmp', where=f'task_id={job.task_id}')
+    utils.condor_logger('sixtrack')
+    workers = min(args.workers or utils.slot_cpus(), len(task_ids))
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or default_root()
+    job_cache = None
+    if cache_dir is None and workers > 1:
+        # share the inputs between the tasks of the job at least
+        job_cache = cache_dir = Path('cache').absolute()
+    if workers <= 1:
+        status = [run_task(task_id, args.input_info, group_name, cache_dir)
+                  for task_id in task_ids]
+    else:
+        # each task in its own folder
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_task, task_id, args.input_info,
+                                   group_name, cache_dir,
+                                   Path(f'task_{task_id}').absolute())
+                       for task_id in task_ids]
+            status = [future.result() for future in futures]
+    if job_cache is not None:
+        shutil.rmtree(job_cache, ignore_errors=True)
+    if not all(status):
+        failed = [i for i, ok in zip(task_ids, status) if not ok]
+        raise Exception(f"The sixtrack tasks {failed} failed!")
+
+
+if __name__ == '__main__':
+    main()
@@ -10,9 +10,16 @@ import configparser
 from collections import OrderedDict
 from collections.abc import Iterable
 
+from . import memo
 from . import utils
 from . import gather
+from . import packing
+from . import segments
+from . import resources
 from . import constants
+from . import compression
+from . import retention
+from . import template
 from . import submission
 from .pysixdb import SixDB
 from .dbtable import Table
@@ -75,6 +82,17 @@ class Study(object):
         self.checkpoint_restart = False
         self.first_turn = 1  # first turn
         self.last_turn = 100  # last turn
+        # with checkpoint_restart, the next segment of segment_turns turns
+        # is queued as soon as a segment is complete, up to final_turn
+        self.segment_turns = None
+        self.final_turn = None
+        # prepare and submit the queued segments when the results are
+        # collected, otherwise they wait for prepare_sixtrack_input and
+        # submit
+        self.auto_submit_segments = True
+        # stop the tracking when the ratio of surviving particles drops
+        # below this value (0 for all particles lost), None to disable
+        self.stop_survival = None
         self.cluster_class = submission.HTCondor
         self.max_jobsubmit = 15000
 
@@ -128,13 +146,50 @@ class Study(object):
         self.sixtrack_output = ['fort.10']
 
         self.db_info['db_type'] = 'sql'
-        self.db_settings = {
-            # 'synchronous': 'off',
-            'foreign_keys': 'on',
-            'journal_mode': 'memory',
-            'auto_vacuum': 'full',
-            'temp_store': 'memory',
-            'count_changes': 'off'}
+        # the sqlite settings, either a dict of pragmas or the name of a
+        # profile of dbadaptor.SQLDatabaseAdaptor. The default 'rollback'
+        # keeps the journal on disk, which is safe on AFS/EOS, an existing
+        # study database switches to incremental auto_vacuum when opened (a
+        # database created without auto_vacuum is vacuumed once). The WAL profiles 'interactive' and 'durable' are
+        # faster but need the study to be on a local file system, its shared
+        # memory index isn't safe otherwise
+        self.db_settings = 'rollback'
+        # applied on top of db_settings during the heavy write phases
+        self.db_bulk_settings = 'bulk-load'
+        # the settings of the databases transferred with the jobs
+        self.sub_db_settings = 'portable'
+        # sharded layout of the result and blob tables, e.g. {'size': 10000}
+        # to store them in a separate sqlite file per 10000 tasks, see
+        # pysixdb.SixDB.shard. None keeps a single file
+        self.db_shard = None
+        # the folder of the blobs archived by compact
+        self.archive_path = os.path.join(self.study_path, 'archive')
+        # compression codec of the stored blobs per table, e.g. 'zstd:3' or
+        # 'lz4', see compression.parse_spec. None keeps the legacy gzip format
+        self.codec_policy = OrderedDict([
+            ('templates', None),
+            ('preprocess_task', None),
+            ('sixtrack_task', None)])
+        # target running time (s) of the sixtrack jobs, the tasks are packed
+        # into jobs of about this duration, see packing.py. None submits a
+        # job per task (or per group with groupby)
+        self.job_walltime = None
+        # choose the JobFlavour and the memory and cpu requests of the jobs
+        # from the measured usage of the previous tasks, see resources.py
+        self.auto_resources = True
+        # reuse the results of the preprocess jobs with the same inputs
+        # (rendered mask, templates, executables and settings) instead of
+        # running them again, see memo.py
+        self.memoize_madx = True
+        # folder of the preprocess results shared between studies, None to
+        # only reuse the results of this study
+        self.madx_cache = None
+        # where the sixtrack runs take place: 'scratch' (the node-local
+        # scratch), 'shm' (/dev/shm, bounded by the slot memory), 'auto' or
+        # 'cwd' (the job folder), and the space they need (MB), estimated
+        # from the inputs if None, see workdir.py
+        self.work_dir = 'scratch'
+        self.work_dir_size = None
 
         self.boinc_vars['workunitName'] = 'pysixdesk'
         self.boinc_vars['fpopsEstimate'] = 30 * 2 * 10e5 / 2 * 10e6 * 6
@@ -248,19 +303,34 @@ class Study(object):
         table.customize_tables('env', self.env)
         table.customize_tables('env', list(self.paths.keys()), 'text')
         table.customize_tables('preprocess_wu', self.madx_params)
+        # the digest of the inputs of the preprocess job, see memo.py
+        table.customize_tables('preprocess_wu', ['madx_key'], 'text')
         table.customize_tables('preprocess_task',
                                list(self.preprocess_output.values()),
                                'MEDIUMBLOB')
         table.customize_tables('sixtrack_wu', self.sixtrack_params)
+        table.customize_vector_columns('sixtrack_wu', self.sixtrack_params)
+        # the turn at which the tracking was stopped, see stop_survival
+        table.customize_tables('sixtrack_wu', ['lost_turn'], 'int')
         table.customize_tables('sixtrack_task', list(self.sixtrack_output),
                                'MEDIUMBLOB')
+        for table_name in ['preprocess_task', 'sixtrack_task']:
+            table.customize_tables(table_name, resources.USAGE_COLUMNS,
+                                   'float')
         table.customize_tables('boinc_vars', self.boinc_vars)
 
         # Initialize the database
-        self.db = SixDB(self.db_info, settings=self.db_settings, create=True)
+        shard = self.db_shard if self.db_info['db_type'] == 'sql' else None
+        self.db = SixDB(self.db_info, settings=self.db_settings, create=True,
+                        shard=shard)
         # create the database tables if not exist
         if not self.db.fetch_tables():
             self.db.create_tables(self.tables, self.table_keys)
+        else:
+            self._add_vector_columns()
+            self._add_usage_columns()
+            self._add_columns('sixtrack_wu', ['lost_turn'])
+            self._add_columns('preprocess_wu', ['madx_key'])
 
         # Initialize the submission object
         try:
@@ -282,6 +352,9 @@ class Study(object):
         madx_sec['collimation'] = json.dumps(self.collimation)
         madx_sec['output_files'] = json.dumps(self.madx_output)
         templates['mask_file'] = self.madx_input["mask_file"]
+        codecs = self._codec_section()
+        if codecs:
+            self.preprocess_config['codecs'] = codecs
         if self.oneturn:
             six_sec = {}
             self.preprocess_config['sixtrack'] = six_sec
@@ -294,6 +367,8 @@ class Study(object):
             templates['fort_file'] = inp
             inp = self.oneturn_sixtrack_input['input']
             six_sec['input_files'] = json.dumps(inp)
+            six_sec['work_dir'] = self.work_dir
+            six_sec['work_dir_size'] = str(self.work_dir_size)
         if self.collimation:
             cus_sec = {}
             self.preprocess_config['collimation'] = cus_sec
@@ -322,13 +397,155 @@ class Study(object):
         inp = self.sixtrack_output
         six_sec['output_files'] = json.dumps(inp)
         six_sec['test_turn'] = str(self.env['test_turn'])
+        six_sec['stop_survival'] = str(self.stop_survival)
+        six_sec['work_dir'] = self.work_dir
+        six_sec['work_dir_size'] = str(self.work_dir_size)
+        # identifies the study in the node cache, the sub.db of the studies
+        # share their name and task ids
+        six_sec['study_path'] = os.path.abspath(self.study_path)
         self.sixtrack_config['six_results'] = self.tables['six_results']
+        if codecs:
+            self.sixtrack_config['codecs'] = codecs
         if self.collimation:
             self.sixtrack_config['aperture_losses'] = self.tables['aperture_losses']
             self.sixtrack_config['collimation_losses'] = self.tables['collimation_losses']
             self.sixtrack_config['init_state'] = self.tables['init_state']
             self.sixtrack_config['final_state'] = self.tables['final_state']
 
+    def _add_vector_columns(self):
+        '''Add the numeric columns of the vector parameters to a database
+        created before they existed, and fill them from the parameter
+        columns'''
+        existing = self.db.fetch_columns('sixtrack_wu')
+        vectors = Table.vector_params(self.sixtrack_params)
+        for key, size in vectors.items():
+            cols = Table.vector_columns(key, size)
+            missing = [i for i in cols if i not in existing]
+            if not missing:
+                continue
+            for col in missing:
+                self.db.add_column('sixtrack_wu', col,
+                                   self.tables['sixtrack_wu'][col])
+            rows = self.db.select('sixtrack_wu', [key], DISTINCT=True)
+            for (value,) in rows:
+                if value is None:
+                    continue
+                comps = dict(zip(cols, Table.split_vector(value, size)))
+                where = f'{key}={Table.sql_literal(value)}'
+                self.db.update('sixtrack_wu', comps, where)
+            content = "Added the columns %s to sixtrack_wu." % ', '.join(
+                missing)
+            self._logger.info(content)
+        for col in self.table_keys['sixtrack_wu'].get('index', []):
+            self.db.create_index('sixtrack_wu', [col])
+
+    def _add_usage_columns(self):
+        '''Add the usage columns to the task tables of a database created
+        before they existed'''
+        for table_name in ['preprocess_task', 'sixtrack_task']:
+            self._add_columns(table_name, resources.USAGE_COLUMNS)
+
+    def _add_columns(self, table_name, columns):
+        '''Add the given columns of the table schema to a database created
+        before they existed'''
+        existing = self.db.fetch_columns(table_name)
+        for col in columns:
+            if col not in existing:
+                self.db.add_column(table_name, col,
+                                   self.tables[table_name][col])
+
+    def _resource_model(self, table_name):
+        '''The resource model fitted on the measured usage of the previous
+        tasks, None without auto_resources or enough measurements.'''
+        if not self.auto_resources:
+            return None
+        resources.record_usage(self.db, table_name)
+        if table_name == 'sixtrack_task':
+            return resources.ResourceModel.fit(self.db, table_name,
+                                               'sixtrack_wu',
+                                               packing.RuntimeModel.columns)
+        return resources.ResourceModel.fit(self.db, table_name)
+
+    def _job_resources(self, table_name, jobs, outputs=None):
+        '''Choose the resources of the jobs from the measured usage of the
+        previous tasks.
+
+        Args:
+            table_name (str): 'preprocess_task' or 'sixtrack_task'.
+            jobs (list): the task ids of the jobs, a list per grouped job.
+            outputs (dict): the sixtrack_wu columns of the tasks, for the
+            cost of the sixtrack tasks.
+
+        Returns:
+            dict: task ids -> (flavour, memory, cpus), None without enough
+            measurements.
+        '''
+        model = self._resource_model(table_name)
+        if model is None:
+            return None
+        costs = {}
+        if table_name == 'sixtrack_task':
+            cols = [i for i in packing.RuntimeModel.columns if i in outputs]
+            for i, task_id in enumerate(outputs['task_id']):
+                costs[task_id] = packing.task_cost(
+                    dict((col, outputs[col][i]) for col in cols))
+        requests = {}
+        flavours = {}
+        for job in jobs:
+            if not isinstance(job, list):
+                job = [job]
+            req = model.request([costs.get(i, 1.0) for i in job])
+            requests['-'.join(map(str, job))] = req
+            flavours[req[0]] = flavours.get(req[0], 0) + 1
+        content = "Resources of the %s jobs from %d measured tasks: %s." % (
+            table_name.split('_')[0], model.samples,
+            ', '.join('%d %s' % (n, i) for i, n in flavours.items()))
+        self._logger.info(content)
+        return requests
+
+    def param_where(self, **ranges):
+        '''Build a where condition on the sixtrack parameters which runs on
+        the indexed columns, e.g. param_where(amp=(8, 12), angle=45).
+
+        Args:
+            **ranges: parameter name with either a value or a (low, high)
+            range, one of the bounds can be None. For a vector parameter the
+            range selects the values within it, e.g. amp=(8, 12) selects
+            amp=(8, 10) and amp=(10, 12).
+
+        Returns:
+            str: the condition, to be used in the queries on sixtrack_wu.
+        '''
+        vectors = Table.vector_params(self.sixtrack_params)
+        columns = self.db.fetch_columns('sixtrack_wu')
+        conds = []
+        for key, val in ranges.items():
+            if key not in columns:
+                content = "Unknown sixtrack parameter %s!" % key
+                raise ValueError(content)
+            if key in vectors:
+                cols = Table.vector_columns(key, vectors[key])
+                low_col, high_col = cols[0], cols[-1]
+            else:
+                low_col = high_col = key
+            if isinstance(val, (tuple, list)):
+                low, high = val
+                if low is not None:
+                    conds.append(f'{low_col}>={Table.sql_literal(low)}')
+                if high is not None:
+                    conds.append(f'{high_col}<={Table.sql_literal(high)}')
+            elif key in vectors:
+                val = Table.sql_literal(val)
+                conds.append(f'{low_col}<={val} and {high_col}>={val}')
+            else:
+                conds.append(f'{key}={Table.sql_literal(val)}')
+        return ' and '.join(conds)
+
+    def _codec_section(self):
+        '''The codec policy as config section, only the explicit codecs'''
+        return dict((key, value) for key, value in self.codec_policy.items()
+                    if value is not None)
+
     def _check_parameter_changes(self):
         '''Check if the parameters are changed, return the records
         and new lists'''
@@ -362,6 +579,11 @@ class Study(object):
 
     def update_db(self, db_check=False):
         '''Update the database whith the user-defined parameters'''
+        with self.db.profile(self.db_bulk_settings):
+            self._update_db(db_check)
+
+    def _update_db(self, db_check=False):
+        '''Fill the database tables, see update_db'''
         temp = self.paths["templates"]
         cont = os.listdir(temp)
         require = []
@@ -372,21 +594,22 @@ class Study(object):
                 content = "The required file %s isn't found in %s!" % (r, temp)
                 raise FileNotFoundError(content)
         outputs = self.db.select('templates', self.tables['templates'].keys())
+        codec = self.codec_policy['templates']
         tab = {}
         for key, value in self.madx_input.items():
             value = os.path.join(self.study_path, value)
-            tab[key] = utils.compress_buf(value)
+            tab[key] = utils.compress_buf(value, codec=codec)
         value = os.path.join(self.study_path, self.sixtrack_input['fort_file'])
-        tab['fort_file'] = utils.compress_buf(value)
+        tab['fort_file'] = utils.compress_buf(value, codec=codec)
         if self.collimation:
             for key in self.collimation_input.keys():
                 val = os.path.join(self.study_path, self.collimation_input[key])
-                tab[key] = utils.compress_buf(val)
+                tab[key] = utils.compress_buf(val, codec=codec)
         if 'additional_input' in self.sixtrack_input.keys():
             inp = self.sixtrack_input['additional_input']
             for key in inp:
                 value = os.path.join(self.study_path, key)
-                tab[key] = utils.compress_buf(value)
+                tab[key] = utils.compress_buf(value, codec=codec)
         if not outputs:
             self.db.insert('templates', tab)
         else:
@@ -504,6 +727,10 @@ class Study(object):
         six_table['status']=[]
         six_table['mtime']=[]
         six_table['preprocess_id'] = []
+        vectors = Table.vector_params(self.sixtrack_params)
+        for ky, size in vectors.items():
+            for col in Table.vector_columns(ky, size):
+                six_table[col] = []
 
         new_elements = set(self.custom_product_sixtrack(six_news))-\
                 set(self.custom_product_sixtrack(six_records))
@@ -520,6 +747,11 @@ class Study(object):
             for i in range(len(element)):
                 ky = keys[i]
                 vl = element[i]
+                if ky in vectors:
+                    cols = Table.vector_columns(ky, vectors[ky])
+                    comps = Table.split_vector(vl, vectors[ky])
+                    for col, comp in zip(cols, comps):
+                        six_table[col].append(comp)
                 if isinstance(vl, Iterable):
                     vl = str(vl)
                 six_table[ky].append(vl)
@@ -590,6 +822,11 @@ class Study(object):
         if status:
             content = "Submit %s job successfully!" % jobname
             self._logger.info(content)
+        else:
+            content = "Failed to submit %s job!" % jobname
+            self._logger.error(content)
+        if out:
+            # record the submitted jobs, also on partial failure
             table = {}
             table['status'] = 'submitted'
             for ky, vl in out.items():
@@ -599,9 +836,6 @@ class Study(object):
                     table['unique_id'] = vl
                     table['batch_name'] = batch_name
                     self.db.update(table_name, table, where)
-        else:
-            content = "Failed to submit %s job!" % jobname
-            self._logger.error(content)
 
     def collect_result(self, typ, boinc=False):
         '''Collect the results of preprocess or sixtrack jobs'''
@@ -609,7 +843,9 @@ class Study(object):
         info_sec = {}
         config['info'] = info_sec
         config['db_setting'] = self.db_settings
+        config['db_bulk_setting'] = self.db_bulk_settings
         config['db_info'] = self.db_info
+        config['codecs'] = self._codec_section()
 
         if typ == 0:
             if self.oneturn:
@@ -639,11 +875,23 @@ class Study(object):
             gather.run(typ, config, self.submission)
         except Exception as e:
             raise e
+        if typ == 0 and self.madx_cache:
+            self.share_preprocess()
+        if typ == 1 and self._chaining():
+            if self.chain_segments() and self.auto_submit_segments:
+                self.submit_segments(boinc)
 
     def prepare_sixtrack_input(self, resubmit=False, boinc=False, groupby=None,
-            *args, **kwargs):
-        '''Prepare the input files for sixtrack job'''
-        if self.checkpoint_restart:
+            *args, walltime=None, **kwargs):
+        '''Prepare the input files for sixtrack job
+        @groupby The tasks whose parameters only differ by this one are run
+        in the same job
+        @walltime Pack the tasks into jobs of this running time (s), instead
+        of job_walltime
+        '''
+        if self._chaining():
+            self.chain_segments()
+        elif self.checkpoint_restart:
             self.prepare_cr()
         where = "status='complete'"
         preprocess_outs = self.db.select('preprocess_wu', ['wu_id'], where)
@@ -665,14 +913,16 @@ class Study(object):
             self._logger.info(content)
             return
         names = list(self.tables['sixtrack_wu'].keys())
-        group_results = dict(zip(names, zip(*results)))
         new_results = []
+        # the parameters before the further calculations, for the grouping
+        raw_results = []
         for result in results:
             paramsdict = dict(zip(names, result))
             pre_id = paramsdict['preprocess_id']
             status = self.pre_calc(paramsdict, pre_id)  # further calculation
             if status:
                 new_results.append(tuple(paramsdict.values()))
+                raw_results.append(result)
         if not new_results:
             content = ("There isn't available sixtrack job to submit due to "
                        "failed further calculation!")
@@ -687,21 +937,27 @@ class Study(object):
         task_table = {}
         wu_table = {}
         task_ids = []
-        for wu_id, last_turn in zip(wu_ids, last_turns):
-            task_table['wu_id'] = wu_id
-            task_table['last_turn'] = last_turn
-            task_table['mtime'] = int(time.time() * 1E7)
-            self.db.insert('sixtrack_task', task_table)
-            where = "mtime=%s and wu_id=%s" % (task_table['mtime'], wu_id)
-            task_id = self.db.select('sixtrack_task', ['task_id'], where)
-            task_id = task_id[0][0]
-            task_ids.append(task_id)
-            wu_table['task_id'] = task_id
-            wu_table['mtime'] = int(time.time() * 1E7)
-            where = f"wu_id={wu_id} and last_turn={last_turn}"  # wu_id is not unique now
-            self.db.update('sixtrack_wu', wu_table, where)
+        with self.db.profile(self.db_bulk_settings):
+            for wu_id, last_turn in zip(wu_ids, last_turns):
+                task_table['wu_id'] = wu_id
+                task_table['last_turn'] = last_turn
+                task_table['mtime'] = int(time.time() * 1E7)
+                self.db.insert('sixtrack_task', task_table)
+                where = "mtime=%s and wu_id=%s" % (task_table['mtime'], wu_id)
+                task_id = self.db.select('sixtrack_task', ['task_id'], where)
+                task_id = task_id[0][0]
+                task_ids.append(task_id)
+                wu_table['task_id'] = task_id
+                wu_table['mtime'] = int(time.time() * 1E7)
+                where = f"wu_id={wu_id} and last_turn={last_turn}"  # wu_id is not unique now
+                self.db.update('sixtrack_wu', wu_table, where)
         outputs['task_id'] = task_ids
+        group_results = dict(zip(names, zip(*raw_results)))
         group_results['task_id'] = task_ids
+        # the madx outputs may have been archived by compact
+        constr = "wu_id in (%s)" % (','.join(map(str, set(pre_ids))))
+        pre_task_ids = self.db.select('preprocess_wu', ['task_id'], constr)
+        self.restore_blobs('preprocess_task', [i[0] for i in pre_task_ids])
         db_info = {}
         db_info.update(self.db_info)
         tran_input = []
@@ -710,7 +966,7 @@ class Study(object):
             if os.path.exists(sub_name):
                 os.remove(sub_name)  # remove the old one
             db_info['db_name'] = sub_name
-            sub_db = SixDB(db_info, settings=self.db_settings, create=True)
+            sub_db = SixDB(db_info, settings=self.sub_db_settings, create=True)
             sub_db.create_table('preprocess_wu', self.tables['preprocess_wu'],
                                 self.table_keys['preprocess_wu'])
             sub_db.create_table('preprocess_task',
@@ -737,13 +993,20 @@ class Study(object):
             pre_outs = self.db.select('preprocess_wu', where=constr)
             names = list(self.tables['preprocess_wu'].keys())
             pre_ins = dict(zip(names, zip(*pre_outs)))
-            sub_db.insertm('preprocess_wu', pre_ins)
 
             pre_task_ids = pre_ins['task_id']
             constr = "task_id in (%s)" % (','.join(map(str, pre_task_ids)))
             pre_task_outs = self.db.select('preprocess_task', where=constr)
             names = list(self.tables['preprocess_task'].keys())
             pre_task_ins = dict(zip(names, zip(*pre_task_outs)))
+            # a shared preprocess task belongs to the work unit which ran it
+            owners = set(pre_task_ins.get('wu_id', ())) - set(pre_ids)
+            if owners:
+                constr = "wu_id in (%s)" % (','.join(map(str, owners)))
+                pre_outs += self.db.select('preprocess_wu', where=constr)
+                names = list(self.tables['preprocess_wu'].keys())
+                pre_ins = dict(zip(names, zip(*pre_outs)))
+            sub_db.insertm('preprocess_wu', pre_ins)
             if resubmit:
                 constr = "first_turn is not null and status='submitted'"
             else:
@@ -796,10 +1059,17 @@ class Study(object):
         in_path = self.paths['sixtrack_in']
         out_path = self.paths['sixtrack_out']
         exe = os.path.join(utils.PYSIXDESK_ABSPATH, 'pysixdesk/lib', 'sixtrack.py')
+        units = [[i] for i in task_ids]
         if groupby:
-            task_ids = self._group_records(group_results, groupby)
+            units = self._group_records(group_results, groupby)
+            task_ids = units
+        walltime = walltime or self.job_walltime
+        if walltime and not boinc:
+            task_ids = self._pack_records(outputs, units, walltime)
+        res = self._job_resources('sixtrack_task', task_ids, outputs)
         self.submission.prepare(task_ids, tran_input, exe, 'input.ini', in_path,
-                                out_path, flavour='tomorrow', *args, **kwargs)
+                                out_path, flavour='tomorrow', resources=res,
+                                *args, **kwargs)
 
     def prepare_preprocess_input(self, resubmit=False, *args, **kwargs):
         '''Prepare the input files for madx and one turn sixtrack job'''
@@ -817,22 +1087,40 @@ class Study(object):
         trans = []
         names = list(self.tables['preprocess_wu'].keys())
         outputs = dict(zip(names, zip(*results)))
+        if self.memoize_madx and not resubmit:
+            outputs = self._reuse_preprocess(outputs)
+            if not outputs['wu_id']:
+                content = "All the preprocess jobs reuse existing results!"
+                self._logger.info(content)
+                return
         wu_ids = outputs['wu_id']
+        madx_keys = outputs.get('madx_key') or [None] * len(wu_ids)
         task_table = {}
         wu_table = {}
         task_ids = []
-        for wu_id in wu_ids:
-            task_table['wu_id'] = wu_id
-            task_table['mtime'] = int(time.time() * 1E7)
-            self.db.insert('preprocess_task', task_table)
-            where = "mtime=%s and wu_id=%s" % (task_table['mtime'], wu_id)
-            task_id = self.db.select('preprocess_task', ['task_id'], where)
-            task_id = task_id[0][0]
-            task_ids.append(task_id)
-            wu_table['task_id'] = task_id
-            wu_table['mtime'] = int(time.time() * 1E7)
-            where = "wu_id=%s" % wu_id
-            self.db.update('preprocess_wu', wu_table, where)
+        wu_task_ids = []
+        # the work units with the same inputs share a task
+        batch_tasks = {}
+        with self.db.profile(self.db_bulk_settings):
+            for wu_id, madx_key in zip(wu_ids, madx_keys):
+                task_id = batch_tasks.get(madx_key)
+                if task_id is None:
+                    task_table['wu_id'] = wu_id
+                    task_table['mtime'] = int(time.time() * 1E7)
+                    self.db.insert('preprocess_task', task_table)
+                    where = "mtime=%s and wu_id=%s" % (task_table['mtime'],
+                                                       wu_id)
+                    task_id = self.db.select('preprocess_task', ['task_id'],
+                                             where)
+                    task_id = task_id[0][0]
+                    task_ids.append(task_id)
+                    if madx_key is not None:
+                        batch_tasks[madx_key] = task_id
+                wu_task_ids.append(task_id)
+                wu_table['task_id'] = task_id
+                wu_table['mtime'] = int(time.time() * 1E7)
+                where = "wu_id=%s" % wu_id
+                self.db.update('preprocess_wu', wu_table, where)
         db_info = {}
         db_info.update(self.db_info)
         if db_info['db_type'].lower() == 'sql':
@@ -840,14 +1128,14 @@ class Study(object):
             if os.path.exists(sub_name):
                 os.remove(sub_name)  # remove the old one
             db_info['db_name'] = sub_name
-            sub_db = SixDB(db_info, settings=self.db_settings, create=True)
+            sub_db = SixDB(db_info, settings=self.sub_db_settings, create=True)
             sub_db.create_table('preprocess_wu', self.tables['preprocess_wu'])
             sub_db.create_table('templates', self.tables['templates'])
             temp_outs = self.db.select('templates')
             names = list(self.tables['templates'].keys())
             temp_ins = dict(zip(names, zip(*temp_outs)))
             sub_db.insertm('templates', temp_ins)
-            outputs['task_id'] = task_ids
+            outputs['task_id'] = wu_task_ids
             sub_db.insertm('preprocess_wu', outputs)
             sub_db.close()
             db_info['db_name'] = 'sub.db'
@@ -865,82 +1153,257 @@ class Study(object):
         in_path = self.paths['preprocess_in']
         out_path = self.paths['preprocess_out']
         exe = os.path.join(utils.PYSIXDESK_ABSPATH, 'pysixdesk/lib', 'preprocess.py')
+        res = self._job_resources('preprocess_task', task_ids)
         self.submission.prepare(task_ids, trans, exe, 'input.ini', in_path,
-                                out_path, flavour='espresso', *args, **kwargs)
+                                out_path, flavour='espresso', resources=res,
+                                *args, **kwargs)
+
+    def _madx_keys(self, outputs):
+        '''The madx_key of the preprocess work units, from the templates
+        stored in the database, see memo.madx_key'''
+        templates = self.preprocess_config['templates']
+        bufs = self.db.select('templates', list(templates.keys()))
+        if not bufs or None in bufs[0]:
+            raise FileNotFoundError('Templates not found in DB.')
+        inputs = dict((key, compression.decompress(buf)) for key, buf in
+                      zip(templates.keys(), bufs[0]))
+        mask = inputs.pop('mask_file').decode()
+        settings = dict((sec, dict(val)) for sec, val in
+                        self.preprocess_config.items()
+                        if sec not in ['mask', 'templates', 'codecs'])
+        exes = [settings['madx'].pop('madx_exe')]
+        if 'sixtrack' in settings:
+            exes.append(settings['sixtrack'].pop('sixtrack_exe'))
+            # where the runs take place doesn't change the results
+            settings['sixtrack'].pop('work_dir', None)
+            settings['sixtrack'].pop('work_dir_size', None)
+        mask = template.compile_text(mask)
+        params = list(self.madx_params.keys())
+        unresolved = mask.unresolved(params)
+        if unresolved:
+            content = "The placeholders %s of the mask have no parameter!" % (
+                ', '.join('%' + i for i in unresolved))
+            self._logger.warning(content)
+        rows = zip(*[outputs[a] for a in params])
+        return [memo.madx_key(rendered, inputs, exes, settings) for rendered
+                in mask.render_many(rows, params)]
+
+    def _reuse_preprocess(self, outputs):
+        '''Set the madx_key of the preprocess work units, and complete those
+        whose results already exist in this study or in the madx_cache
+        folder.
+
+        Args:
+            outputs (dict): the columns of the incomplete work units.
+
+        Returns:
+            dict: the columns of the work units left to run.
+        '''
+        keys = self._madx_keys(outputs)
+        outputs['madx_key'] = keys
+        where = "status='complete' and madx_key is not null"
+        done = dict(self.db.select('preprocess_wu', ['madx_key', 'task_id'],
+                                   where))
+        shared = None
+        if self.madx_cache:
+            shared = memo.ResultCache(self.madx_cache)
+        left = []
+        with self.db.profile(self.db_bulk_settings):
+            for i, (wu_id, key) in enumerate(zip(outputs['wu_id'], keys)):
+                task_id = done.get(key)
+                if task_id is None and shared is not None:
+                    task_id = self._import_preprocess(shared, wu_id, key)
+                    done[key] = task_id
+                wu_table = {'madx_key': key}
+                if task_id is None:
+                    left.append(i)
+                else:
+                    wu_table['task_id'] = task_id
+                    wu_table['status'] = 'complete'
+                    wu_table['mtime'] = int(time.time() * 1E7)
+                self.db.update('preprocess_wu', wu_table, f'wu_id={wu_id}')
+        reused = len(keys) - len(left)
+        if reused:
+            content = ("Reused the results of %d preprocess jobs with the "
+                       "same inputs." % reused)
+            self._logger.info(content)
+        return dict((col, [vals[i] for i in left]) for col, vals in
+                    outputs.items())
+
+    def _import_preprocess(self, shared, wu_id, key):
+        '''Insert the results of the madx_cache entry as a task of the work
+        unit.
+
+        Returns:
+            int: the task id, None if the entry is missing.
+        '''
+        entry = shared.get(key)
+        if entry is None:
+            return None
+        blobs, results = entry
+        known = [i.replace('.', '_') for i in self.tables['preprocess_task']]
+        task_table = dict((col, buf) for col, buf in blobs.items()
+                          if col in known)
+        task_table['wu_id'] = wu_id
+        task_table['status'] = 'Success'
+        task_table['mtime'] = int(time.time() * 1E7)
+        self.db.insert('preprocess_task', task_table)
+        where = "mtime=%s and wu_id=%s" % (task_table['mtime'], wu_id)
+        task_id = self.db.select('preprocess_task', ['task_id'], where)[0][0]
+        for table_name, vals in results.items():
+            if vals:
+                vals['task_id'] = [task_id] * len(vals['mtime'])
+                self.db.insertm(table_name, vals)
+        return task_id
+
+    def share_preprocess(self):
+        '''Store the results of the complete preprocess jobs in the
+        madx_cache folder, for the other studies.'''
+        shared = memo.ResultCache(self.madx_cache)
+        where = "status='complete' and madx_key is not null"
+        rows = self.db.select('preprocess_wu', ['madx_key', 'task_id'], where,
+                              DISTINCT=True)
+        rows = [i for i in rows if i[0] not in shared]
+        if not rows:
+            return
+        cols = [i.replace('.', '_') for i in self.preprocess_output.values()]
+        cols += ['madx_in', 'madx_stdout']
+        # the madx outputs may have been archived by compact
+        self.restore_blobs('preprocess_task', [i[1] for i in rows], cols)
+        tables = Table.result_table(self.preprocess_output.values()).values()
+        tables = [i for i in tables if i is not None]
+        stored = 0
+        for key, task_id in rows:
+            where = f'task_id={task_id}'
+            bufs = self.db.select('preprocess_task', cols, where)
+            if not bufs or None in bufs[0]:
+                continue
+            results = {}
+            for table_name in tables:
+                names = [i for i in self.tables[table_name] if i != 'task_id']
+                vals = self.db.select(table_name, names, where)
+                results[table_name] = dict(zip(names, map(list, zip(*vals))))
+            stored += shared.put(key, dict(zip(cols, bufs[0])), results)
+        content = "Stored %d preprocess results in %s." % (stored,
+                                                            self.madx_cache)
+        self._logger.info(content)
 
     def _group_records(self, outputs, groupby):
-        '''Group the records from db by given rules'''
-        task_ids = []
+        '''Group the tasks whose parameters only differ by the groupby one,
+        the tasks of a group are sorted on the groupby parameter'''
         keys = list(self.sixtrack_params.keys())
         keys.append('preprocess_id')
-        new_outs = {}
-        for key in keys:
-            new_outs[key] = outputs[key]
+        others = [key for key in keys if key != groupby]
+        # sort on the numeric column of the vector parameters
+        first = outputs.get(f'{groupby}_0', [None] * len(outputs[groupby]))
+        order = dict(zip(outputs[groupby], first))
+
         def fun(elem):
+            if order.get(elem) is not None:
+                return order[elem]
             if isinstance(elem, str):
                 ele = ast.literal_eval(elem)
                 if isinstance(ele, Iterable):
                     elem = ele[0]
                 return elem
             return elem
-        iden_names = sorted(set(new_outs[groupby]), key=fun)
-        records = list(zip(*new_outs.values()))
-        ind = list(new_outs.keys()).index(groupby)
-        group_list = []
-        init = list(records[0])
-        init.pop(ind)
-        results = SpecialDict.fromkeys(init, iden_names)
-        group_list.append(results)
-        for i in range(len(records)):
-            rec = list(records[i])
-            iden = rec.pop(ind)
-            for li in group_list:
-                flag = li.set(iden, outputs['task_id'][i], rec)
-                if flag:
-                    break
-            else:
-                res = SpecialDict.fromkeys(rec, iden_names)
-                res.set(iden, outputs['task_id'][i], rec)
-                group_list.append(res)
-
-        for lis in group_list:
-            lis.clear_none()
-            task_ids.append(list(lis.values()))
+        groups = OrderedDict()
+        for i, task_id in enumerate(outputs['task_id']):
+            mark = tuple(outputs[key][i] for key in others)
+            groups.setdefault(mark, []).append((outputs[groupby][i], task_id))
+        task_ids = []
+        for members in groups.values():
+            members.sort(key=lambda x: fun(x[0]))
+            task_ids.append([i[1] for i in members])
         return task_ids
 
+    def _pack_records(self, outputs, units, walltime):
+        '''Pack the tasks of the same preprocess job into jobs of the given
+        running time (s). The tasks of a job run concurrently on the cpus it
+        requests, see _job_resources: with a resource model the jobs are
+        sized on its predicted wall times and concurrency, otherwise on the
+        running times calibrated on the gathered tasks and the request_cpus
+        of the submission. The units are lists of tasks which aren't
+        split.'''
+        model = self._resource_model('sixtrack_task')
+        if model is not None:
+            workers, slowdown = model.concurrency()
+        else:
+            runtime = packing.RuntimeModel.calibrate(self.db)
+            workers = getattr(self.submission, 'request_cpus', 1) or 1
+            slowdown = 1.0
+        cols = [i for i in packing.RuntimeModel.columns if i in outputs]
+        costs = {}
+        pre_ids = {}
+        for i, task_id in enumerate(outputs['task_id']):
+            params = dict((col, outputs[col][i]) for col in cols)
+            if model is not None:
+                cost = model.predict_wall(packing.task_cost(params))
+            else:
+                cost = runtime.estimate(params)
+            costs[task_id] = cost * slowdown
+            pre_ids[task_id] = outputs['preprocess_id'][i]
+        groups = OrderedDict()
+        for unit in units:
+            groups.setdefault(pre_ids[unit[0]], []).append(unit)
+        jobs = packing.pack_tasks(groups, costs, walltime, workers=workers)
+        stats = packing.summary(jobs, costs, workers)
+        content = "Packed %d tasks into %d jobs of %d workers, estimated "\
+            "running time min/median/max: %.0f/%.0f/%.0f s." % (
+                stats['tasks'], stats['jobs'], workers, stats['min'],
+                stats['median'], stats['max'])
+        self._logger.info(content)
+        return jobs
+
     def pre_calc(self, **kwargs):
         '''Further calculations for the specified parameters'''
         pass
 
     def prepare_cr(self):
         '''Prepare the checkpoint data, add new lines in db'''
-        checks_1 = self.db.select('sixtrack_wu', ['wu_id'], DISTINCT=True)
-        if checks_1:
-            checks_1 = list(zip(*checks_1))[0]
+        names = list(self.tables['sixtrack_wu'].keys())
+        where = f"s.last_turn={self.first_turn-1}"
+        if segments.insert_next(self.db, names, where, str(self.last_turn)):
+            return True
         where = f"last_turn={self.last_turn}"
-        checks_2 = self.db.select('sixtrack_wu', ['wu_id'], where)
-        if checks_2:
-            checks_2 = list(zip(*checks_2))[0]
-        checks = [i for i in checks_1 if i not in checks_2]
-        if not checks:
+        if self.db.select('sixtrack_wu', ['wu_id'], where, limit=1):
             self._logger.info(f"The tracking jobs with last turn "
                               f"{self.last_turn} already exist!")
             return True
-        constraints = f"status='complete' and last_turn={self.first_turn-1}\
-                and wu_id in ({','.join(map(str, checks))})"
-        results = self.db.select('sixtrack_wu', where=constraints)
-        if not results:
-            self._logger.warning(f"There isn't complete job with last "
-                                 f"turn is {self.first_turn-1}")
-            return False
-        N = len(results)
-        names = self.tables['sixtrack_wu'].keys()
-        new_lines = dict(zip(names, zip(*results)))
-        new_lines['last_turn'] = (self.last_turn,)*N
-        new_lines['first_turn'] = (self.first_turn,)*N
-        new_lines['status'] = ('incomplete',)*N
-        new_lines['turnss'] = (self.last_turn,)*N
-        self.db.insertm('sixtrack_wu', new_lines)
+        self._logger.warning(f"There isn't complete job with last "
+                             f"turn is {self.first_turn-1}")
+        return False
+
+    def _chaining(self):
+        return bool(self.checkpoint_restart and self.segment_turns and
+                    self.final_turn)
+
+    def chain_segments(self):
+        '''Queue the next checkpoint/restart segment of the work units whose
+        last segment is complete, see segments.chain. When the results are
+        collected, the new segments are prepared and submitted with the
+        other incomplete sixtrack jobs if auto_submit_segments is set.
+
+        Returns:
+            int: the number of queued segments.
+        '''
+        names = list(self.tables['sixtrack_wu'].keys())
+        count = segments.chain(self.db, names, self.segment_turns,
+                               self.final_turn)
+        if not count:
+            left = segments.pending(self.db, self.final_turn)
+            content = "%d work units haven't reached turn %d yet." % (
+                left, self.final_turn)
+            self._logger.info(content)
+        return count
+
+    def submit_segments(self, boinc=False, trials=5):
+        '''Prepare and submit the queued segments, with the other incomplete
+        sixtrack work units, see auto_submit_segments.'''
+        self.prepare_sixtrack_input(boinc=boinc)
+        self.submit(1, trials)
+        content = "Submitted the next checkpoint/restart segments."
+        self._logger.info(content)
 
     def init_boinc_dir(self):
         '''Initialise the boinc directory'''
@@ -961,10 +1424,76 @@ class Study(object):
         if not os.path.isdir(results_path):
             os.mkdir(results_path)
 
-    def purge_table(self, table_name):
-        '''Clean the invalid lines in the specified table'''
+    def purge_table(self, table_name, pages=None):
+        '''Clean the invalid lines in the specified table, then release up to
+        pages free pages of the database file (all of them if None)'''
         where = "status IS NULL"
         self.db.remove(table_name, where)
+        self.db.vacuum(pages)
+
+    def compact(self, policy='default', pages=None):
+        '''Move the blobs which aren't needed anymore to tar archives in
+        archive_path, then release up to pages free pages of the database
+        file (all of them if None). The archived blobs can be put back with
+        restore_blobs.
+
+        Args:
+            policy (str/list): name of a policy of retention.POLICIES or list
+            of the rules to apply:
+                superseded_checkpoints: the checkpoint files and logs of the
+                segments followed by a complete segment.
+                completed_logs: the logs of the successful tasks.
+                finished_preprocess: the madx outputs of the preprocess jobs
+                whose sixtrack jobs are all complete.
+            pages (int): number of free pages to release.
+
+        Returns:
+            int: the number of archived bytes.
+        '''
+        rules = retention.policy_rules(policy)
+        archive = retention.BlobArchive(self.db, self.archive_path,
+                                        self.study_path)
+        n_bytes = 0
+        with self.db.profile(self.db_bulk_settings):
+            # keep the usage of the tasks before archiving their logs
+            for table_name in retention.LOG_COLUMNS.keys():
+                resources.record_usage(self.db, table_name)
+            if 'superseded_checkpoints' in rules:
+                task_ids = retention.superseded_checkpoints(self.db)
+                cols = (retention.CHECKPOINT_COLUMNS +
+                        retention.LOG_COLUMNS['sixtrack_task'])
+                n_bytes += archive.archive('sixtrack_task', task_ids, cols)
+            if 'completed_logs' in rules:
+                for table_name, cols in retention.LOG_COLUMNS.items():
+                    task_ids = retention.completed_tasks(self.db, table_name)
+                    n_bytes += archive.archive(table_name, task_ids, cols)
+            if 'finished_preprocess' in rules:
+                task_ids = retention.finished_preprocess(self.db)
+                cols = [i.replace('.', '_') for i in
+                        self.preprocess_output.values()]
+                n_bytes += archive.archive('preprocess_task', task_ids, cols)
+        self.db.vacuum(pages)
+        content = "Compacted the database, %d bytes archived." % n_bytes
+        self._logger.info(content)
+        return n_bytes
+
+    def restore_blobs(self, table_name, task_ids=None, columns=None):
+        '''Put back in the database the blobs archived by compact.
+
+        Args:
+            table_name (str): 'sixtrack_task' or 'preprocess_task'.
+            task_ids (list): the tasks to restore, all if None.
+            columns (list): the columns to restore, all if None.
+
+        Returns:
+            int: the number of restored blobs.
+        '''
+        if (retention.BlobArchive.index_table,) not in self.db.fetch_tables():
+            return 0
+        archive = retention.BlobArchive(self.db, self.archive_path,
+                                        self.study_path)
+        with self.db.profile(self.db_bulk_settings):
+            return archive.restore(table_name, task_ids, columns)
 
     def getval(self, pre_id, reqlist):
         '''Get required values from oneturn sixtrack results'''
@@ -1002,32 +1531,3 @@ class Study(object):
         '''Custom product of the input iterables for sixtrack.
         In default, it's cartesian product'''
         return itertools.product(*param_dict.values())
-
-class SpecialDict(OrderedDict):
-
-    def __init__(self, mark=None, *args, **kwargs):
-        self.mark = mark
-        super().__init__(*args, **kwargs)
-
-    @classmethod
-    def fromkeys(cls, mark, iterable, value=None):
-        self = cls(mark)
-        for key in iterable:
-            self[key] = value
-        return self
-
-    def set(self, key, value, mark):
-        if mark == self.mark:
-            super().__setitem__(key, value)
-            return True
-        else:
-            return False
-
-    def clear_none(self):
-        keys = list(self.keys())
-        for key in keys:
-            if self[key] is None:
-                self.pop(key)
-
-
-
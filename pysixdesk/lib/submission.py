@@ -1,19 +1,88 @@
 import os
+import re
+import sys
+import json
+import time
 import shutil
 import logging
 import getpass
 
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
 
 from . import utils
+from . import bundle
+from . import localrun
+from . import jobtracker
+
+
+class StatusSnapshot(object):
+    '''The states of the jobs of a study at a given time'''
+
+    def __init__(self, jobs=None, complete=True):
+        '''Constructor.
+        jobs (dict): ClusterId.ProcId -> (state, batch name, task), the
+        states are the JobStatus values of jobtracker, the task is the
+        argument of the job, e.g. '12' or '12-13-14' for grouped tasks
+        complete (bool): whether the jobs missing from the snapshot have left
+        the queue, i.e. the snapshot lists all the jobs of the study
+        '''
+        self.jobs = jobs or {}
+        self.complete = complete
+        self.time = time.time()
+        self.tasks = {}
+        for unique_id, (state, batch, task) in self.jobs.items():
+            if task:
+                for task_id in str(task).split('-'):
+                    self.tasks[task_id] = unique_id
+
+    def age(self):
+        return time.time() - self.time
+
+    def state(self, unique_id):
+        '''The state of a job, None if not in the snapshot'''
+        job = self.jobs.get(str(unique_id))
+        if job is None:
+            return None
+        return job[0]
+
+    def task_state(self, task_id):
+        '''The state of the job of a task, None if not in the snapshot'''
+        unique_id = self.tasks.get(str(task_id))
+        if unique_id is None:
+            return None
+        return self.state(unique_id)
+
+    def unfinished(self, unique_ids=None):
+        '''The jobs which are still in the queue (idle, running or held)'''
+        if unique_ids is None:
+            unique_ids = self.jobs.keys()
+        return [i for i in map(str, unique_ids)
+                if self.state(i) in jobtracker.UNFINISHED]
+
+    def unknown(self, unique_ids):
+        '''The jobs whose state can't be told from the snapshot'''
+        if self.complete:
+            return []
+        return [i for i in map(str, unique_ids) if i not in self.jobs]
+
+    def batch(self, batch_name):
+        '''The jobs of a batch, task -> ClusterId.ProcId'''
+        return dict((task, unique_id) for unique_id, (state, batch, task) in
+                    self.jobs.items() if batch == batch_name)
 
 
 class Cluster(ABC):
 
+    # seconds during which a status snapshot is reused
+    snapshot_ttl = 30
+
     def __init__(self, temp_path):
         '''Constructor'''
         self._logger = logging.getLogger(__name__)
+        self._snapshots = {}
 
     @abstractmethod
     def prepare(self, task_ids, trans, exe, exe_args, input_path, output_path,
@@ -28,6 +97,40 @@ class Cluster(ABC):
     def check_running(self, *args, **kwargs):
         pass
 
+    def status_snapshot(self, study_path, unique_ids=None, refresh=False):
+        '''Get the states of all the jobs of a study with a single query to
+        the scheduler, the snapshot is reused for snapshot_ttl seconds.
+
+        Args:
+            study_path (str): The absolute path of the study.
+            unique_ids (list): The jobs of interest, the cached snapshot is
+            refreshed if it can't tell their state.
+            refresh (bool): Ignore the cached snapshot.
+
+        Returns:
+            StatusSnapshot: the snapshot, None if the query failed.
+        '''
+        cached = self._snapshots.get(study_path)
+        if (not refresh and cached is not None and
+                cached.age() < self.snapshot_ttl and
+                not cached.unknown(unique_ids or [])):
+            return cached
+        snapshot = self._snapshot(study_path, unique_ids)
+        if snapshot is None:
+            self._snapshots.pop(study_path, None)
+        else:
+            self._snapshots[study_path] = snapshot
+        return snapshot
+
+    def _snapshot(self, study_path, unique_ids=None):
+        '''Query the states of the jobs of a study. By default only the
+        unfinished jobs are known, from check_running.'''
+        running = self.check_running(study_path)
+        if running is None:
+            return None
+        jobs = dict((i, (jobtracker.IDLE, None, None)) for i in running)
+        return StatusSnapshot(jobs)
+
     @abstractmethod
     def download_from_spool(self):
         pass
@@ -40,29 +143,58 @@ class Cluster(ABC):
 class HTCondor(Cluster):
     '''The HTCondor management system'''
 
+    resources_name = 'job_resources.json'
+    # the macros of the submit file holding the resources of the jobs
+    resource_macros = ['flavour', 'memory', 'cpus']
+    # the queue statement of the submit file, iterating over the job list
+    queue_re = re.compile(r'^(queue\s+\w+\s+from\s+).*$',
+                          re.MULTILINE | re.IGNORECASE)
+
     def __init__(self, temp_path=None):
         '''Constructor'''
         super().__init__(temp_path)
         self.temp = temp_path
         self.sub_name = 'htcondor_run.sub'
+        # follow the jobs with their event logs instead of querying condor_q
+        self.event_logs = True
+        self._tracker = None
+        # number of concurrent condor_submit processes
+        self.submit_workers = 4
+        # the default resource requests of the jobs
+        self.request_memory = 2000
+        self.request_cpus = 1
+        # ship the pysixdesk workers as zipapp bundles of the modules they
+        # import, see bundle.build, instead of the whole source folder
+        self.bundle = True
 
     def prepare(self, task_ids, trans, exe, exe_args, input_path, output_path,
-                flavour='tomorrow', *args, **kwargs):
+                flavour='tomorrow', resources=None, *args, **kwargs):
         '''Prepare the submission file.
 
         Args:
             task_ids (int): The task ids for submission
             trans (list): The python modules needed by the executables
-            exe (str): The executable
+            exe (str): The executable, a worker script of pysixdesk is
+            replaced by its bundle if bundle is set
             exe_args (str): The additional arguments for executable except for
             wu_id.
             input_path (str): The folder with input files
             output_path (str): The output folder
             flavour (str): The queue types of HTCondor
+            resources (dict): The resources of the jobs, task ->
+            (flavour, memory, cpus), None for the default ones. The jobs are
+            submitted in chunks of identical resources.
         '''
         job_list = os.path.join(input_path, 'job_id.list')
         if os.path.exists(job_list):
             os.remove(job_list)
+        res_file = os.path.join(input_path, self.resources_name)
+        if os.path.exists(res_file):
+            os.remove(res_file)
+        if resources:
+            with open(res_file, 'w') as f_out:
+                json.dump(dict((str(k), v) for k, v in resources.items()),
+                          f_out)
         with open(job_list, 'w') as f_out:
             for i in task_ids:
                 if isinstance(i, list):
@@ -74,7 +206,13 @@ class HTCondor(Cluster):
                     shutil.rmtree(out_f)
                 os.makedirs(out_f)
         #os.chmod(job_list, 0o444)  # change the permission to readonly
-        trans.append(os.path.join(utils.PYSIXDESK_ABSPATH, 'pysixdesk'))
+        exe_bundle = None
+        if self.bundle:
+            exe_bundle = bundle.build(exe, input_path)
+        if exe_bundle is None:
+            trans.append(os.path.join(utils.PYSIXDESK_ABSPATH, 'pysixdesk'))
+        else:
+            exe = exe_bundle
         rep = {}
         rep['%func'] = ','.join(map(str, trans))
         rep['%exe'] = exe
@@ -82,6 +220,8 @@ class HTCondor(Cluster):
         rep['%joblist'] = job_list
         rep['%input'] = exe_args
         rep['%flavour'] = flavour
+        rep['%memory'] = str(self.request_memory)
+        rep['%cpus'] = str(self.request_cpus)
         if self.temp is None:
             self.temp = os.path.basename(input_path)
         sub_temp = os.path.join(self.temp, self.sub_name)
@@ -97,15 +237,22 @@ class HTCondor(Cluster):
         content = "The htcondor description file is ready!"
         self._logger.info(content)
 
-    def submit(self, input_path, job_name, limit, trials=5, *args, **kwargs):
-        '''Submit the job to the cluster
+    def submit(self, input_path, job_name, limit=None, trials=5, *args,
+               **kwargs):
+        '''Submit the job to the cluster. The job list is split into chunks
+        of at most limit jobs, which are submitted concurrently by up to
+        submit_workers condor_submit processes, a failed chunk is retried on
+        its own.
         Args:
             input_path (string): The input path to hold the input files
             job_name (string): The job name (also is the batch_name for HTCondor)
             limit (int): The maximum job number per submittion
             trials (int): The maximum number of resubmission when submit failed
+            return(tuple): (status, out), status is True if all the jobs were
+            submitted, out maps the submitted tasks to their job id
+            (ClusterId.ProcId), also on partial failure
         '''
-
+        input_path = str(input_path)
         sub = os.path.join(input_path, self.sub_name)
         joblist = os.path.join(input_path, 'job_id.list')
         if not os.path.isfile(joblist):
@@ -114,50 +261,153 @@ class HTCondor(Cluster):
             return False, None
         with open(joblist, 'r') as f_in:
             task_ids = f_in.read().split()
-        scont = 1
-        while scont <= trials:
-            args = list(args)
-            for ky in kwargs.keys():
-                args = args + ['-' + ky, kwargs[ky]]
-            args.append(sub)
-            args.append('-batch-name')
-            args.append(job_name)
-            try:
-                valid_ids = list(task_ids)
-                while valid_ids:
-                    with open(joblist, 'w') as f_out:
-                        sub_ids = valid_ids[:limit]
-                        valid_ids = list(set(valid_ids)-set(sub_ids))
-                        out_str = '\n'.join(sub_ids)
-                        f_out.write(out_str)
-                    process = Popen(['condor_submit', '-terse', *args],
-                                    stdout=PIPE, stderr=PIPE,
-                                    universal_newlines=True)
-
-                    stdout, stderr = process.communicate()
-                    self._logger.info(stdout)
-                    if stderr:
-                        self._logger.error(stderr)
-                args = ['-constraint', 'JobBatchName=="%s"' % job_name,
-                        '-format', '%d.', 'ClusterId', '-format', '%d\n', 'ProcId']
-                uniq_ids = self.check(*args).split()
-                status = len(task_ids) == len(uniq_ids)
-                if not status:
-                    content = "There is something wrong during submitting!"
-                    self._logger.error(content)
-                    scont += 1
-                else:
-                    comb = list(zip(task_ids, uniq_ids))
-                    out = dict(comb)
-                    # remove job list after successful submission
-                    os.remove(joblist)
-                    return True, out
-            except Exception as e:
-                # this will catch the excpetion raised or any unexpected
-                # exception in the try block.
-                self._logger.error(e, exc_info=True)
-                return False, None
-        return False, None
+        with open(sub, 'r') as f_in:
+            sub_cont = f_in.read()
+        args = list(args)
+        for ky in kwargs.keys():
+            args = args + ['-' + ky, kwargs[ky]]
+        args += ['-batch-name', job_name]
+
+        # the jobs with the same resources are submitted together
+        res_file = os.path.join(input_path, self.resources_name)
+        resources = {}
+        if os.path.isfile(res_file):
+            with open(res_file, 'r') as f_in:
+                resources = json.load(f_in)
+        classes = OrderedDict()
+        for task in task_ids:
+            res = resources.get(task)
+            classes.setdefault(tuple(res) if res else None, []).append(task)
+        chunks = []
+        for res, tasks in classes.items():
+            chunks += [(res, i) for i in
+                       utils.chunks(tasks, limit or len(tasks) or 1)]
+        out = {}
+        status = True
+        workers = max(1, min(self.submit_workers, len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._submit_chunk, i, chunk,
+                                   self._set_resources(sub_cont, res),
+                                   input_path, args, trials)
+                       for i, (res, chunk) in enumerate(chunks)]
+            for future in futures:
+                try:
+                    chunk_out, done = future.result()
+                except Exception as e:
+                    self._logger.error(e, exc_info=True)
+                    chunk_out, done = {}, False
+                # the queued jobs are recorded even if the chunk failed
+                out.update(chunk_out)
+                status = status and done
+        # the new jobs aren't in the cached snapshots
+        self._snapshots.clear()
+        if status:
+            # remove job list after successful submission
+            os.remove(joblist)
+            if os.path.isfile(res_file):
+                os.remove(res_file)
+        else:
+            content = "There is something wrong during submitting, %d of "\
+                "the %d jobs are submitted!" % (len(out), len(task_ids))
+            self._logger.error(content)
+            # keep the remaining jobs for the next submission
+            with open(joblist, 'w') as f_out:
+                f_out.write('\n'.join(i for i in task_ids if i not in out))
+        return status, out
+
+    def _set_resources(self, sub_cont, resources):
+        '''Set the resource macros of the submit file, resources is
+        (flavour, memory, cpus), the None values keep the defaults'''
+        if not resources:
+            return sub_cont
+        for macro, value in zip(self.resource_macros, resources):
+            if value is None:
+                continue
+            sub_cont = re.sub(r'^%s = .*$' % macro, '%s = %s' % (macro, value),
+                              sub_cont, flags=re.MULTILINE)
+        return sub_cont
+
+    def _set_queue(self, sub_cont, job_list):
+        '''Point the queue statement of the submit file to a job list'''
+        sub_cont, count = self.queue_re.subn(
+            lambda match: match.group(1) + job_list, sub_cont)
+        if count != 1:
+            content = "The submit file must have a single 'queue ... from' "\
+                "statement, found %d!" % count
+            raise ValueError(content)
+        return sub_cont
+
+    def _submit_chunk(self, index, chunk, sub_cont, input_path, args, trials):
+        '''Submit a chunk of the job list with its own submit and list files.
+
+        The submission is retried while no job is queued. When condor_submit
+        fails after queuing jobs, they are matched to the tasks in the order
+        of the job list, the jobs in excess are removed.
+
+        Returns:
+            tuple: (dict of task -> ClusterId.ProcId of the queued jobs, True
+            if all the tasks of the chunk were submitted).
+        '''
+        chunk_list = os.path.join(input_path, 'job_id.%d.list' % index)
+        chunk_sub = os.path.join(input_path, 'htcondor_run.%d.sub' % index)
+        sub_cont = self._set_queue(sub_cont, chunk_list)
+        with open(chunk_list, 'w') as f_out:
+            f_out.write('\n'.join(chunk))
+            f_out.write('\n')
+        with open(chunk_sub, 'w') as f_out:
+            f_out.write(sub_cont)
+        for trial in range(1, trials + 1):
+            process = Popen(['condor_submit', '-terse', *args, chunk_sub],
+                            stdout=PIPE, stderr=PIPE,
+                            universal_newlines=True)
+            stdout, stderr = process.communicate()
+            self._logger.info(stdout)
+            if stderr:
+                self._logger.error(stderr)
+            uniq_ids = self.parse_terse(stdout)
+            if process.returncode == 0 and len(uniq_ids) == len(chunk):
+                os.remove(chunk_list)
+                os.remove(chunk_sub)
+                return dict(zip(chunk, uniq_ids)), True
+            if uniq_ids:
+                # the jobs were queued, a retry would duplicate them
+                content = "Unexpected condor_submit output for chunk %d, "\
+                    "%d jobs for %d tasks!" % (index, len(uniq_ids),
+                                               len(chunk))
+                self._logger.error(content)
+                extra = uniq_ids[len(chunk):]
+                if extra:
+                    self._remove_jobs(extra)
+                return dict(zip(chunk, uniq_ids)), False
+            content = "Failed to submit chunk %d (trial %d/%d)!" % (
+                index, trial, trials)
+            self._logger.warning(content)
+        return {}, False
+
+    def _remove_jobs(self, uniq_ids):
+        '''Remove the given jobs from the queue'''
+        process = Popen(['condor_rm', *uniq_ids], stdout=PIPE, stderr=PIPE,
+                        universal_newlines=True)
+        stdout, stderr = process.communicate()
+        if stdout:
+            self._logger.info(stdout)
+        if stderr:
+            self._logger.error(stderr)
+        if process.returncode:
+            content = "Failed to remove the jobs %s, they aren't recorded "\
+                "in the database!" % ', '.join(uniq_ids)
+            self._logger.error(content)
+        return not process.returncode
+
+    @staticmethod
+    def parse_terse(stdout):
+        '''Get the job ids from the output of condor_submit -terse, e.g.
+        "1234.0 - 1234.9", in the order of the job list'''
+        uniq_ids = []
+        for match in re.finditer(r'(\d+)\.(\d+)\s*-\s*(\d+)\.(\d+)', stdout):
+            cluster, first, _, last = map(int, match.groups())
+            uniq_ids += ['%d.%d' % (cluster, i) for i in range(first, last + 1)]
+        return uniq_ids
 
     def check_format(self, unique_id):
         '''Check the job status with fixed format
@@ -166,6 +416,11 @@ class HTCondor(Cluster):
             return(int or None): The job status
         '''
 
+        if self._tracker is not None:
+            status = self._tracker.status(unique_id)
+            if status is not None:
+                return 0 if status in (jobtracker.COMPLETED,
+                                       jobtracker.REMOVED) else status
         args = ['-format', '%d\n', 'JobStatus']
         Id = str(unique_id)
         process = Popen(['condor_q', Id, *args], stdout=PIPE,
@@ -192,16 +447,41 @@ class HTCondor(Cluster):
                 self._logger.info(stdout)
                 return None
 
-    def check_running(self, studypath):
+    def check_running(self, studypath, unique_ids=None):
         '''Check the unfininshed job
         Args:
             studypath (string): The absolute path of the study
+            unique_ids (list): The submitted jobs, condor_q is only queried
+            if some of them aren't found in the event logs
             return(list or None): The unique id (ClusterId.ProcId) list
         '''
+        snapshot = self.status_snapshot(studypath, unique_ids)
+        if snapshot is None:
+            return None
+        return snapshot.unfinished()
 
+    def _snapshot(self, studypath, unique_ids=None):
+        '''Get the job states from the event logs, condor_q is only queried
+        if some of the given jobs aren't found in the event logs'''
+        if self.event_logs:
+            tracker = jobtracker.EventLogTracker(studypath)
+            tracker.update()
+            self._tracker = tracker
+            if unique_ids is None or not tracker.unknown(unique_ids):
+                jobs = {}
+                for unique_id, job in tracker.jobs.items():
+                    task = os.path.basename(os.path.dirname(job['log']))
+                    jobs[unique_id] = (job['status'], None, task)
+                return StatusSnapshot(jobs, complete=False)
+            content = "Some jobs aren't in the event logs, querying condor_q!"
+            self._logger.info(content)
+        return self._query_snapshot(studypath)
+
+    def _query_snapshot(self, studypath):
+        '''Get the states of all the jobs of the study with one condor_q'''
         args = ['-constraint', 'regexp("%s", JobBatchName)' % studypath,
-                '-constraint', 'JobStatus != 4', '-format', '%d.',
-                'ClusterId', '-format', '%d\n', 'ProcId']
+                '-af:t', 'ClusterId', 'ProcId', 'JobStatus', 'JobBatchName',
+                'Args']
         process = Popen(['condor_q', *args], stdout=PIPE,
                         stderr=PIPE, universal_newlines=True)
         stdout, stderr = process.communicate()
@@ -209,9 +489,15 @@ class HTCondor(Cluster):
             self._logger.info(stdout)
             self._logger.error(stderr)
             return None
-        else:
-            st = stdout.split()
-            return st
+        jobs = {}
+        for line in stdout.splitlines():
+            fields = line.split('\t')
+            if len(fields) < 5:
+                continue
+            cluster, proc, status, batch, job_args = fields[:5]
+            task = job_args.split()[0] if job_args.split() else None
+            jobs['%s.%s' % (cluster, proc)] = (int(status), batch, task)
+        return StatusSnapshot(jobs)
 
     def check(self, *args, **kwargs):
         '''Check the job status'''
@@ -265,3 +551,203 @@ class HTCondor(Cluster):
         if stderr:
             self._logger.error(stderr)
         return not process.returncode
+
+
+class LocalCluster(Cluster):
+    '''Run the jobs on the local machine with a pool of processes.
+
+    The jobs of a submission are run by a detached runner (localrun.py), so
+    that they survive the python session, in per-task temporary folders.
+    The outputs follow the layout of HTCondor (<output>/<task>/results and
+    _condor_stdout/_condor_stderr), so that the results are gathered in the
+    same way.
+    '''
+
+    batch_dir = '.local_jobs'
+
+    def __init__(self, temp_path=None, max_workers=None, pin_cpus=False,
+                 scratch=None, detach=True):
+        '''Constructor.
+        max_workers (int): number of concurrent tasks, all the cpus by default
+        pin_cpus (bool): pin every task to its own cpu
+        scratch (str): folder of the temporary task folders, e.g. /dev/shm
+        detach (bool): run the jobs in a detached process, otherwise submit
+        only returns when the jobs are finished
+        '''
+        super().__init__(temp_path)
+        if max_workers is None:
+            if hasattr(os, 'sched_getaffinity'):
+                max_workers = len(os.sched_getaffinity(0))
+            else:
+                max_workers = os.cpu_count() or 1
+        self.max_workers = max_workers
+        self.pin_cpus = pin_cpus
+        self.scratch = scratch
+        self.detach = detach
+        self.desc_name = 'local_run.json'
+
+    def prepare(self, task_ids, trans, exe, exe_args, input_path, output_path,
+                *args, **kwargs):
+        '''Prepare the job list and the description of the jobs, see
+        HTCondor.prepare'''
+        job_list = os.path.join(input_path, 'job_id.list')
+        with open(job_list, 'w') as f_out:
+            for i in task_ids:
+                if isinstance(i, list):
+                    i = '-'.join(map(str, i))
+                f_out.write(str(i))
+                f_out.write('\n')
+                out_f = os.path.join(output_path, str(i))
+                if os.path.exists(out_f):
+                    shutil.rmtree(out_f)
+                os.makedirs(out_f)
+        trans = list(trans)
+        trans.append(os.path.join(utils.PYSIXDESK_ABSPATH, 'pysixdesk'))
+        desc = {'trans': [os.path.abspath(i) for i in trans],
+                'exe': os.path.abspath(exe),
+                'exe_args': exe_args,
+                'output_path': os.path.abspath(output_path)}
+        with open(os.path.join(input_path, self.desc_name), 'w') as f_out:
+            json.dump(desc, f_out)
+        content = "The local job description is ready!"
+        self._logger.info(content)
+
+    def _new_cluster(self, study_path):
+        '''Reserve a new cluster id, returns the id and the state file'''
+        folder = os.path.join(study_path, self.batch_dir)
+        os.makedirs(folder, exist_ok=True)
+        ids = [int(i.split('.')[0]) for i in os.listdir(folder)
+               if i.split('.')[0].isdigit()]
+        cluster = max(ids, default=0) + 1
+        while True:
+            state_file = os.path.join(folder, '%d.state.json' % cluster)
+            try:
+                os.close(os.open(state_file, os.O_CREAT | os.O_EXCL))
+                return cluster, state_file
+            except FileExistsError:
+                cluster += 1
+
+    def submit(self, input_path, job_name, limit=None, trials=5, *args,
+               **kwargs):
+        '''Start the jobs of the job list.
+        Args:
+            input_path (string): The input path to hold the input files
+            job_name (string): The job name, the study path is its folder
+            limit (int): Not used, all the jobs are queued at once
+            trials (int): Not used
+            return(tuple): (status, out), out maps the tasks to their job id
+        '''
+        input_path = str(input_path)
+        joblist = os.path.join(input_path, 'job_id.list')
+        desc_file = os.path.join(input_path, self.desc_name)
+        if not os.path.isfile(joblist) or not os.path.isfile(desc_file):
+            content = "There isn't %s job for submission!" % job_name
+            self._logger.warning(content)
+            return False, None
+        with open(joblist, 'r') as f_in:
+            task_ids = f_in.read().split()
+        with open(desc_file, 'r') as f_in:
+            batch = json.load(f_in)
+        study_path = os.path.dirname(job_name)
+        cluster, state_file = self._new_cluster(study_path)
+        out = dict((task, '%d.%d' % (cluster, i))
+                   for i, task in enumerate(task_ids))
+        jobs = dict((uid, [jobtracker.IDLE, job_name, task])
+                    for task, uid in out.items())
+        localrun.write_state(state_file, {'pid': None, 'jobs': jobs})
+        batch['order'] = [out[task] for task in task_ids]
+        batch['state_file'] = state_file
+        batch['cancel_file'] = state_file.replace('.state.json', '.cancel')
+        batch['max_workers'] = self.max_workers
+        batch['pin_cpus'] = self.pin_cpus
+        batch['scratch'] = self.scratch
+        batch_file = state_file.replace('.state.json', '.batch.json')
+        with open(batch_file, 'w') as f_out:
+            json.dump(batch, f_out)
+        try:
+            if self.detach:
+                log = open(batch_file.replace('.batch.json', '.log'), 'w')
+                Popen([sys.executable, '-m', 'pysixdesk.lib.localrun',
+                       batch_file], cwd=utils.PYSIXDESK_ABSPATH, stdout=log,
+                      stderr=log, start_new_session=True)
+                log.close()
+            else:
+                localrun.BatchRunner(batch_file).run()
+        except Exception as e:
+            self._logger.error(e, exc_info=True)
+            os.remove(state_file)
+            return False, None
+        self._snapshots.clear()
+        os.remove(joblist)
+        content = "Started %d local jobs with %d workers." % (
+            len(task_ids), self.max_workers)
+        self._logger.info(content)
+        return True, out
+
+    def _batches(self, study_path):
+        '''The state files of the batches of the study'''
+        folder = os.path.join(study_path, self.batch_dir)
+        if not os.path.isdir(folder):
+            return []
+        return [os.path.join(folder, i) for i in sorted(os.listdir(folder))
+                if i.endswith('.state.json')]
+
+    @staticmethod
+    def _alive(pid):
+        if pid is None:
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _snapshot(self, study_path, unique_ids=None):
+        '''The states of the local jobs, the unfinished jobs of a dead runner
+        are reported as removed'''
+        jobs = {}
+        for state_file in self._batches(study_path):
+            state = localrun.read_state(state_file)
+            alive = self._alive(state.get('pid'))
+            for uid, (status, batch, task) in state['jobs'].items():
+                if not alive and status in jobtracker.UNFINISHED:
+                    status = jobtracker.REMOVED
+                jobs[uid] = (status, batch, task)
+        return StatusSnapshot(jobs)
+
+    def check_running(self, studypath, unique_ids=None):
+        '''Check the unfinished jobs
+        Args:
+            studypath (string): The absolute path of the study
+            return(list): The unique id (cluster.index) list
+        '''
+        return self.status_snapshot(studypath, unique_ids,
+                                    refresh=True).unfinished()
+
+    def download_from_spool(self, study_path, *args, **kwargs):
+        '''The outputs are written in place, nothing to download'''
+        return True
+
+    def remove(self, study_path, status, *args, **kwargs):
+        '''Cancel the jobs with the given status, the finished batches are
+        forgotten with status 4 (done)'''
+        if status not in [0, 1, 2, 3, 4, 5, 6]:
+            self._logger.error("Unknown job status %s!" % status)
+            return False
+        for state_file in self._batches(study_path):
+            state = localrun.read_state(state_file)
+            states = [i[0] for i in state['jobs'].values()]
+            if status == 4:
+                if all(i not in jobtracker.UNFINISHED for i in states):
+                    prefix = state_file[:-len('.state.json')]
+                    for suffix in ['.state.json', '.batch.json', '.log',
+                                   '.cancel']:
+                        if os.path.exists(prefix + suffix):
+                            os.remove(prefix + suffix)
+            elif status in states:
+                cancel = state_file.replace('.state.json', '.cancel')
+                open(cancel, 'w').close()
+        self._snapshots.clear()
+        return True
@@ -0,0 +1,126 @@
+'''Rendering of the input templates (MAD-X masks, fort.3).
+
+The placeholders of a template are a '%' followed by the name of a
+parameter, e.g. %SEEDRAN or %turnss. A template is tokenized once into its
+literal parts and placeholder tokens, the tokens are matched to the longest
+parameter name they start with, so that %turnss2 isn't clobbered by
+turnss, and the output is built in a single pass. The values aren't
+scanned again, a value containing '%' is written as is.
+
+The compiled templates are cached on the hash of their content, the masks
+and fort.3 files are rendered many times with different parameters.
+'''
+import re
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# a placeholder token, the name is matched to the parameters when rendering
+PLACEHOLDER_RE = re.compile(r'%([A-Za-z_][A-Za-z0-9_]*)')
+
+# number of compiled templates kept
+CACHE_SIZE = 32
+
+_templates = OrderedDict()
+
+
+class Template(object):
+    '''A compiled template'''
+
+    def __init__(self, text):
+        self.text = text
+        parts = PLACEHOLDER_RE.split(text)
+        # literal, token, literal, ..., literal
+        self._literals = parts[0::2]
+        self._tokens = parts[1::2]
+        # resolution of the tokens per set of parameter names
+        self._plans = {}
+
+    @property
+    def tokens(self):
+        '''The distinct placeholder tokens, without the %'''
+        return set(self._tokens)
+
+    def _plan(self, names):
+        '''Match the tokens to the longest parameter names they start with.
+
+        Returns:
+            list: (name, rest of the token) per token, None if not matched.
+        '''
+        names = frozenset(names)
+        plan = self._plans.get(names)
+        if plan is None:
+            resolved = {}
+            for token in set(self._tokens):
+                resolved[token] = None
+                for i in range(len(token), 0, -1):
+                    if token[:i] in names:
+                        resolved[token] = (token[:i], token[i:])
+                        break
+            plan = [resolved[i] for i in self._tokens]
+            self._plans[names] = plan
+        return plan
+
+    def unresolved(self, names):
+        '''The tokens without matching parameter, left as is in the output'''
+        return sorted(set(token for token, match in
+                          zip(self._tokens, self._plan(names))
+                          if match is None))
+
+    def render(self, values):
+        '''Render the template.
+
+        Args:
+            values (dict): parameter name -> value, written with str.
+
+        Returns:
+            str: the rendered text.
+        '''
+        plan = self._plan(values.keys())
+        out = [self._literals[0]]
+        for token, match, literal in zip(self._tokens, plan,
+                                         self._literals[1:]):
+            if match is None:
+                out.append('%' + token)
+            else:
+                out.append(str(values[match[0]]))
+                out.append(match[1])
+            out.append(literal)
+        return ''.join(out)
+
+    def render_many(self, rows, names=None):
+        '''Render the template for many parameter sets.
+
+        Args:
+            rows (list): dicts of values, or sequences of values in the order
+            of names.
+            names (list): the parameter names of sequence rows.
+
+        Returns:
+            list: the rendered texts.
+        '''
+        if names is not None:
+            rows = [dict(zip(names, row)) for row in rows]
+        return [self.render(row) for row in rows]
+
+
+def compile_text(text):
+    '''The compiled template of a text, cached on its hash'''
+    key = hashlib.sha1(text.encode()).hexdigest()
+    template = _templates.get(key)
+    if template is None:
+        template = Template(text)
+        _templates[key] = template
+        if len(_templates) > CACHE_SIZE:
+            _templates.popitem(last=False)
+    else:
+        _templates.move_to_end(key)
+    return template
+
+
+def load(path):
+    '''The compiled template of a file'''
+    with open(path, 'r') as f_in:
+        return compile_text(f_in.read())
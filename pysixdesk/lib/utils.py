@@ -1,5 +1,4 @@
 import os
-import io
 import re
 import sys
 import gzip
@@ -7,6 +6,10 @@ import shutil
 import logging
 import difflib
 
+from . import template
+from . import compression
+from . import outputs
+
 # Gobal variables
 PYSIXDESK_ABSPATH = os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__))))
@@ -38,9 +41,11 @@ def check(files):
     return status
 
 
-def download_output(filenames, dest, zp=True):
+def download_output(filenames, dest, zp=True, workers=None, levels=None):
     '''Download the requested files to the given destinaion.
-    If zp is true, then zip the files before download.
+    If zp is true, then zip the files before download, in workers threads
+    (the cpus of the slot if None) with the levels of outputs.LEVELS, and
+    write the manifest of the files.
     '''
     if not os.path.isdir(dest):
         os.makedirs(dest, 0o755)
@@ -49,13 +54,13 @@ def download_output(filenames, dest, zp=True):
         if not os.path.isfile(filename):
             content = "The file %s doesn't exist, download failed!" % filename
             raise FileNotFoundError(content)
-        if os.path.isfile(filename):
-            if zp:
-                out_name = os.path.join(dest, filename + '.gz')
-                with open(filename, 'rb') as f_in, gzip.open(out_name, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            else:
-                shutil.copy(filename, dest)
+    if zp:
+        if workers is None:
+            workers = slot_cpus()
+        outputs.compress_files(filenames, dest, workers, levels)
+    else:
+        for filename in filenames:
+            shutil.copy(filename, dest)
 
 
 def check_fort3_block(fort3, block):
@@ -76,15 +81,23 @@ def replace(patterns, replacements, source, dest):
     if not os.path.isfile(source):
         raise FileNotFoundError("The file %s doesn't exist!" % source)
 
-    fin = open(source, 'r')
-    fout = open(dest, 'w')
-    num = len(patterns)
-    for line in fin:
-        for i in range(num):
-            line = re.sub(patterns[i], str(replacements[i]), line)
-        fout.write(line)
-    fin.close()
-    fout.close()
+    with open(source, 'r') as fin:
+        text = fin.read()
+    with open(dest, 'w') as fout:
+        fout.write(replace_text(patterns, replacements, text))
+
+
+def replace_text(patterns, replacements, text):
+    '''Replaces patterns with replacements in the whole text.
+    The %name placeholders are rendered in a single pass, see template.py,
+    other patterns are applied one after the other as regular expressions.'''
+    names = [i[1:] for i in patterns if template.PLACEHOLDER_RE.fullmatch(i)]
+    if len(names) == len(patterns):
+        values = dict(zip(names, replacements))
+        return template.compile_text(text).render(values)
+    for pattern, replacement in zip(patterns, replacements):
+        text = re.sub(pattern, str(replacement), text)
+    return text
 
 
 def diff(file1, file2, logger=None, **kwargs):
@@ -121,64 +134,94 @@ def diff(file1, file2, logger=None, **kwargs):
         display(f'▲▲▲▲▲▲▲▲▲▲▲▲▲ {file1} --> {file2} diff ▲▲▲▲▲▲▲▲▲▲▲▲▲')
 
 
-def compress_buf(data, source='file'):
+def compress_buf(data, source='file', codec=None):
     '''Data compression for storing in database
-    The data source can be file,gzip,str'''
-    zbuf = io.BytesIO()
+    The data source can be file,gzip,str,bytes
+
+    Args:
+        data (str/bytes): file path, string or bytes to compress.
+        source (str): type of the data source.
+        codec (str, optional): codec specification, e.g. 'zstd:3', see
+        compression.parse_spec. If None, the legacy gzip format is kept.
+    '''
+    name, _ = compression.parse_spec(codec)
     if source == 'file' and os.path.isfile(data):
-        with gzip.GzipFile(mode='wb', fileobj=zbuf) as zfile:
-            with open(data, 'rb') as f_in:
-                buf = f_in.read()
-                zfile.write(buf)
+        with open(data, 'rb') as f_in:
+            buf = f_in.read()
     elif source == 'gzip' and os.path.isfile(data):
         with open(data, 'rb') as f_in:
-            shutil.copyfileobj(f_in, zbuf)
+            buf = f_in.read()
+        if name == compression.LEGACY:
+            # already in the requested format
+            return buf
+        buf = gzip.decompress(buf)
     elif source == 'str' and isinstance(data, str):
         buf = data.encode()
-        with gzip.GzipFile(mode='wb', fileobj=zbuf) as zfile:
-            zfile.write(buf)
+    elif source == 'bytes' and isinstance(data, bytes):
+        buf = data
     else:
         raise ValueError("Invalid data source!")
-    return zbuf.getvalue()
+    return compression.compress(buf, codec)
 
 
 def decompress_buf(buf, out, des='file'):
-    '''Data decompression to retrieve from database'''
+    '''Data decompression to retrieve from database, the codec is detected
+    from the blob header, blobs without header are legacy gzip streams'''
     if not isinstance(buf, bytes):
         raise TypeError('"buf" must be bytes.')
     if des not in ['file', 'buf']:
         raise ValueError('"des" must be "file" or "buf".')
 
-    zbuf = io.BytesIO(buf)
+    data = compression.decompress(buf)
     if des == 'file':
-        with gzip.GzipFile(fileobj=zbuf) as f_in:
-            with open(out, 'wb') as f_out:
-                f_out.write(f_in.read())
+        with open(out, 'wb') as f_out:
+            f_out.write(data)
     elif des == 'buf':
-        with gzip.GzipFile(fileobj=zbuf) as f_in:
-            out = f_in.read()
-            out = out.decode()
+        out = data.decode()
     return out
 
 
 def concatenate_files(source, dest, ignore='ENDE'):
     '''Concatenate the given files'''
-    f_out = open(dest, 'w')
-    endline = ignore + '\n'
     if not isinstance(source, list):
         source = [source]
+    texts = []
     for s_in in source:
         with open(s_in, 'r') as f_in:
-            lines = f_in.readlines()
-            valid_lines = []
-            for line in lines:
-                if line.lower().startswith(ignore.lower()):
-                    endline = line
-                    break
-                valid_lines.append(line)
-            f_out.writelines(valid_lines)
-    f_out.writelines(endline)
-    f_out.close()
+            texts.append(f_in.read())
+    with open(dest, 'w') as f_out:
+        f_out.write(concatenate_texts(texts, ignore))
+
+
+def concatenate_texts(texts, ignore='ENDE'):
+    '''Concatenate the given texts, each one up to its ignore line, the last
+    ignore line found closes the result'''
+    endline = ignore + '\n'
+    valid_lines = []
+    for text in texts:
+        for line in text.splitlines(True):
+            if line.lower().startswith(ignore.lower()):
+                endline = line
+                break
+            valid_lines.append(line)
+    return ''.join(valid_lines) + endline
+
+
+def chunks(items, size):
+    '''Split a sequence into consecutive chunks, preserving the order.
+
+    Args:
+        items (list): The sequence to split.
+        size (int): The maximum length of the chunks.
+
+    Returns:
+        list: The chunks.
+    '''
+    size = int(size)
+    if size <= 0:
+        raise ValueError("The chunk size must be positive!")
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
 
 def exc_catch(fun, exc_action=None, *args, **kwargs):
@@ -235,3 +278,34 @@ def condor_logger(name):
     logger.addHandler(h2)
     logger.setLevel(logging.DEBUG)
     return logger
+
+
+def machine_ad_value(name):
+    '''The integer attribute of the HTCondor machine ad of the slot, None if
+    unknown.'''
+    machine_ad = os.environ.get('_CONDOR_MACHINE_AD')
+    if machine_ad and os.path.isfile(machine_ad):
+        with open(machine_ad, 'r') as f_in:
+            for line in f_in:
+                match = re.match(r'^%s\s*=\s*(\d+)\s*$' % name, line)
+                if match:
+                    return int(match.group(1))
+    return None
+
+
+def slot_cpus():
+    '''The number of cpus of the slot: the Cpus of the HTCondor machine ad,
+    OMP_NUM_THREADS (set by HTCondor to the allocated cpus) or 1.'''
+    cpus = machine_ad_value('Cpus')
+    if cpus is not None:
+        return max(cpus, 1)
+    try:
+        return max(int(os.environ.get('OMP_NUM_THREADS', 1)), 1)
+    except ValueError:
+        return 1
+
+
+def slot_memory():
+    '''The memory of the slot (MB): the Memory of the HTCondor machine ad,
+    None if unknown.'''
+    return machine_ad_value('Memory')
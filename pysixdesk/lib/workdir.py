@@ -0,0 +1,336 @@
+'''Working folders of the SixTrack runs on fast local storage.
+
+SixTrack reads and writes its fort.* files many times during a run, the
+initial folder of the job is often on a network or spool disk. WorkDir
+places the run folder following a policy:
+
+- 'scratch' (the default): in the node-local scratch folder,
+  _CONDOR_SCRATCH_DIR, TMPDIR or /tmp,
+- 'shm': in /dev/shm (memory), for the small runs,
+- 'cwd': in the current folder, the former behaviour,
+- 'auto': the first of shm, scratch and cwd with enough free space.
+
+The needed space is estimated from the inputs, with a margin for the
+outputs. The files in /dev/shm are charged to the memory of the job and
+the outputs aren't bounded by the margin, so a run folder there may only
+take a part of the Memory of the slot (from the HTCondor machine ad), and
+'auto' skips shm when the slot memory is unknown.
+
+The inputs are hardlinked when on the same file system, reflinked (copy on
+write) when supported, copied otherwise, and the outputs are moved back
+atomically. The time spent staging the files in and out is logged.
+
+The temporary folders hold a lock (LOCK) while in use, the folders of the
+killed jobs, whose lock is free, are removed when a new one is created.
+'''
+import os
+import time
+import errno
+import fcntl
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+
+from pysixdesk.lib.utils import slot_memory
+
+POLICIES = ['auto', 'shm', 'scratch', 'cwd']
+SHM = '/dev/shm'
+PREFIX = 'pysixdesk_'
+LOCK = '.pysixdesk.lock'
+
+# space kept for the outputs of a run (MB)
+MARGIN = 64
+# part of the memory of the slot which a run folder in /dev/shm may take,
+# its files are charged to the memory of the job
+SHM_RATIO = 0.25
+
+# the ioctl cloning a file on copy on write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def scratch_root():
+    '''The node-local scratch folder'''
+    for var in ['_CONDOR_SCRATCH_DIR', 'TMPDIR']:
+        root = os.environ.get(var)
+        if root and os.path.isdir(root):
+            return root
+    return tempfile.gettempdir()
+
+
+def free_space(path):
+    '''The free space of the file system of the path (MB)'''
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize / 1024**2
+
+
+def reflink(source, dest):
+    '''Clone a file, raises OSError if not supported'''
+    with open(source, 'rb') as f_in, open(dest, 'wb') as f_out:
+        try:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        except OSError:
+            f_out.close()
+            os.remove(dest)
+            raise
+    shutil.copystat(source, dest)
+
+
+def stage_file(source, dest):
+    '''Hardlink, reflink or copy a file.
+
+    Returns:
+        str: the method used.
+    '''
+    try:
+        os.link(source, dest)
+        return 'link'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    try:
+        reflink(source, dest)
+        return 'reflink'
+    except (OSError, ImportError):
+        shutil.copy2(source, dest)
+        return 'copy'
+
+
+def move_file(source, dest):
+    '''Move a file, atomically replacing the destination'''
+    try:
+        os.replace(source, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # across file systems, copy next to the destination then rename
+    fd, tmp = tempfile.mkstemp(prefix=f'.{Path(dest).name}.',
+                               dir=Path(dest).parent)
+    os.close(fd)
+    try:
+        shutil.copy2(source, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.remove(source)
+
+
+def lock_folder(path):
+    '''Lock a temporary folder while in use.
+
+    Returns:
+        file: the lock file, the lock is released when closed.
+    '''
+    f_lock = open(os.path.join(path, LOCK), 'w')
+    fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return f_lock
+
+
+def clean_stale(root, logger=None):
+    '''Remove the temporary folders of the killed jobs in root, those whose
+    lock is free. The folders without a lock are kept.
+
+    Returns:
+        list: the removed folders.
+    '''
+    removed = []
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return removed
+    for entry in entries:
+        if not entry.name.startswith(PREFIX):
+            continue
+        try:
+            if (not entry.is_dir(follow_symlinks=False) or
+                    entry.stat().st_uid != os.getuid()):
+                continue
+            with open(os.path.join(entry.path, LOCK), 'r') as f_lock:
+                fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            # in use, or without a lock
+            continue
+        removed.append(entry.path)
+    if removed:
+        content = "Removed %d stale work dirs in %s." % (len(removed), root)
+        (logger or logging.getLogger(__name__)).info(content)
+    return removed
+
+
+class WorkDir(object):
+    '''A temporary run folder, see the module documentation'''
+
+    def __init__(self, name='temp', inputs=(), policy='scratch', size=None,
+                 parent=None, logger=None):
+        '''Constructor.
+
+        Args:
+            name (str): name of the folder, the prefix of the temporary
+            folder outside of the parent folder.
+            inputs (list): names of the input files in the parent folder,
+            staged in the folder.
+            policy (str): the placement policy, see POLICIES.
+            size (float): the space needed by the run (MB), estimated from
+            the inputs if None.
+            parent (str/path): the folder of the inputs and outputs, the
+            current folder if None.
+            logger: the logger of the job.
+
+        Raises:
+            ValueError: if the policy is unknown.
+        '''
+        if policy not in POLICIES:
+            content = "Unknown work dir policy %s, must be one of %s!" % (
+                policy, ', '.join(POLICIES))
+            raise ValueError(content)
+        self.name = name
+        self.inputs = list(inputs)
+        self.policy = policy
+        self.size = size
+        self.parent = Path(parent or Path.cwd()).absolute()
+        self._logger = logger or logging.getLogger(__name__)
+        self.path = None
+        self.location = None
+        self._lock = None
+        # direction -> [files, bytes, seconds]
+        self.io = {'in': [0, 0, 0.0], 'out': [0, 0, 0.0]}
+
+    def _needed(self):
+        if self.size is not None:
+            return float(self.size)
+        n_bytes = 0
+        for name in self.inputs:
+            try:
+                n_bytes += os.path.getsize(self.parent / name)
+            except OSError:
+                pass
+        return n_bytes / 1024**2 + MARGIN
+
+    def _shm_limit(self):
+        '''The space a run folder in /dev/shm may take (MB), None if not
+        usable'''
+        if not os.access(SHM, os.W_OK):
+            return None
+        free = free_space(SHM)
+        memory = slot_memory()
+        if memory is not None:
+            return min(free, memory * SHM_RATIO)
+        if self.policy == 'shm':
+            # asked for, bounded by the node only
+            return free * SHM_RATIO
+        return None
+
+    def _candidates(self):
+        if self.policy in ['auto', 'shm']:
+            yield 'shm', SHM
+        if self.policy in ['auto', 'scratch']:
+            yield 'scratch', scratch_root()
+        if self.policy in ['auto', 'cwd']:
+            yield 'cwd', None
+
+    def _create(self):
+        needed = self._needed()
+        for location, root in self._candidates():
+            if root is None:
+                path = self.parent / self.name
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                path.mkdir()
+                return location, path
+            try:
+                if location == 'shm':
+                    free = self._shm_limit()
+                else:
+                    free = free_space(root)
+                if free is None or free < needed:
+                    continue
+                clean_stale(root, self._logger)
+                path = tempfile.mkdtemp(prefix=f'{PREFIX}{self.name}_',
+                                        dir=root)
+            except OSError:
+                continue
+            try:
+                self._lock = lock_folder(path)
+            except OSError:
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            return location, Path(path)
+        content = "No space for the work dir (%.0f MB) with policy %s!" % (
+            needed, self.policy)
+        raise OSError(content)
+
+    def __enter__(self):
+        self.location, self.path = self._create()
+        try:
+            self.stage_in(self.inputs)
+        except BaseException:
+            self._release()
+            raise
+        return self
+
+    def stage_in(self, names):
+        '''Stage the files of the parent folder in the folder.
+
+        Raises:
+            FileNotFoundError: if an input file is missing.
+        '''
+        start = time.perf_counter()
+        for name in names:
+            source = self.parent / name
+            if not source.is_file():
+                msg = f"The required input file {name} was not found!"
+                raise FileNotFoundError(msg)
+            dest = self.path / name
+            if dest.is_symlink() or dest.exists():
+                dest.unlink()
+            stage_file(source, dest)
+            self.io['in'][0] += 1
+            self.io['in'][1] += source.stat().st_size
+        self.io['in'][2] += time.perf_counter() - start
+
+    def move_out(self, names):
+        '''Move the files of the folder back to the parent folder, the
+        missing files and the inputs written in place are skipped.
+
+        Returns:
+            list: the moved files.
+        '''
+        start = time.perf_counter()
+        moved = []
+        for name in names:
+            source = self.path / name
+            dest = self.parent / name
+            if not source.is_file():
+                continue
+            if dest.exists() and os.path.samefile(source, dest):
+                # a hardlinked input, already up to date
+                continue
+            if dest.is_symlink():
+                dest.unlink()
+            n_bytes = source.stat().st_size
+            move_file(source, dest)
+            self.io['out'][0] += 1
+            self.io['out'][1] += n_bytes
+            moved.append(name)
+        self.io['out'][2] += time.perf_counter() - start
+        return moved
+
+    def _release(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    def __exit__(self, *exc):
+        self._release()
+        content = ("Work dir in %s (%s): staged in %d files (%.1f MB) in "
+                   "%.2f s, out %d files (%.1f MB) in %.2f s." % (
+                       self.location, self.path, self.io['in'][0],
+                       self.io['in'][1] / 1024**2, self.io['in'][2],
+                       self.io['out'][0], self.io['out'][1] / 1024**2,
+                       self.io['out'][2]))
+        self._logger.info(content)
+        return False
@@ -0,0 +1,60 @@
+import unittest
+import shutil
+import os
+import sys
+import subprocess
+from pathlib import Path
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import bundle
+
+
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/bundle/').absolute()
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.script = Path(pysixdesk_path, 'pysixdesk/lib/sixtrack.py')
+        self.env = dict(os.environ)
+        self.env.pop('PYTHONPATH', None)
+
+    def test_required_modules(self):
+        modules = bundle.required_modules(self.script)
+        for name in ['pysixdesk', 'pysixdesk.lib', 'pysixdesk.lib.pysixdb',
+                     'pysixdesk.lib.dbadaptor', 'pysixdesk.lib.fort3']:
+            self.assertIn(name, modules)
+        for name in ['pysixdesk.lib.study', 'pysixdesk.lib.submission']:
+            self.assertNotIn(name, modules)
+
+    def test_build(self):
+        pyz = bundle.build(self.script, self.test_folder)
+        mtime = os.path.getmtime(pyz)
+        self.assertEqual(bundle.build(self.script, self.test_folder), pyz)
+        self.assertEqual(os.path.getmtime(pyz), mtime)
+        self.assertIsNone(bundle.build(self.test_folder / 'x.py',
+                                       self.test_folder))
+        # runs on its own, out of the source folder
+        out = subprocess.run([sys.executable, pyz, '--help'],
+                             cwd=self.test_folder, env=self.env,
+                             stdout=subprocess.PIPE)
+        self.assertEqual(out.returncode, 0)
+        self.assertIn(b'input_info', out.stdout)
+
+    def test_lazy_package(self):
+        code = ('import sys, pysixdesk.lib.sixtrack; '
+                'assert "pysixdesk.lib.study" not in sys.modules; '
+                'assert "pymysql" not in sys.modules; '
+                'from pysixdesk import Study; '
+                'assert "pysixdesk.lib.study" in sys.modules')
+        out = subprocess.run([sys.executable, '-c', code],
+                             cwd=pysixdesk_path, env=self.env)
+        self.assertEqual(out.returncode, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
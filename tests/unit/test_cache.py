@@ -0,0 +1,112 @@
+import unittest
+import shutil
+import struct
+import gzip
+import subprocess
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib.cache import NodeCache, cacheable
+
+
+class NodeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/cache/').absolute()
+        self.work = self.test_folder / 'work'
+        self.work.mkdir(parents=True, exist_ok=True)
+        self.fetched = 0
+
+    def elf(self, path, rpath=b'/usr/lib'):
+        '''Write a minimal 64 bits ELF file with a runpath'''
+        dynstr = b'\0' + rpath + b'\0' * (8 - len(rpath) % 8)
+        dynamic = struct.pack('<qQqQ', 29, 1, 0, 0)
+        shoff = 64 + len(dynstr) + len(dynamic)
+        header = struct.pack('<HHIQQQIHHHHHH', 2, 62, 1, 0, 0, shoff, 0, 64,
+                             0, 0, 64, 3, 0)
+        sections = [(0, 0, 0, 0), (3, 64, len(dynstr), 0),
+                    (6, 64 + len(dynstr), len(dynamic), 1)]
+        with open(path, 'wb') as f_out:
+            f_out.write(b'\x7fELF\x02\x01\x01' + b'\0' * 9 + header[:48])
+            f_out.write(dynstr + dynamic)
+            for sh_type, offset, size, link in sections:
+                f_out.write(struct.pack('<IIQQQQIIQQ', 0, sh_type, 0, 0,
+                                        offset, size, link, 0, 8, 0))
+        path.chmod(0o755)
+        return path
+
+    def fetcher(self, *contents):
+        def fetch():
+            self.fetched += 1
+            return [gzip.compress(i) for i in contents]
+        return fetch
+
+    def test_get(self):
+        cache = NodeCache(self.test_folder / 'cache')
+        names = ['fort.2', 'fort.8']
+        fetch = self.fetcher(b'two', b'eight')
+        key = cache.get(names, fetch, self.work, alias='pre_1')
+        self.assertEqual((self.work / 'fort.2').read_bytes(), b'two')
+        # the alias avoids fetching the buffers again
+        other = self.test_folder / 'other'
+        other.mkdir()
+        self.assertEqual(cache.get(names, fetch, other, alias='pre_1'), key)
+        self.assertEqual(self.fetched, 1)
+        self.assertEqual((other / 'fort.8').stat().st_nlink, 3)
+        # the same content under another alias shares the entry
+        self.assertEqual(cache.get(names, fetch, other, alias='pre_2'), key)
+        self.assertEqual(len(cache.size()), 1)
+
+    def test_evict(self):
+        cache = NodeCache(self.test_folder / 'cache', max_size=1E-3)
+        first = cache.get(['a'], self.fetcher(b'x' * 800), self.work)
+        second = cache.get(['b'], self.fetcher(b'y' * 800), self.work)
+        # the least recently used entry is evicted
+        self.assertEqual(list(cache.size().keys()), [second])
+        self.assertNotEqual(first, second)
+        # the linked files survive the eviction
+        self.assertEqual((self.work / 'a').read_bytes(), b'x' * 800)
+
+    def test_executable(self):
+        cache = NodeCache(self.test_folder / 'cache', max_size=1E-3)
+        exe = self.elf(self.work / 'madx')
+        with cache.executable(exe) as local:
+            self.assertNotEqual(local, str(exe))
+            self.assertEqual(Path(local).read_bytes(), exe.read_bytes())
+            # the copy in use isn't evicted
+            cache.get(['a'], self.fetcher(b'x' * 800), self.work)
+            self.assertTrue(Path(local).is_file())
+        with cache.executable(exe) as again:
+            self.assertEqual(again, local)
+        # not found, run as given
+        with cache.executable('no_such_exe') as local:
+            self.assertEqual(local, 'no_such_exe')
+
+    def test_executable_in_place(self):
+        cache = NodeCache(self.test_folder / 'cache')
+        # a wrapper script running a sibling file
+        (self.work / 'sixtrack.real').write_text('echo tracked\n')
+        exe = self.work / 'sixtrack'
+        exe.write_text('#!/bin/sh\n. "$(dirname "$0")/sixtrack.real"\n')
+        exe.chmod(0o755)
+        self.assertFalse(cacheable(exe))
+        with cache.executable(exe) as local:
+            self.assertEqual(local, str(exe))
+            out = subprocess.run([local], stdout=subprocess.PIPE, check=True)
+            self.assertEqual(out.stdout, b'tracked\n')
+        # the libraries next to the binary
+        origin = self.elf(self.work / 'madx', rpath=b'$ORIGIN/../lib')
+        with cache.executable(origin) as local:
+            self.assertEqual(local, str(origin))
+        self.assertTrue(cacheable(self.elf(self.work / 'other')))
+        self.assertEqual(cache.size(), {})
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
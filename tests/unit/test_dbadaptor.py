@@ -64,6 +64,46 @@ class SQLDatabaseAdaptorTest(unittest.TestCase):
         out_select = self.db.select(self.conn, self.name)
         self.assertEqual(out_select, out)
 
+    def test_sqldb_profiles(self):
+        self.db.setting(self.conn, 'interactive')
+        out = self.db.current_settings(self.conn, ['journal_mode',
+                                                   'synchronous',
+                                                   'auto_vacuum'])
+        self.assertEqual(out, {'journal_mode': 'wal', 'synchronous': 1,
+                               'auto_vacuum': 2})
+        previous = self.db.current_settings(self.conn, 'bulk-load')
+        self.db.setting(self.conn, 'bulk-load')
+        out = self.db.current_settings(self.conn, ['journal_mode',
+                                                   'synchronous'])
+        self.assertEqual(out, {'journal_mode': 'wal', 'synchronous': 0})
+        self.db.setting(self.conn, previous)
+        out = self.db.current_settings(self.conn, ['synchronous'])
+        self.assertEqual(out, {'synchronous': 1})
+        with self.assertRaises(ValueError):
+            self.db.setting(self.conn, 'unknown')
+        self.db.vacuum(self.conn)
+
+    def test_sqldb_migrate(self):
+        # databases created with the historical settings and without
+        # auto_vacuum, the latter is rebuilt
+        for profile in ['legacy', 'portable']:
+            self.db.setting(self.conn, profile)
+            self.db.create_table(self.conn, self.name, {'a': 'INT'}, {},
+                                 True)
+            self.db.insert(self.conn, self.name, {'a': 1})
+            self.conn.close()
+            self.conn = self.db.new_connection(self.db_name)
+            self.db.setting(self.conn, 'rollback')
+            out = self.db.current_settings(self.conn, ['journal_mode',
+                                                       'synchronous',
+                                                       'auto_vacuum'])
+            self.assertEqual(out, {'journal_mode': 'delete',
+                                   'synchronous': 1, 'auto_vacuum': 2})
+            self.assertEqual(self.db.select(self.conn, self.name), [(1,)])
+            self.conn.close()
+            Path(self.db_name).unlink()
+            self.conn = self.db.new_connection(self.db_name)
+
     def tearDown(self):
         self.conn.close()
         shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
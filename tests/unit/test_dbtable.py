@@ -0,0 +1,42 @@
+import unittest
+import sys
+from fractions import Fraction
+from pathlib import Path
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib.dbtable import Table
+
+
+class TableTest(unittest.TestCase):
+
+    def test_split_vector(self):
+        self.assertEqual(Table.split_vector('(8, 10)', 2), [8, 10])
+        self.assertEqual(Table.split_vector([8.5], 2), [8.5, None])
+        self.assertEqual(Table.split_vector((1, 'a', 3), 2), [1, None])
+        self.assertEqual(Table.split_vector('junk', 2), [None, None])
+        # any real number, e.g. the numpy scalars
+        self.assertEqual(Table.split_vector((Fraction(1, 2), True), 2),
+                         [0.5, None])
+
+    def test_split_vector_numpy(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        comps = Table.split_vector((np.int64(8), np.float32(10.5)), 2)
+        self.assertEqual(comps, [8, 10.5])
+        self.assertEqual([type(i) for i in comps], [int, float])
+
+    def test_sql_literal(self):
+        self.assertEqual(Table.sql_literal(8), '8')
+        self.assertEqual(Table.sql_literal(0.5), '0.5')
+        self.assertEqual(Table.sql_literal("it's"), "'it''s'")
+        with self.assertRaises(ValueError):
+            Table.sql_literal(None)
+        with self.assertRaises(ValueError):
+            Table.sql_literal('1; DROP TABLE x'.split())
+
+
+if __name__ == '__main__':
+    unittest.main()
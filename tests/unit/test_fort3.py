@@ -0,0 +1,57 @@
+import unittest
+import shutil
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import fort3
+from pysixdesk.lib import utils
+
+
+class Fort3Test(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/fort3/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.fort_file = ('GEOME-STRENG TITLE:%Runnam\n'
+                          'TRACKING PARAMETERS-----\n'
+                          '%turnss 0 1\n'
+                          'NEXT\n'
+                          '/ comment\n'
+                          'SYNC\n'
+                          '35640 .000347 16 0. %length\n'
+                          'NEXT\n'
+                          '%COLLENDE\n'
+                          'COLLIMATION\n'
+                          'NEXT\n'
+                          'ENDE\n')
+        self.madx_fc3 = 'MULT\nmb 1\nNEXT\nENDE====\n'
+        (self.test_folder / 'fort.3.aux').write_text(
+            'x\n a b c d 26658.8832 f\n')
+
+    def test_build(self):
+        builder = fort3.Fort3Builder(self.fort_file, self.madx_fc3)
+        values = {'Runnam': 'run', 'turnss': 100, 'COLL': '',
+                  'length': fort3.aux_length(self.test_folder / 'fort.3.aux')}
+        out = builder.build(values)
+        # same content as the concatenation of the rendered files
+        rendered = utils.replace_text(['%' + i for i in values],
+                                      list(values.values()), self.fort_file)
+        legacy = utils.concatenate_texts([rendered, self.madx_fc3])
+        self.assertEqual(out.text(), legacy)
+        self.assertEqual([i.name for i in out.blocks],
+                         ['GEOM', 'TRAC', None, 'SYNC', 'MULT'])
+        self.assertEqual(out.block('sync').lines[1],
+                         '35640 .000347 16 0. 26658.8832\n')
+        self.assertIsNone(out.block('COLL'))
+        out.write(self.test_folder / 'fort.3')
+        self.assertEqual((self.test_folder / 'fort.3').read_text(), legacy)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import shutil
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import jobtracker
+
+SUBMIT = '''000 (1234.000.000) 2020-03-02 10:00:00 Job submitted from host: <127.0.0.1:9618?addrs=127.0.0.1-9618>
+...
+'''
+EXECUTE = '''001 (1234.000.000) 2020-03-02 10:01:00 Job executing on host: <127.0.0.2:9618?addrs=127.0.0.2-9618>
+...
+006 (1234.000.000) 2020-03-02 10:06:00 Image size of job updated: 22000
+\t20  -  MemoryUsage of job (MB)
+\t19524  -  ResidentSetSize of job (KB)
+...
+'''
+TERMINATE = '''005 (1234.000.000) 2020-03-02 10:30:00 Job terminated.
+\t(1) Normal termination (return value 0)
+\t\tUsr 0 00:28:01, Sys 0 00:00:03  -  Run Remote Usage
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Run Local Usage
+\t1024  -  Run Bytes Sent By Job
+...
+'''
+HOLD = '''000 (1234.001.000) 2020-03-02 10:00:00 Job submitted from host: <127.0.0.1:9618?addrs=127.0.0.1-9618>
+...
+012 (1234.001.000) 2020-03-02 10:02:00 Job was held.
+\tError from slot1@node: Failed to execute
+\tCode 6 Subcode 2
+...
+'''
+
+
+class EventLogTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/jobtracker/')
+        self.job_folder = self.test_folder / 'sixtrack_output' / '1'
+        self.job_folder.mkdir(parents=True, exist_ok=True)
+        self.log = self.job_folder / 'htcondor.1234.0.log'
+        self.held_log = self.test_folder / 'sixtrack_output' / '2' / \
+            'htcondor.1234.1.log'
+        self.held_log.parent.mkdir(parents=True, exist_ok=True)
+
+    def test_parse_events(self):
+        events, length = jobtracker.parse_events(SUBMIT + EXECUTE +
+                                                 TERMINATE[:40])
+        self.assertEqual([i[0] for i in events], [0, 1, 6])
+        self.assertEqual(events[0][1], '1234.0')
+        self.assertEqual(length, len(SUBMIT + EXECUTE))
+
+    def test_update(self):
+        self.log.write_text(SUBMIT)
+        self.held_log.write_text(HOLD)
+        tracker = jobtracker.EventLogTracker(str(self.test_folder))
+        self.assertEqual(tracker.update(), 3)
+        self.assertEqual(tracker.status('1234.0'), jobtracker.IDLE)
+        self.assertEqual(tracker.select(jobtracker.HELD), ['1234.1'])
+        self.assertEqual(tracker.unknown(['1234.0', '1234.2']), ['1234.2'])
+
+        # incomplete event, only the complete ones are consumed
+        with open(self.log, 'a') as f_out:
+            f_out.write(EXECUTE + TERMINATE[:60])
+        self.assertEqual(tracker.update(), 2)
+        self.assertEqual(tracker.status('1234.0'), jobtracker.RUNNING)
+        self.assertEqual(tracker.update(), 0)
+
+        # the state is resumed from the stored offsets
+        with open(self.log, 'a') as f_out:
+            f_out.write(TERMINATE[60:])
+        tracker = jobtracker.EventLogTracker(str(self.test_folder))
+        self.assertEqual(tracker.update(), 1)
+        self.assertEqual(tracker.status('1234.0'), jobtracker.COMPLETED)
+        self.assertEqual(tracker.jobs['1234.0']['return_value'], 0)
+        self.assertEqual(sorted(tracker.select(jobtracker.UNFINISHED)),
+                         ['1234.1'])
+
+        # the jobs of the removed logs are forgotten
+        shutil.rmtree(self.job_folder)
+        tracker.update()
+        self.assertIsNone(tracker.status('1234.0'))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
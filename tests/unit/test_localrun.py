@@ -0,0 +1,127 @@
+import unittest
+import shutil
+import os
+from pathlib import Path
+from unittest import mock
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import submission, jobtracker, localrun
+
+EXE = '''import os
+import sys
+
+with open('input.txt') as f_in:
+    data = f_in.read()
+os.makedirs('results')
+with open(os.path.join('results', 'out.txt'), 'w') as f_out:
+    f_out.write('%s %s %s' % (sys.argv[1], sys.argv[2], data))
+print('done', sys.argv[1])
+'''
+
+
+class LocalClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/localrun/').absolute()
+        self.study = self.test_folder / 'study'
+        self.in_path = self.study / 'sixtrack_input'
+        self.out_path = self.study / 'sixtrack_output'
+        self.in_path.mkdir(parents=True, exist_ok=True)
+        self.out_path.mkdir(parents=True, exist_ok=True)
+        self.exe = self.in_path / 'worker.py'
+        self.exe.write_text(EXE)
+        self.trans = [self.in_path / 'input.txt']
+        self.trans[0].write_text('data')
+        self.scratch = self.test_folder / 'scratch'
+        self.scratch.mkdir()
+        self.cluster = submission.LocalCluster(max_workers=2, detach=False,
+                                               scratch=str(self.scratch))
+
+    def run_batch(self, task_ids):
+        self.cluster.prepare(task_ids, self.trans, self.exe, 'input.ini',
+                             str(self.in_path), str(self.out_path))
+        return self.cluster.submit(self.in_path,
+                                   str(self.study / 'sixtrack_1'))
+
+    def test_run(self):
+        status, out = self.run_batch([1, [2, 3]])
+        self.assertTrue(status)
+        self.assertEqual(sorted(out.keys()), ['1', '2-3'])
+        for task in ['1', '2-3']:
+            job_path = self.out_path / task
+            self.assertEqual((job_path / 'results' / 'out.txt').read_text(),
+                             '%s input.ini data' % task)
+            self.assertEqual((job_path / '_condor_stdout').read_text(),
+                             'done %s\n' % task)
+        snapshot = self.cluster.status_snapshot(str(self.study))
+        self.assertEqual(snapshot.task_state(3), jobtracker.COMPLETED)
+        self.assertEqual(self.cluster.check_running(str(self.study)), [])
+        # the temporary task folders are removed
+        self.assertEqual(os.listdir(self.scratch), [])
+        self.assertFalse((self.in_path / 'job_id.list').exists())
+        self.assertTrue(self.cluster.remove(str(self.study), 4))
+        self.assertEqual(self.cluster._batches(str(self.study)), [])
+
+    def test_held(self):
+        # the input file can't be transferred
+        status, out = self.run_batch([1])
+        self.assertTrue(status)
+        self.trans[0].unlink()
+        status, out = self.run_batch([2])
+        self.assertTrue(status)
+        snapshot = self.cluster.status_snapshot(str(self.study),
+                                                refresh=True)
+        self.assertEqual(snapshot.task_state(1), jobtracker.COMPLETED)
+        self.assertEqual(snapshot.task_state(2), jobtracker.HELD)
+        self.assertEqual(snapshot.unfinished(), [out['2']])
+        # once its runner is gone, the held job is reported as removed
+        state_file = self.cluster._batches(str(self.study))[-1]
+        state = localrun.read_state(state_file)
+        state['pid'] = self.dead_pid()
+        localrun.write_state(state_file, state)
+        snapshot = self.cluster.status_snapshot(str(self.study),
+                                                refresh=True)
+        self.assertEqual(snapshot.task_state(2), jobtracker.REMOVED)
+        self.assertFalse((self.out_path / '2' / 'results').exists())
+
+    def test_failed_setup(self):
+        # an error before the task runs doesn't leave it running
+        with mock.patch.object(localrun.tempfile, 'mkdtemp',
+                               side_effect=OSError('no scratch')):
+            status, out = self.run_batch([1, 2])
+        self.assertTrue(status)
+        snapshot = self.cluster.status_snapshot(str(self.study),
+                                                refresh=True)
+        self.assertEqual(snapshot.task_state(1), jobtracker.HELD)
+        self.assertEqual(snapshot.task_state(2), jobtracker.HELD)
+
+    @unittest.skipUnless(hasattr(os, 'sched_setaffinity'),
+                         "cpu affinity isn't supported")
+    def test_pin_cpus(self):
+        # the task reports the cpus it may run on
+        self.exe.write_text(EXE.replace(
+            "print('done', sys.argv[1])",
+            "print('done', sorted(os.sched_getaffinity(0)))"))
+        self.cluster.pin_cpus = True
+        self.run_batch([1])
+        cpus = sorted(os.sched_getaffinity(0))
+        self.assertEqual((self.out_path / '1' / '_condor_stdout').read_text(),
+                         'done [%d]\n' % cpus[0])
+
+    @staticmethod
+    def dead_pid():
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import shutil
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import memo
+
+
+class MemoTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/memo/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+
+    def test_madx_key(self):
+        exe = self.test_folder / 'madx'
+        exe.write_bytes(b'v1')
+        key = memo.madx_key('seed=1;', {'fort_file': b'x'}, [str(exe)],
+                            {'madx': {'oneturn': 'true'}})
+        self.assertEqual(key, memo.madx_key('seed=1;', {'fort_file': b'x'},
+                                            [str(exe)],
+                                            {'madx': {'oneturn': 'true'}}))
+        self.assertNotEqual(key, memo.madx_key('seed=2;',
+                                               {'fort_file': b'x'},
+                                               [str(exe)],
+                                               {'madx': {'oneturn': 'true'}}))
+        # a new executable at the same path
+        exe.write_bytes(b'version2')
+        self.assertNotEqual(key, memo.madx_key('seed=1;',
+                                               {'fort_file': b'x'},
+                                               [str(exe)],
+                                               {'madx': {'oneturn': 'true'}}))
+
+    def test_result_cache(self):
+        shared = memo.ResultCache(self.test_folder / 'shared')
+        self.assertIsNone(shared.get('abcd'))
+        results = {'oneturn_sixtrack_results': {'betax': [1.5],
+                                                'mtime': [1]}}
+        self.assertTrue(shared.put('abcd', {'fort_2': b'two'}, results))
+        self.assertFalse(shared.put('abcd', {'fort_2': b'other'}, {}))
+        self.assertIn('abcd', shared)
+        self.assertEqual(shared.get('abcd'), ({'fort_2': b'two'}, results))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import shutil
+import gzip
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import outputs
+from pysixdesk.lib import utils
+
+
+class OutputsTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/outputs/')
+        self.dest = self.test_folder / 'results'
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.files = {'fort.10': b'1 2 3\n' * 1000,
+                      'crpoint_pri.bin': bytes(range(256)) * 10,
+                      'fort.6': b'tracking\n' * 100,
+                      'already.gz': gzip.compress(b'data')}
+        for name, data in self.files.items():
+            (self.test_folder / name).write_bytes(data)
+
+    def test_compress(self):
+        names = [str(self.test_folder / i) for i in self.files]
+        utils.download_output(names, self.dest, workers=3)
+        manifest = outputs.read_manifest(self.dest / outputs.MANIFEST)
+        self.assertEqual(manifest['crpoint_pri.bin']['level'], 1)
+        self.assertEqual(manifest['fort.10']['level'], 6)
+        self.assertEqual(manifest['already.gz']['name'], 'already.gz')
+        self.assertEqual(manifest['already.gz']['level'], 0)
+        for name, data in self.files.items():
+            stored = self.dest / manifest[name]['name']
+            self.assertEqual(gzip.decompress(stored.read_bytes()),
+                             gzip.decompress(data)
+                             if name.endswith('.gz') else data)
+        self.assertEqual(outputs.verify(self.dest / outputs.MANIFEST), [])
+
+    def test_verify(self):
+        utils.download_output([str(self.test_folder / 'fort.10'),
+                               str(self.test_folder / 'fort.6')], self.dest)
+        # a truncated and a corrupted (same size) transfer
+        f10 = self.dest / 'fort.10.gz'
+        f10.write_bytes(f10.read_bytes()[:-1])
+        f6 = self.dest / 'fort.6.gz'
+        buf = bytearray(f6.read_bytes())
+        buf[-5] ^= 0xff
+        f6.write_bytes(bytes(buf))
+        self.assertEqual(sorted(outputs.verify(self.dest / outputs.MANIFEST)),
+                         ['fort.10.gz', 'fort.6.gz'])
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
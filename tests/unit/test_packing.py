@@ -0,0 +1,49 @@
+import unittest
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import packing
+
+
+class PackingTest(unittest.TestCase):
+
+    def test_task_cost(self):
+        self.assertEqual(packing.task_cost({'turnss': 100, 'nss': 30}), 3000)
+        # checkpoint/restart segment
+        params = {'turnss': 1000, 'nss': 30, 'imc': 2, 'first_turn': 101,
+                  'last_turn': 200}
+        self.assertEqual(packing.task_cost(params), 6000)
+
+    def test_pack(self):
+        items = [('a', 5), ('b', 1), ('c', 9), ('d', 20), ('e', 4), ('f', 1)]
+        bins = packing.pack(items, 10)
+        self.assertEqual(bins, [['d'], ['c', 'b'], ['a', 'e', 'f']])
+        self.assertEqual(len(packing.pack(items, 10, max_items=1)), 6)
+
+    def test_pack_workers(self):
+        items = [('a', 5), ('b', 1), ('c', 9), ('d', 20), ('e', 4), ('f', 1)]
+        # the items of a bin run on 2 workers
+        bins = packing.pack(items, 10, workers=2)
+        self.assertEqual(bins, [['d', 'c'], ['a', 'e', 'b', 'f']])
+        self.assertEqual(packing.makespan([20, 9], 2), 20)
+        self.assertEqual(packing.makespan([5, 4, 1, 1], 2), 6)
+        self.assertEqual(packing.pack(items, 10, workers=1),
+                         packing.pack(items, 10))
+
+    def test_makespan(self):
+        self.assertEqual(packing.makespan([5, 1, 9, 4], 1), 19)
+        self.assertEqual(packing.makespan([5, 1, 9, 4], 2), 10)
+        self.assertEqual(packing.makespan([5, 1, 9, 4], 8), 9)
+        self.assertEqual(packing.makespan([], 2), 0)
+
+    def test_pack_tasks(self):
+        costs = {1: 3, 2: 3, 3: 3, 4: 3, 5: 12}
+        groups = {'pre_1': [[1, 2], [3], [4]], 'pre_2': [[5]]}
+        jobs = packing.pack_tasks(groups, costs, 7)
+        self.assertEqual(jobs, [[1, 2], [3, 4], [5]])
+
+
+if __name__ == '__main__':
+    unittest.main()
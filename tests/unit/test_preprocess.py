@@ -0,0 +1,110 @@
+import unittest
+import shutil
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+from unittest import mock
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib.preprocess import PreprocessJob
+
+
+class FakeFort3(object):
+    '''Stand-in for fort3.Fort3, writes the placeholder values'''
+
+    def __init__(self, fort_cfg):
+        self.fort_cfg = fort_cfg
+
+    def write(self, path):
+        Path(path).write_text(json.dumps(self.fort_cfg, sort_keys=True))
+
+
+class PreprocessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_folder = Path('unit_test/preprocess/').absolute()
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        (self.test_folder / 'fc.3').write_text('fc.3')
+        self.top = Path.cwd()
+        os.chdir(self.test_folder)
+        # the one turn jobs only, without the database
+        self.job = PreprocessJob.__new__(PreprocessJob)
+        self.job._logger = logging.getLogger(__name__)
+        self.job.six_cfg = {'input_files': json.dumps({'fc.3': 'fc.3'}),
+                            'work_dir': 'scratch'}
+        self.runs = []
+        self.failing = None
+        self.barrier = None
+
+    def sixtrack_run(self, output_file, cwd=None):
+        '''Stand-in for PreprocessJob.sixtrack_run, writes fort.10 from the
+        fort.3 of the job unless it is the failing one'''
+        if self.barrier is not None:
+            # all the jobs run at the same time
+            self.barrier.wait()
+        self.runs.append(output_file)
+        cwd = Path(cwd)
+        self.assertEqual((cwd / 'fc.3').read_text(), 'fc.3')
+        if output_file != self.failing:
+            shutil.copy(cwd / 'fort.3', cwd / 'fort.10')
+
+    def run_jobs(self, workers):
+        self.job.workers = workers
+        with mock.patch.object(self.job, 'sixtrack_prep_cfg', dict), \
+                mock.patch.object(self.job, 'render_fort3', FakeFort3), \
+                mock.patch.object(self.job, 'sixtrack_run',
+                                  self.sixtrack_run):
+            self.job.sixtrack_job()
+
+    def result(self, name):
+        path = self.test_folder / f'fort.10_{name}_oneturn'
+        return json.loads(path.read_text())
+
+    def test_concurrent(self):
+        self.barrier = threading.Barrier(3, timeout=10)
+        self.run_jobs(3)
+        self.assertEqual(sorted(self.runs), ['beta_oneturn', 'first_oneturn',
+                                             'second_oneturn'])
+        self.assertEqual(self.result('first'),
+                         {'dp1': '.0', 'dp2': '.0', 'ition': '0'})
+        self.assertEqual(self.result('second'), {'ition': '0'})
+        self.assertEqual(self.result('beta'), {'dp1': '.0', 'dp2': '.0'})
+        # the temp folders are removed
+        self.assertEqual(sorted(i.name for i in self.test_folder.iterdir()),
+                         ['fc.3', 'fort.10_beta_oneturn',
+                          'fort.10_first_oneturn', 'fort.10_second_oneturn'])
+
+    def test_concurrent_failure(self):
+        # the other jobs complete, the error of the failed one is raised
+        self.barrier = threading.Barrier(3, timeout=10)
+        self.failing = 'second_oneturn'
+        with self.assertRaises(FileNotFoundError):
+            self.run_jobs(3)
+        self.assertEqual(len(self.runs), 3)
+        self.assertTrue((self.test_folder /
+                         'fort.10_first_oneturn').is_file())
+        self.assertTrue((self.test_folder /
+                         'fort.10_beta_oneturn').is_file())
+        self.assertFalse((self.test_folder /
+                          'fort.10_second_oneturn').exists())
+
+    def test_serial_failure(self):
+        # the jobs after the failed one aren't run
+        self.failing = 'first_oneturn'
+        with self.assertRaises(FileNotFoundError):
+            self.run_jobs(1)
+        self.assertEqual(self.runs, ['first_oneturn'])
+        self.assertEqual(sorted(i.name for i in self.test_folder.iterdir()),
+                         ['fc.3'])
+
+    def tearDown(self):
+        os.chdir(self.top)
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+import shutil
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib.pysixdb import SixDB
+from pysixdesk.lib.sharding import ShardManager
+
+
+class SixDBShardTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/pysixdb/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.db_info = {'db_type': 'sql',
+                        'db_name': str(self.test_folder / 'test.db')}
+        self.db = SixDB(self.db_info, settings='interactive', create=True,
+                        shard={'tables': ['task', 'result'], 'size': 3})
+        self.db.create_table('wu', OrderedDict([('wu_id', 'int')]),
+                             {'primary': ['wu_id']})
+        self.db.create_table('task', OrderedDict([('task_id', 'INTEGER'),
+                                                  ('wu_id', 'int'),
+                                                  ('status', 'text')]),
+                             {'primary': ['task_id'],
+                              'foreign': {'wu': [['wu_id'], ['wu_id']]}})
+        self.db.create_table('result', OrderedDict([('task_id', 'int'),
+                                                    ('row_num', 'int')]),
+                             {'primary': ['task_id', 'row_num'],
+                              'foreign': {'task': [['task_id'], ['task_id']]}})
+
+    def test_shard(self):
+        self.db.insert('wu', {'wu_id': 1})
+        for i in range(8):
+            self.db.insert('task', {'wu_id': 1, 'status': 'new'})
+        self.assertEqual(self.db.shards.existing(), [0, 1, 2])
+        out = self.db.select('task', ['task_id'], orderby=['task_id'])
+        self.assertEqual(out, [(i,) for i in range(1, 9)])
+
+        self.db.update('task', {'status': 'done'}, 'task_id=5')
+        out = self.db.select('task', ['task_id'], "status='done'")
+        self.assertEqual(out, [(5,)])
+
+        self.db.insertm('result', {'task_id': [1, 4, 7], 'row_num': [1] * 3})
+        self.db.remove('task', 'task_id>=4')
+        out = self.db.select('task', ['count(*)'])
+        self.assertEqual(out, [(3,)])
+        # the foreign keys still cascade inside the shards
+        out = self.db.select('result', ['task_id'])
+        self.assertEqual(out, [(1,)])
+
+        # the layout is stored in the database
+        self.db.close()
+        self.db = SixDB(self.db_info, settings='interactive')
+        self.assertTrue(self.db.is_sharded('result'))
+        self.db.insert('task', {'wu_id': 1})
+        out = self.db.select('task', ['max(task_id)'])
+        # the keys of the removed rows aren't reused, the new connection
+        # reserves a new block
+        self.assertEqual(out, [(ShardManager.key_block + 1,)])
+
+    def test_allocate(self):
+        self.db.shards.key_block = 4
+        self.db.insert('wu', {'wu_id': 1})
+        self.db.insertm('task', {'wu_id': [1, 1]})
+        # a second connection, e.g. another gather, gets distinct keys
+        other = SixDB(self.db_info, settings='interactive')
+        other.shards.key_block = 4
+        try:
+            other.insert('task', {'wu_id': 1})
+            self.db.insert('task', {'wu_id': 1})
+            other.insertm('task', {'wu_id': [1, 1]})
+            # the keys inserted explicitly move the counter
+            self.db.insert('task', {'task_id': 10, 'wu_id': 1})
+            other.insert('task', {'wu_id': 1})
+            self.db.insert('task', {'wu_id': 1})
+            other.insert('task', {'wu_id': 1})
+        finally:
+            other.close()
+        out = self.db.select('task', ['task_id'], orderby=['task_id'])
+        self.assertEqual(out, [(i,) for i in [1, 2, 3, 4, 5, 6, 7, 8, 10,
+                                              11]])
+
+    def test_shard_locks(self):
+        self.db.shards.key_block = 4
+        self.db.insert('wu', {'wu_id': 1})
+        self.db.insert('task', {'wu_id': 1})
+        # another writer holds the lock of the main database
+        blocker = sqlite3.connect(self.db_info['db_name'], timeout=0)
+        blocker.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.conn.execute('PRAGMA busy_timeout=0')
+            # the keys of the reserved block, the routed updates and the
+            # explicit keys below the counter don't write to it
+            self.db.insert('task', {'wu_id': 1, 'status': 'new'})
+            self.db.update('task', {'status': 'done'}, 'task_id=2')
+            self.db.insert('result', {'task_id': 2, 'row_num': 1})
+            self.db.remove('result', 'task_id=2')
+            with self.assertRaises(sqlite3.OperationalError):
+                self.db.update('wu', {'wu_id': 2}, 'wu_id=1')
+        finally:
+            blocker.rollback()
+            blocker.close()
+        out = self.db.select('task', ['task_id', 'status'],
+                             orderby=['task_id'])
+        self.assertEqual(out, [(1, None), (2, 'done')])
+
+    def test_allocate_transaction(self):
+        # the transaction of the caller isn't committed
+        self.db.insert('wu', {'wu_id': 1})
+        self.db.conn.execute('INSERT INTO wu VALUES (2)')
+        self.assertEqual(self.db.shards.allocate('task', 2), 1)
+        self.assertTrue(self.db.conn.in_transaction)
+        self.db.conn.rollback()
+        self.assertEqual(self.db.select('wu', ['wu_id']), [(1,)])
+        # nor is the reservation
+        self.assertEqual(self.db.shards.allocate('task'), 1)
+
+    def test_select_merge(self):
+        self.db.shards.max_attached = 2
+        self.db.insert('wu', {'wu_id': 1})
+        self.db.insertm('task', {'wu_id': [1] * 10,
+                                 'status': ['new', 'done'] * 5})
+        self.assertEqual(self.db.shards.existing(), [0, 1, 2, 3])
+        out = self.db.select('task', ['count(*)', 'max(task_id)'])
+        self.assertEqual(out, [(10, 10)])
+        out = self.db.select('task', ['task_id'], 'task_id>2',
+                             orderby=['task_id DESC'], limit=3)
+        self.assertEqual(out, [(10,), (9,), (8,)])
+        out = self.db.select('task', ['status', 'count(*)'],
+                             groupby=['status'], orderby=['status'])
+        self.assertEqual(out, [('done', 5), ('new', 5)])
+        out = self.db.select('task', ['status'], DISTINCT=True,
+                             orderby=['status'])
+        self.assertEqual(out, [('done',), ('new',)])
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import math
+import unittest
+import gzip
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import resources, packing
+from pysixdesk.lib.pysixdb import SixDB
+from pysixdesk.lib.submission import HTCondor
+
+LOG = '''000 (1234.000.000) 2020-03-02 10:00:00 Job submitted from host: <127.0.0.1:9618>
+...
+001 (1234.000.000) 2020-03-02 10:01:00 Job executing on host: <127.0.0.2:9618>
+...
+006 (1234.000.000) 2020-03-02 10:06:00 Image size of job updated: 22000
+\t350  -  MemoryUsage of job (MB)
+\t358524  -  ResidentSetSize of job (KB)
+...
+005 (1234.000.000) 2020-03-02 10:30:00 Job terminated.
+\t(1) Normal termination (return value 0)
+\t\tUsr 0 00:28:01, Sys 0 00:00:03  -  Run Remote Usage
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Run Local Usage
+\t1024  -  Run Bytes Sent By Job
+\tPartitionable Resources :    Usage  Request Allocated
+\t   Cpus                 :     0.98        1         1
+\t   Memory (MB)          :      412      2000      2048
+...
+'''
+
+
+class ResourcesTest(unittest.TestCase):
+
+    def test_parse_usage(self):
+        usage = resources.parse_usage(LOG)
+        self.assertEqual(usage['wall_time'], 29 * 60)
+        self.assertEqual(usage['cpu_time'], 28 * 60 + 4)
+        self.assertEqual(usage['peak_memory'], 412)
+        self.assertEqual(resources.parse_usage(LOG[:200]),
+                         dict.fromkeys(resources.USAGE_COLUMNS))
+
+    def test_record_usage(self):
+        test_folder = Path('unit_test/resources/')
+        test_folder.mkdir(parents=True, exist_ok=True)
+        db = SixDB({'db_type': 'sql', 'db_name': str(test_folder / 'test.db')},
+                   create=True)
+        try:
+            db.create_table('task', OrderedDict([
+                ('task_id', 'int'), ('job_stdlog', 'blob'),
+                ('wall_time', 'float'), ('cpu_time', 'float'),
+                ('peak_memory', 'float')]))
+            grouped = LOG.replace('1234.000', '1240.000')
+            # task 1 ran alone, tasks 2 and 3 in the same job
+            db.insertm('task', {'task_id': [1, 2, 3], 'job_stdlog': [
+                gzip.compress(LOG.encode()),
+                gzip.compress(grouped.encode()),
+                gzip.compress(grouped.encode())]})
+            self.assertEqual(resources.record_usage(db, 'task'), 3)
+            out = db.select('task', ['task_id'] + resources.USAGE_COLUMNS,
+                            orderby=['task_id'])
+        finally:
+            db.close()
+            shutil.rmtree(test_folder.parents[0], ignore_errors=True)
+        # the job ran on a single cpu, its tasks one after the other
+        self.assertEqual(out, [(1, 1740, 1684, 412), (2, 870, 842, 412),
+                               (3, 870, 842, 412)])
+
+    def test_choose_flavour(self):
+        self.assertEqual(resources.choose_flavour(600), 'espresso')
+        self.assertEqual(resources.choose_flavour(5 * 3600), 'workday')
+        self.assertEqual(resources.choose_flavour(1E7), 'nextweek')
+
+    def test_split_usage(self):
+        usage = {'wall_time': 1000.0, 'cpu_time': 3900.0,
+                 'peak_memory': 1600.0}
+        self.assertEqual(resources.split_usage(usage, 1), usage)
+        # 8 tasks on 4 workers
+        self.assertEqual(resources.split_usage(usage, 8),
+                         {'wall_time': 500.0, 'cpu_time': 487.5,
+                          'peak_memory': 400.0})
+        usage = dict.fromkeys(resources.USAGE_COLUMNS)
+        self.assertEqual(resources.split_usage(usage, 4), usage)
+
+    def test_request(self):
+        model = resources.ResourceModel()
+        model.intercept = 1000.0
+        model.peak_memory = 300.0
+        self.assertEqual(model.request([1.0]), ('microcentury', 500, 1))
+        # the tasks of a grouped job run concurrently
+        self.assertEqual(model.request([1.0] * 4), ('microcentury', 2000, 4))
+        self.assertEqual(model.request([1.0] * 16), ('microcentury', 3750, 8))
+        self.assertEqual(model.request([1.0] * 17), ('longlunch', 3750, 8))
+        # the multi-threaded tasks share the cpus
+        model.cpus = 2
+        self.assertEqual(model.request([1.0]), ('microcentury', 500, 2))
+        self.assertEqual(model.request([1.0] * 4), ('microcentury', 2000, 4))
+        model.intercept = 1500.0
+        self.assertEqual(model.request([1.0] * 4), ('longlunch', 2000, 4))
+
+    def test_pack_request(self):
+        # the packed jobs last about the target wall time on the requested
+        # cpus
+        walltime = 3600.0
+        costs = dict((i, 100.0 + (i * 37) % 500) for i in range(400))
+        model = resources.ResourceModel()
+        model.intercept = 0.0
+        model.slope = 1.0
+        for cpus in [1, 2]:
+            model.cpus = cpus
+            workers, slowdown = model.concurrency()
+            scaled = dict((i, model.predict_wall(j) * slowdown)
+                          for i, j in costs.items())
+            jobs = packing.pack_tasks({'pre_1': [[i] for i in costs]},
+                                      scaled, walltime, workers=workers)
+            walls = sorted(model.predict_job_wall([costs[i] for i in job])
+                           for job in jobs)
+            self.assertLessEqual(walls[-1], walltime)
+            self.assertGreater(walls[1], 0.9 * walltime)
+            serial = sum(costs.values()) * cpus
+            self.assertEqual(len(jobs),
+                             math.ceil(serial / workers / walltime))
+
+    def test_set_resources(self):
+        sub = 'flavour = tomorrow\nmemory = 2000\ncpus = 1\n'
+        sub = HTCondor()._set_resources(sub, ['espresso', None, 4])
+        self.assertEqual(sub, 'flavour = espresso\nmemory = 2000\ncpus = 4\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
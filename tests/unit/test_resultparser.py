@@ -0,0 +1,55 @@
+import unittest
+import shutil
+import json
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import outputs
+from pysixdesk.lib.resultparser import parse_results
+
+
+class ResultParserTest(unittest.TestCase):
+
+    def setUp(self):
+        # the outputs of a sixtrack task stopped early, see
+        # runner.survival_stop
+        self.test_folder = Path('unit_test/resultparser/')
+        self.job_path = self.test_folder / 'job'
+        self.results = self.job_path / 'results' / '7'
+        self.results.mkdir(parents=True, exist_ok=True)
+        src = self.test_folder / 'src'
+        src.mkdir()
+        (src / 'fort.6').write_text('tracking output\n' * 100)
+        outputs.compress_files([str(src / 'fort.6')], str(self.results))
+        (self.results / 'early_stop.json').write_text(
+            json.dumps({'turn': 1200, 'reason': 'all particles lost'}))
+
+    def parse(self):
+        task_table = {'status': 'Success'}
+        parse_results('sixtrack', '7', str(self.job_path),
+                      {'fort.10': 'six_results'}, task_table, {})
+        return task_table
+
+    def test_early_stop(self):
+        task_table = self.parse()
+        self.assertEqual(task_table['status'], 'Lost')
+        self.assertEqual(task_table['lost_turn'], 1200)
+        self.assertIn('fort_6', task_table)
+
+    def test_early_stop_corrupted(self):
+        # a truncated transfer isn't reported as lost particles
+        name = self.results / 'fort.6.gz'
+        name.write_bytes(name.read_bytes()[:-4])
+        task_table = self.parse()
+        self.assertEqual(task_table['status'], 'Failed')
+        self.assertNotIn('lost_turn', task_table)
+        self.assertNotIn('fort_6', task_table)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
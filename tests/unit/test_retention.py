@@ -0,0 +1,106 @@
+import unittest
+import shutil
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import workspace, retention
+
+
+class RetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_folder = Path('unit_test/retention/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        ws = workspace.WorkSpace(str(self.test_folder / 'unit_test_ws'))
+        ws.init_study('unit_test_st')
+        self.st = ws.load_study('unit_test_st')
+        db = self.st.db
+        # preprocess 1 feeds two segments of a job, preprocess 2 a job with
+        # a running segment
+        for wu_id, task_id in [(1, 1), (2, 2)]:
+            db.insert('preprocess_wu', {'wu_id': wu_id, 'status': 'complete',
+                                        'task_id': task_id})
+            db.insert('preprocess_task', {'task_id': task_id, 'wu_id': wu_id,
+                                          'status': 'Success',
+                                          'fort_2': b'fort.2 %d' % wu_id,
+                                          'madx_stdout': b'madx log'})
+        segments = [(1, 100, 1, 'complete', 1), (1, 200, 1, 'complete', 2),
+                    (2, 100, 2, 'complete', 3),
+                    (2, 200, 2, 'incomplete', None)]
+        for wu_id, last_turn, pre_id, status, task_id in segments:
+            db.insert('sixtrack_wu', {'wu_id': wu_id, 'last_turn': last_turn,
+                                      'preprocess_id': pre_id,
+                                      'status': status, 'task_id': task_id})
+            if task_id is not None:
+                db.insert('sixtrack_task', {
+                    'task_id': task_id, 'wu_id': wu_id,
+                    'last_turn': last_turn, 'status': 'Success',
+                    'crpoint_pri_bin': bytes(range(256)) * task_id,
+                    'job_stdout': b'stdout %d' % task_id})
+
+    def blobs(self, table_name, column):
+        rows = self.st.db.select(table_name, ['task_id', column],
+                                 orderby=['task_id'])
+        return [(i, None if j is None else bytes(j)) for i, j in rows]
+
+    def test_rules(self):
+        self.assertEqual(retention.superseded_checkpoints(self.st.db), [1])
+        self.assertEqual(retention.finished_preprocess(self.st.db), [1])
+        self.assertEqual(retention.completed_tasks(self.st.db,
+                                                   'sixtrack_task'),
+                         [1, 2, 3])
+        self.assertEqual(retention.policy_rules('default'),
+                         ['superseded_checkpoints', 'completed_logs'])
+        with self.assertRaises(ValueError):
+            retention.policy_rules(['unknown'])
+
+    def test_archive_restore(self):
+        before = self.blobs('sixtrack_task', 'crpoint_pri_bin')
+        archive = retention.BlobArchive(self.st.db, self.st.archive_path,
+                                        self.st.study_path)
+        n_bytes = archive.archive('sixtrack_task', [1, 3],
+                                  ['crpoint_pri_bin'])
+        self.assertEqual(n_bytes, 256 * 4)
+        out = self.blobs('sixtrack_task', 'crpoint_pri_bin')
+        self.assertEqual(out, [(1, None), before[1], (3, None)])
+        self.assertEqual(len(archive.archived('sixtrack_task')), 2)
+
+        self.assertEqual(archive.restore('sixtrack_task', [3]), 1)
+        out = self.blobs('sixtrack_task', 'crpoint_pri_bin')
+        self.assertEqual(out, [(1, None), before[1], before[2]])
+        self.assertEqual(archive.restore('sixtrack_task'), 1)
+        self.assertEqual(self.blobs('sixtrack_task', 'crpoint_pri_bin'),
+                         before)
+        self.assertEqual(archive.archived('sixtrack_task'), [])
+
+    def test_compact(self):
+        checkpoints = self.blobs('sixtrack_task', 'crpoint_pri_bin')
+        logs = self.blobs('sixtrack_task', 'job_stdout')
+        madx = self.blobs('preprocess_task', 'fort_2')
+        self.assertGreater(self.st.compact('all'), 0)
+        # the checkpoint of the superseded segment and all the logs
+        out = self.blobs('sixtrack_task', 'crpoint_pri_bin')
+        self.assertEqual(out, [(1, None), checkpoints[1], checkpoints[2]])
+        out = self.blobs('sixtrack_task', 'job_stdout')
+        self.assertEqual(out, [(1, None), (2, None), (3, None)])
+        out = self.blobs('preprocess_task', 'fort_2')
+        self.assertEqual(out, [(1, None), madx[1]])
+
+        self.st.restore_blobs('sixtrack_task')
+        self.st.restore_blobs('preprocess_task', [1], ['fort_2'])
+        self.assertEqual(self.blobs('sixtrack_task', 'crpoint_pri_bin'),
+                         checkpoints)
+        self.assertEqual(self.blobs('sixtrack_task', 'job_stdout'), logs)
+        self.assertEqual(self.blobs('preprocess_task', 'fort_2'), madx)
+        out = self.blobs('preprocess_task', 'madx_stdout')
+        self.assertEqual(out, [(1, None), (2, None)])
+
+    def tearDown(self):
+        self.st.db.close()
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import shutil
+import sys
+from pathlib import Path
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import runner
+
+
+class RunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/runner/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+
+    def test_parse_tracking(self):
+        line = ('TRACKING> Turn 512 / 1000, Particles: 58 / 60, '
+                'Amplitude: 8.1')
+        self.assertEqual(runner.parse_tracking(line),
+                         {'turn': 512, 'turns': 1000, 'particles': 58,
+                          'total_particles': 60})
+        self.assertIsNone(runner.parse_tracking('ENDE'))
+
+    def test_run(self):
+        stdout = self.test_folder / 'stdout'
+        heartbeat = self.test_folder / 'heartbeat.json'
+        command = ('for i in 1 2 3; do echo "TRACKING> Turn $i / 3, '
+                   'Particles: 60 / 60"; done; echo oops >&2; exit 3')
+        result = runner.run(command, stdout,
+                            stderr=self.test_folder / 'stderr',
+                            heartbeat=heartbeat, tail=2,
+                            parser=runner.parse_tracking)
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(len(stdout.read_text().splitlines()), 3)
+        self.assertEqual(len(result.tail), 2)
+        self.assertEqual(result.progress['turn'], 3)
+        self.assertGreaterEqual(result.usage['cpu_time'], 0)
+        self.assertEqual((self.test_folder / 'stderr').read_text(), 'oops\n')
+        beat = runner.read_heartbeat(heartbeat)
+        self.assertEqual(beat['status'], 'finished')
+        self.assertEqual(beat['lines'], 3)
+        self.assertEqual(beat['returncode'], 3)
+
+    def test_stop(self):
+        stdout = self.test_folder / 'stdout'
+        command = ('echo "TRACKING> Turn 1 / 100, Particles: 60 / 60"; '
+                   'echo "TRACKING> Turn 2 / 100, Particles: 0 / 60"; '
+                   'sleep 30; echo done')
+        result = runner.run(command, stdout, parser=runner.parse_tracking,
+                            stop=runner.survival_stop())
+        self.assertEqual(result.stopped, '0 of 60 particles left at turn 2')
+        self.assertLess(result.usage['wall_time'], 10)
+        self.assertNotIn('done', stdout.read_text())
+        stop = runner.survival_stop(0.5)
+        self.assertIsNone(stop({'turn': 2, 'turns': 100, 'particles': 40,
+                                'total_particles': 60}))
+        self.assertIsNotNone(stop({'turn': 2, 'turns': 100, 'particles': 20,
+                                   'total_particles': 60}))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
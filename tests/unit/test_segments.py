@@ -0,0 +1,58 @@
+import unittest
+import shutil
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import segments
+from pysixdesk.lib.pysixdb import SixDB
+from pysixdesk.lib.dbtable import Table
+
+
+class SegmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/segments/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        db_info = {'db_type': 'sql',
+                   'db_name': str(self.test_folder / 'test.db')}
+        self.db = SixDB(db_info, create=True)
+        table = Table({}, {}, 'sql')
+        self.columns = list(table.tables['sixtrack_wu'].keys())
+        self.db.create_table('sixtrack_wu', table.tables['sixtrack_wu'],
+                             table.table_keys['sixtrack_wu'])
+        rows = {'wu_id': [1, 2, 3], 'last_turn': [100, 100, 100],
+                'status': ['complete', 'incomplete', 'complete'],
+                'task_id': [1, 2, 3], 'job_name': ['a', 'b', 'c']}
+        self.db.insertm('sixtrack_wu', rows)
+
+    def test_chain(self):
+        self.assertEqual(segments.chain(self.db, self.columns, 100, 250), 2)
+        # the new segments aren't complete yet
+        self.assertEqual(segments.chain(self.db, self.columns, 100, 250), 0)
+        out = self.db.select('sixtrack_wu',
+                             ['wu_id', 'first_turn', 'last_turn', 'status',
+                              'task_id', 'job_name'], 'first_turn=101')
+        self.assertEqual(sorted(out), [(1, 101, 200, 'incomplete', None, 'a'),
+                                       (3, 101, 200, 'incomplete', None, 'c')])
+        self.db.update('sixtrack_wu', {'status': 'complete'},
+                       'first_turn=101')
+        segments.chain(self.db, self.columns, 100, 250)
+        out = self.db.select('sixtrack_wu', ['first_turn', 'last_turn'],
+                             'wu_id=1 and first_turn=201')
+        self.assertEqual(out, [(201, 250)])
+        self.db.update('sixtrack_wu', {'status': 'complete'},
+                       'first_turn=201')
+        # the final turn is reached
+        self.assertEqual(segments.chain(self.db, self.columns, 100, 250), 0)
+        self.assertEqual(segments.pending(self.db, 250), 1)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
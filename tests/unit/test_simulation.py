@@ -0,0 +1,94 @@
+import unittest
+import shutil
+import json
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import jobtracker, workspace
+from pysixdesk.lib.simulation import SimulatedCluster, LifecycleHarness
+
+
+class SimulatedClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/simulation/').absolute()
+        self.in_path = self.test_folder / 'sixtrack_input'
+        self.out_path = self.test_folder / 'sixtrack_output'
+        self.in_path.mkdir(parents=True, exist_ok=True)
+        self.out_path.mkdir(parents=True, exist_ok=True)
+        output_files = json.dumps(['fort.10'])
+        (self.in_path / 'input.ini').write_text(
+            f'[sixtrack]\noutput_files = {output_files}\n')
+
+    def test_lifecycle(self):
+        cluster = SimulatedCluster(seed=0, hold_rate=0.5)
+        cluster.prepare([1, 2, [3, 4]], [], 'sixtrack.py', 'input.ini',
+                        self.in_path, self.out_path)
+        status, out = cluster.submit(self.in_path,
+                                     str(self.test_folder / 'sixtrack_1'))
+        self.assertTrue(status)
+        self.assertEqual(sorted(out.keys()), ['1', '2', '3-4'])
+        study = str(self.test_folder)
+        self.assertEqual(len(cluster.check_running(study)), 3)
+
+        cluster.drain()
+        snapshot = cluster.status_snapshot(study)
+        held = [i for i in out.values()
+                if snapshot.state(i) == jobtracker.HELD]
+        self.assertEqual(sorted(cluster.check_running(study)), sorted(held))
+        cluster.profile['hold_rate'] = 0
+        cluster.release(study)
+        cluster.drain()
+        self.assertEqual(cluster.check_running(study), [])
+
+        cluster.download_from_spool(study)
+        for task in ['1', '2', '3', '4']:
+            job_path = self.out_path / ('3-4' if task in '34' else task)
+            self.assertTrue((job_path / 'results' / task /
+                             'fort.10.gz').is_file())
+        cluster.remove(study, 4)
+        self.assertEqual(cluster.jobs, {})
+
+    def test_profile(self):
+        for key in ['hold_rate', 'evict_rate', 'fail_rate']:
+            with self.assertRaises(ValueError):
+                SimulatedCluster(**{key: 1})
+            with self.assertRaises(ValueError):
+                SimulatedCluster(**{key: -0.1})
+        with self.assertRaises(ValueError):
+            SimulatedCluster(runtime=-1)
+        with self.assertRaises(ValueError):
+            SimulatedCluster(unknown=1)
+
+    def test_harness(self):
+        ws = workspace.WorkSpace(str(self.test_folder / 'unit_test_ws'))
+        ws.init_study('unit_test_st')
+        study = ws.load_study('unit_test_st')
+        cluster = SimulatedCluster(seed=1, hold_rate=0.2, evict_rate=0.2,
+                                   fail_rate=0.2)
+        harness = LifecycleHarness(study, cluster, max_rounds=5)
+        try:
+            report = harness.run()
+            summary = harness.summary()
+        finally:
+            study.db.close()
+        self.assertIs(study.submission, cluster)
+        self.assertEqual(report['jobs'], {'preprocess_wu': {'complete': 4},
+                                          'sixtrack_wu': {'complete': 8}})
+        # the failed sixtrack jobs were resubmitted
+        self.assertGreater(report['calls']['submit'], 2)
+        self.assertEqual(report['phases']['update_db']['calls'], 1)
+        for name in ['submit', 'poll', 'collect']:
+            self.assertIn(f'{name}_sixtrack', report['phases'])
+        self.assertEqual(report['simulated'], cluster.now)
+        self.assertIn('sixtrack_wu: complete=8', summary)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+import shutil
+import gzip
+import json
+import os
+from pathlib import Path
+from unittest import mock
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import sixtrack
+from pysixdesk.lib.cache import NodeCache
+
+
+class FakeJob(object):
+    '''Stand-in for TrackingJob, writes the results of the task in the
+    current folder, the task 'bad' fails'''
+
+    def __init__(self, task_id, input_info, group_name, logger,
+                 cache_dir=None):
+        self.task_id = task_id
+        self.input_info = input_info
+        self.cache_dir = cache_dir
+        self.db_type = 'sql'
+
+    def run(self):
+        if self.task_id == 'bad':
+            raise ValueError('The task failed!')
+        results = Path('results', self.task_id)
+        results.mkdir(parents=True)
+        (results / 'fort.10').write_text('%s %s %s %s' % (
+            Path(self.input_info).read_text(), os.getpid(),
+            Path.cwd().name, self.cache_dir))
+
+
+class SixtrackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_folder = Path('unit_test/sixtrack/').absolute()
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        (self.test_folder / 'input.ini').write_text('input')
+        self.top = Path.cwd()
+        os.chdir(self.test_folder)
+
+    def result(self, task_id):
+        return (self.test_folder / 'results' / task_id /
+                'fort.10').read_text().split()
+
+    def run_main(self, *args):
+        argv = ['sixtrack.py', *args]
+        with mock.patch.object(sixtrack, 'TrackingJob', FakeJob), \
+                mock.patch.object(sys, 'argv', argv):
+            sixtrack.main()
+
+    def test_run_task(self):
+        with mock.patch.object(sixtrack, 'TrackingJob', FakeJob):
+            self.assertTrue(sixtrack.run_task('1', 'input.ini', '1-2', None,
+                                              'task_1'))
+            self.assertFalse(sixtrack.run_task('bad', 'input.ini', '1-bad'))
+        # run in its own folder, where the inputs are linked
+        self.assertEqual(self.result('1')[0], 'input')
+        self.assertEqual(self.result('1')[2], 'task_1')
+        self.assertFalse((self.test_folder / 'task_1').exists())
+        self.assertEqual(Path.cwd(), self.test_folder)
+
+    def test_main_grouped(self):
+        self.run_main('1-2-3-4', 'input.ini', '--workers', '2', '--no-cache')
+        pids = set()
+        for task_id in ['1', '2', '3', '4']:
+            data, pid, folder, cache = self.result(task_id)
+            self.assertEqual(folder, 'task_%s' % task_id)
+            # the inputs are shared between the tasks of the job
+            self.assertEqual(cache, str(self.test_folder / 'cache'))
+            pids.add(pid)
+        self.assertNotIn(str(os.getpid()), pids)
+        self.assertEqual(sorted(os.listdir(self.test_folder)),
+                         ['input.ini', 'results'])
+
+    def test_main_serial(self):
+        cache = str(self.test_folder / 'node_cache')
+        self.run_main('1-2', 'input.ini', '--workers', '1', '--cache-dir',
+                      cache)
+        for task_id in ['1', '2']:
+            data, pid, folder, cache_dir = self.result(task_id)
+            self.assertEqual((pid, folder), (str(os.getpid()), 'sixtrack'))
+            self.assertEqual(cache_dir, cache)
+
+    def test_main_failure(self):
+        with self.assertRaisesRegex(Exception, r"\['bad'\]"):
+            self.run_main('1-bad-3', 'input.ini', '--workers', '3',
+                          '--no-cache')
+        # the other tasks of the job still ran
+        self.assertEqual(self.result('1')[0], 'input')
+        self.assertEqual(self.result('3')[0], 'input')
+        self.assertFalse((self.test_folder / 'results' / 'bad').exists())
+
+    def test_decomp_studies(self):
+        cache = NodeCache(self.test_folder / 'node_cache')
+
+        def job(study_path, content):
+            # the same preprocess task and mtime in the sub.db of both
+            job = sixtrack.TrackingJob.__new__(sixtrack.TrackingJob)
+            job.cache = cache
+            job.cf = {'db_info': {'db_type': 'sql', 'db_name': 'sub.db'}}
+            job.six_cfg = {'input_files': json.dumps({'fort.2': 'fort_2'}),
+                           'study_path': study_path}
+            job.pre_task_id = 1
+            job.first_turn = None
+            job.db = mock.Mock()
+            job.db.select.side_effect = lambda table, cols, where: [
+                [gzip.compress(content)] if cols == ['fort_2'] else [12]]
+            return job
+        job('/studies/a', b'lattice a')._decomp_files()
+        self.assertEqual(Path('fort_2').read_bytes(), b'lattice a')
+        job('/studies/b', b'lattice b')._decomp_files()
+        self.assertEqual(Path('fort_2').read_bytes(), b'lattice b')
+        self.assertEqual(len(cache.size()), 2)
+
+    def tearDown(self):
+        os.chdir(self.top)
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import unittest
+import shutil
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import workspace, memo
+from pysixdesk.lib.simulation import SimulatedCluster
+
+
+class StudyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_folder = Path('unit_test/study/')
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        self.ws = workspace.WorkSpace(str(self.test_folder / 'unit_test_ws'))
+        self.ws.init_study('unit_test_st')
+        self.st = self.ws.load_study('unit_test_st')
+
+    def test_param_where(self):
+        where = self.st.param_where(amp=(8, 12), kang=1, turnss=(None, 100))
+        self.assertEqual(where, 'amp_0>=8 and amp_1<=12 and kang=1 and '
+                         'turnss<=100')
+        where = self.st.param_where(amp=9.5, Runnam="it's")
+        self.assertEqual(where, "amp_0<=9.5 and amp_1>=9.5 and "
+                         "Runnam='it''s'")
+        with self.assertRaises(ValueError):
+            self.st.param_where(**{'kang=1 or 1': 1})
+        with self.assertRaises(ValueError):
+            self.st.param_where(kang='1'.split())
+
+    def test_add_vector_columns(self):
+        db = self.st.db
+        for wu_id, amp in enumerate([(8, 10), (10, 12), (10, 12)]):
+            db.insert('sixtrack_wu', {'wu_id': wu_id, 'last_turn': 100,
+                                      'amp': str(amp)})
+        # a database created before the vector columns existed
+        for col in ['amp_0', 'amp_1']:
+            db.execute('DROP INDEX IF EXISTS idx_sixtrack_wu_%s' % col)
+            db.execute('ALTER TABLE sixtrack_wu DROP COLUMN %s' % col)
+        self.st._add_vector_columns()
+        out = db.select('sixtrack_wu', ['wu_id', 'amp_0', 'amp_1'],
+                        orderby=['wu_id'])
+        self.assertEqual(out, [(0, 8, 10), (1, 10, 12), (2, 10, 12)])
+        out = db.select('sixtrack_wu', ['wu_id'],
+                        self.st.param_where(amp=(10, 12)))
+        self.assertEqual(out, [(1,), (2,)])
+
+    def test_pack_records(self):
+        # 0.1 s per task by default, run on the cpus of the jobs
+        outputs = {'task_id': [1, 2, 3, 4, 5], 'preprocess_id': [1] * 4 + [2],
+                   'turnss': [100] * 5, 'nss': [1] * 5}
+        units = [[i] for i in outputs['task_id']]
+        self.st.auto_resources = False
+        self.st.submission = SimulatedCluster(seed=0)
+        self.st.submission.request_cpus = 1
+        jobs = self.st._pack_records(outputs, units, 0.2)
+        self.assertEqual(jobs, [[1, 2], [3, 4], [5]])
+        self.st.submission.request_cpus = 2
+        jobs = self.st._pack_records(outputs, units, 0.2)
+        self.assertEqual(jobs, [[1, 2, 3, 4], [5]])
+
+    def run_preprocess(self):
+        self.st.submission = SimulatedCluster(seed=0)
+        self.st.update_db()
+        self.st.prepare_preprocess_input()
+        self.st.submit(0)
+        self.st.submission.drain()
+        self.st.collect_result(0)
+
+    def segment_status(self):
+        return self.st.db.select('sixtrack_wu', ['last_turn', 'status',
+                                                 'count(*)'],
+                                 groupby=['last_turn', 'status'],
+                                 orderby=['last_turn'])
+
+    def test_submit_segments(self):
+        self.st.checkpoint_restart = True
+        self.st.segment_turns = 50
+        self.st.final_turn = 150
+        self.run_preprocess()
+        self.st.prepare_sixtrack_input()
+        self.st.submit(1)
+        self.st.submission.drain()
+        # the next segments are submitted when the results are collected
+        self.st.collect_result(1)
+        self.assertEqual(self.segment_status(), [(100, 'complete', 8),
+                                                 (150, 'submitted', 8)])
+        self.st.submission.drain()
+        self.st.collect_result(1)
+        self.assertEqual(self.segment_status(), [(100, 'complete', 8),
+                                                 (150, 'complete', 8)])
+
+        # or only queued
+        self.st.auto_submit_segments = False
+        self.st.final_turn = 200
+        self.st.collect_result(1)
+        self.assertEqual(self.segment_status()[-1], (200, 'incomplete', 8))
+
+    def preprocess_tasks(self, study):
+        wus = study.db.select('preprocess_wu', ['wu_id', 'task_id', 'status'],
+                              orderby=['wu_id'])
+        tasks = study.db.select('preprocess_task', ['task_id', 'fort_2'],
+                                orderby=['task_id'])
+        return wus, [(i, bytes(j) if j else None) for i, j in tasks]
+
+    def test_reuse_preprocess(self):
+        cache = str((self.test_folder / 'madx_cache').absolute())
+        self.st.madx_cache = cache
+        self.st.submission = SimulatedCluster(seed=0)
+        self.st.update_db()
+        # the mask only depends on SEEDRAN, the IOCT values share a task
+        self.st.prepare_preprocess_input()
+        wus, tasks = self.preprocess_tasks(self.st)
+        self.assertEqual([i[:2] for i in wus], [(1, 1), (2, 1), (3, 2),
+                                                (4, 2)])
+        self.assertEqual([i[0] for i in tasks], [1, 2])
+        job_list = Path(self.st.paths['preprocess_in']) / 'job_id.list'
+        self.assertEqual(job_list.read_text().split(), ['1', '2'])
+
+        # the results of a task complete all the work units sharing it
+        self.st.submit(0)
+        self.st.submission.drain()
+        self.st.collect_result(0)
+        wus, tasks = self.preprocess_tasks(self.st)
+        self.assertEqual(set(i[2] for i in wus), {'complete'})
+        self.assertTrue(all(i[1] for i in tasks))
+        # and they are shared through the madx_cache
+        keys = self.st.db.select('preprocess_wu', ['madx_key'],
+                                 DISTINCT=True)
+        shared = memo.ResultCache(cache)
+        self.assertEqual(len(keys), 2)
+        for (key,) in keys:
+            self.assertIn(key, shared)
+
+        # another study with the same inputs imports them
+        self.ws.init_study('unit_test_st2')
+        other = self.ws.load_study('unit_test_st2')
+        try:
+            other.madx_cache = cache
+            other.submission = SimulatedCluster(seed=0)
+            other.update_db()
+            other.prepare_preprocess_input()
+            wus_2, tasks_2 = self.preprocess_tasks(other)
+        finally:
+            other.db.close()
+        self.assertEqual(wus_2, wus)
+        self.assertEqual(tasks_2, tasks)
+        job_list = Path(other.paths['preprocess_in']) / 'job_id.list'
+        self.assertFalse(job_list.exists())
+
+    def tearDown(self):
+        self.st.db.close()
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,35 @@
 import unittest
 import shutil
 import os
+import re
+import threading
 from pathlib import Path
+from unittest import mock
 import sys
 # give the test runner the import access
 pysixdesk_path = str(Path(__file__).parents[2].absolute())
 sys.path.insert(0, pysixdesk_path)
 from pysixdesk.lib import submission
+from pysixdesk.lib import jobtracker
+
+
+class FakePopen(object):
+    '''Stand-in for subprocess.Popen, replies with the outputs of the given
+    function of the command line'''
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.calls = []
+
+    def __call__(self, cmd, **kwargs):
+        self.calls.append(cmd)
+        process = mock.Mock()
+        process.communicate = lambda: self._communicate(process, cmd)
+        return process
+
+    def _communicate(self, process, cmd):
+        process.returncode, stdout, stderr = self.reply(cmd)
+        return stdout, stderr
 
 
 class SubmissionTest(unittest.TestCase):
@@ -56,6 +79,203 @@ class SubmissionTest(unittest.TestCase):
         self.jobs = out
         self.assertEqual(list(out.keys()), [str(i) for i in self.wu_ids])
 
+    def test_parse_terse(self):
+        out = submission.HTCondor.parse_terse('1234.0 - 1234.2\n1240.0 - 1240.0\n')
+        self.assertEqual(out, ['1234.0', '1234.1', '1234.2', '1240.0'])
+
+    def prepare_chunks(self, wu_ids, resources=None):
+        self.cluster.prepare(wu_ids, self.trans, self.exe, 'dummyarg',
+                             str(self.sub_folder_in.absolute()),
+                             str(self.sub_folder_out.absolute()),
+                             resources=resources)
+        lock = threading.Lock()
+        submitted = []
+
+        def condor_submit(sub_file):
+            # the tasks of a chunk, from the job list of its submit file
+            with open(sub_file) as f_in:
+                sub_cont = f_in.read()
+            job_list = re.search(r'^queue wu_id from (.*)$', sub_cont,
+                                 re.MULTILINE).group(1)
+            with open(job_list) as f_in:
+                tasks = f_in.read().split()
+            with lock:
+                cluster = 100 + len(submitted)
+                submitted.append((tasks, sub_cont))
+            return cluster, tasks
+        return submitted, condor_submit
+
+    def test_submit_chunks(self):
+        submitted, condor_submit = self.prepare_chunks(
+            [1, 2, 3, 4, 5], resources={5: ['espresso', 4000, 2]})
+        barrier = threading.Barrier(2, timeout=10)
+
+        def reply(cmd):
+            cluster, tasks = condor_submit(cmd[-1])
+            if cluster < 102:
+                # the first two chunks are submitted concurrently
+                barrier.wait()
+            return 0, '%d.0 - %d.%d\n' % (cluster, cluster,
+                                          len(tasks) - 1), ''
+        self.cluster.submit_workers = 2
+        popen = FakePopen(reply)
+        with mock.patch.object(submission, 'Popen', popen):
+            status, out = self.cluster.submit(self.sub_folder_in, 'batch',
+                                              limit=2)
+        self.assertTrue(status)
+        chunks = sorted(i[0] for i in submitted)
+        self.assertEqual(chunks, [['1', '2'], ['3', '4'], ['5']])
+        self.assertEqual(sorted(out.keys()), ['1', '2', '3', '4', '5'])
+        self.assertEqual(len(set(out.values())), 5)
+        for cmd in popen.calls:
+            self.assertEqual(cmd[:4], ['condor_submit', '-terse',
+                                       '-batch-name', 'batch'])
+        for tasks, sub_cont in submitted:
+            memory = '4000' if tasks == ['5'] else '2000'
+            self.assertIn('\nmemory = %s\n' % memory, sub_cont)
+            self.assertNotIn('job_id.list', sub_cont)
+        # only the prepared submit file is left
+        self.assertEqual(sorted(os.listdir(self.sub_folder_in)),
+                         ['db.ini', 'dummy.exe', 'htcondor_run.sub'])
+
+    def test_submit_retry(self):
+        submitted, condor_submit = self.prepare_chunks([1, 2, 3, 4, 5])
+
+        def reply(cmd):
+            if cmd[0] == 'condor_rm':
+                return 0, '', ''
+            cluster, tasks = condor_submit(cmd[-1])
+            if '3' in tasks:
+                # never accepted
+                return 1, '', 'ERROR: Failed to connect to the schedd'
+            if '1' in tasks and len(submitted) == 1:
+                # a transient failure, retried
+                return 1, '', 'ERROR: Failed to connect to the schedd'
+            if '5' in tasks:
+                # queued with an extra job, not retried
+                return 1, '%d.0 - %d.1\n' % (cluster, cluster), ''
+            return 0, '%d.0 - %d.%d\n' % (cluster, cluster,
+                                          len(tasks) - 1), ''
+        self.cluster.submit_workers = 1
+        popen = FakePopen(reply)
+        with mock.patch.object(submission, 'Popen', popen):
+            status, out = self.cluster.submit(self.sub_folder_in, 'batch',
+                                              limit=2, trials=3)
+        self.assertFalse(status)
+        self.assertEqual(out, {'1': '101.0', '2': '101.1', '5': '105.0'})
+        tried = [i[0] for i in submitted]
+        self.assertEqual(tried, [['1', '2'], ['1', '2'], ['3', '4'],
+                                 ['3', '4'], ['3', '4'], ['5']])
+        self.assertEqual(popen.calls[-1], ['condor_rm', '105.1'])
+        # the tasks left for the next submission
+        with open(self.sub_folder_in / 'job_id.list') as f_in:
+            self.assertEqual(f_in.read().split(), ['3', '4'])
+
+    def test_submit_partial(self):
+        submitted, condor_submit = self.prepare_chunks([1, 2, 3])
+
+        def reply(cmd):
+            cluster, tasks = condor_submit(cmd[-1])
+            # two of the three jobs were queued
+            return 1, '%d.0 - %d.1\n' % (cluster, cluster), 'ERROR'
+        popen = FakePopen(reply)
+        with mock.patch.object(submission, 'Popen', popen):
+            status, out = self.cluster.submit(self.sub_folder_in, 'batch',
+                                              trials=3)
+        self.assertFalse(status)
+        self.assertEqual(out, {'1': '100.0', '2': '100.1'})
+        self.assertEqual(len(popen.calls), 1)
+        with open(self.sub_folder_in / 'job_id.list') as f_in:
+            self.assertEqual(f_in.read().split(), ['3'])
+
+    def test_set_queue(self):
+        sub_cont = 'executable = a\nqueue wu_id from /in/job_id.list\n'
+        out = self.cluster._set_queue(sub_cont, '/in/job_id.0.list')
+        self.assertEqual(out, 'executable = a\nqueue wu_id from '
+                         '/in/job_id.0.list\n')
+        with self.assertRaises(ValueError):
+            self.cluster._set_queue('executable = a\nqueue 1\n', 'list')
+
+    def test_query_snapshot(self):
+        study = '/tmp/ws/studies/st'
+        batch = study + '/sixtrack_1'
+        lines = ['12\t0\t1\t%s\t1 input.ini' % batch,
+                 '12\t1\t2\t%s\t2-3 input.ini' % batch,
+                 '13\t0\t5\t%s\t4 input.ini' % batch,
+                 'garbage line']
+        popen = FakePopen(lambda cmd: (0, '\n'.join(lines) + '\n', ''))
+        with mock.patch.object(submission, 'Popen', popen):
+            snapshot = self.cluster._query_snapshot(study)
+        self.assertEqual(popen.calls[0][0], 'condor_q')
+        self.assertIn('regexp("%s", JobBatchName)' % study, popen.calls[0])
+        self.assertEqual(snapshot.jobs, {
+            '12.0': (jobtracker.IDLE, batch, '1'),
+            '12.1': (jobtracker.RUNNING, batch, '2-3'),
+            '13.0': (jobtracker.HELD, batch, '4')})
+        self.assertTrue(snapshot.complete)
+        self.assertEqual(snapshot.task_state(3), jobtracker.RUNNING)
+        self.assertEqual(sorted(snapshot.unfinished()),
+                         ['12.0', '12.1', '13.0'])
+        self.assertEqual(snapshot.unknown(['99.0']), [])
+        self.assertEqual(snapshot.batch(batch),
+                         {'1': '12.0', '2-3': '12.1', '4': '13.0'})
+
+        popen = FakePopen(lambda cmd: (1, '', 'Failed to connect'))
+        with mock.patch.object(submission, 'Popen', popen):
+            self.assertIsNone(self.cluster._query_snapshot(study))
+
+    def test_status_snapshot(self):
+        study = '/tmp/ws/studies/st'
+        self.cluster.event_logs = False
+        queue = ['12\t0\t2\t%s/sixtrack_1\t1 input.ini' % study]
+        popen = FakePopen(lambda cmd: (0, '\n'.join(queue), ''))
+        with mock.patch.object(submission, 'Popen', popen):
+            first = self.cluster.status_snapshot(study)
+            # reused within the ttl, even for the jobs not in the queue
+            self.assertIs(self.cluster.status_snapshot(study, ['12.1']), first)
+            self.assertEqual(self.cluster.check_running(study), ['12.0'])
+            self.assertEqual(len(popen.calls), 1)
+
+            # queried again after the ttl or on demand
+            first.time -= self.cluster.snapshot_ttl
+            queue.append('12\t1\t1\t%s/sixtrack_1\t2 input.ini' % study)
+            second = self.cluster.status_snapshot(study)
+            self.assertIsNot(second, first)
+            self.assertEqual(len(popen.calls), 2)
+            self.assertEqual(sorted(self.cluster.check_running(study)),
+                             ['12.0', '12.1'])
+            third = self.cluster.status_snapshot(study, refresh=True)
+            self.assertIsNot(third, second)
+            self.assertEqual(len(popen.calls), 3)
+
+        # a failed query drops the cached snapshot
+        popen = FakePopen(lambda cmd: (1, '', 'Failed to connect'))
+        with mock.patch.object(submission, 'Popen', popen):
+            self.assertIsNone(self.cluster.status_snapshot(study,
+                                                           refresh=True))
+            self.assertIsNone(self.cluster.check_running(study))
+        self.assertEqual(self.cluster._snapshots, {})
+
+    def test_partial_snapshot(self):
+        # the jobs of the event logs, the unknown jobs trigger a condor_q
+        snapshot = submission.StatusSnapshot(
+            {'12.0': (jobtracker.COMPLETED, None, '1')}, complete=False)
+        self.assertEqual(snapshot.unknown(['12.0', '12.1']), ['12.1'])
+        self.assertEqual(snapshot.unfinished(), [])
+        self.assertIsNone(snapshot.state('12.1'))
+
+        study = '/tmp/ws/studies/st'
+        self.cluster._snapshots[study] = snapshot
+        popen = FakePopen(lambda cmd: (0, '', ''))
+        with mock.patch.object(submission, 'Popen', popen):
+            self.assertIs(self.cluster.status_snapshot(study, ['12.0']),
+                          snapshot)
+            self.assertEqual(popen.calls, [])
+            self.cluster.event_logs = False
+            out = self.cluster.status_snapshot(study, ['12.1'])
+        self.assertIsNot(out, snapshot)
+        self.assertEqual(len(popen.calls), 1)
+
     def tearDown(self):
         # remove jobs if they were submitted
         if self.jobs is not None:
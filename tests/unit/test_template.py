@@ -0,0 +1,31 @@
+import unittest
+from pathlib import Path
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import template
+
+
+class TemplateTest(unittest.TestCase):
+
+    def test_render(self):
+        tpl = template.compile_text('turns %turnss2 %turnss, %turnssX 5%\n')
+        # the longest parameter name wins, whatever the order
+        out = tpl.render({'turnss': 10, 'turnss2': 20})
+        self.assertEqual(out, 'turns 20 10, 10X 5%\n')
+        # the values aren't scanned again
+        self.assertEqual(tpl.render({'turnss': '%turnss2', 'turnss2': 1}),
+                         'turns 1 %turnss2, %turnss2X 5%\n')
+        self.assertEqual(tpl.unresolved(['seed']),
+                         ['turnss', 'turnss2', 'turnssX'])
+        self.assertIs(template.compile_text(tpl.text), tpl)
+
+    def test_render_many(self):
+        tpl = template.compile_text('seed=%SEEDRAN; qp=%QP;')
+        out = tpl.render_many([(1, 2), (3, 4)], ['SEEDRAN', 'QP'])
+        self.assertEqual(out, ['seed=1; qp=2;', 'seed=3; qp=4;'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,13 @@
 import unittest
 import shutil
 from pathlib import Path
+from unittest import mock
 import sys
 # give the test runner the import access
 pysixdesk_path = str(Path(__file__).parents[2].absolute())
 sys.path.insert(0, pysixdesk_path)
 from pysixdesk.lib import utils
+from pysixdesk.lib import compression
 
 
 class UtilsTest(unittest.TestCase):
@@ -46,6 +48,35 @@ class UtilsTest(unittest.TestCase):
         out = [l.rstrip() for l in out]
         self.assertEqual(out, ['1', 'var = 2.5;', 'var=100000000000.0, var;'])
 
+    def test_slot_cpus(self):
+        machine_ad = self.test_folder / '.machine.ad'
+        machine_ad.write_text('CpuBusy = false\nCpus = 4\n'
+                              'TotalCpus = 32\nMemory = 8000\n')
+        env = {'_CONDOR_MACHINE_AD': str(machine_ad),
+               'OMP_NUM_THREADS': '2'}
+        with mock.patch.dict('os.environ', env):
+            self.assertEqual(utils.slot_cpus(), 4)
+            machine_ad.write_text('TotalCpus = 32\n')
+            self.assertEqual(utils.slot_cpus(), 2)
+            machine_ad.unlink()
+            self.assertEqual(utils.slot_cpus(), 2)
+        with mock.patch.dict('os.environ', {'OMP_NUM_THREADS': 'x'}):
+            self.assertEqual(utils.slot_cpus(), 1)
+        with mock.patch.dict('os.environ', clear=True):
+            self.assertEqual(utils.slot_cpus(), 1)
+
+    def test_slot_memory(self):
+        machine_ad = self.test_folder / '.machine.ad'
+        machine_ad.write_text('Cpus = 4\nMemory = 8000\n'
+                              'TotalMemory = 64000\n')
+        with mock.patch.dict('os.environ',
+                             {'_CONDOR_MACHINE_AD': str(machine_ad)}):
+            self.assertEqual(utils.slot_memory(), 8000)
+            machine_ad.write_text('TotalMemory = 64000\n')
+            self.assertIsNone(utils.slot_memory())
+        with mock.patch.dict('os.environ', clear=True):
+            self.assertIsNone(utils.slot_memory())
+
     def test_compress_buf(self):
         # with strings
         in_str = 'qwertyuiopasdfghjklzxcvbnm_-./'
@@ -56,6 +87,36 @@ class UtilsTest(unittest.TestCase):
 
         # with gzip ...
 
+    def test_compress_buf_codec(self):
+        in_str = 'qwertyuiopasdfghjklzxcvbnm_-./' * 10
+        for codec in ['none', 'zlib', 'zlib:1']:
+            in_str_comp = utils.compress_buf(in_str, source='str', codec=codec)
+            self.assertEqual(compression.blob_codec(in_str_comp),
+                             codec.split(':')[0])
+            in_str_decomp = utils.decompress_buf(in_str_comp, None, des='buf')
+            self.assertEqual(in_str, in_str_decomp)
+        # the legacy gzip blobs are still understood
+        in_str_comp = utils.compress_buf(in_str, source='str')
+        self.assertEqual(compression.blob_codec(in_str_comp), 'gzip')
+        self.assertEqual(utils.decompress_buf(in_str_comp, None, des='buf'),
+                         in_str)
+        # corrupted blobs are detected
+        in_str_comp = bytearray(utils.compress_buf(in_str, source='str',
+                                                   codec='none'))
+        in_str_comp[-1] ^= 0xff
+        with self.assertRaises(ValueError):
+            utils.decompress_buf(bytes(in_str_comp), None, des='buf')
+        with self.assertRaises(ValueError):
+            utils.compress_buf(in_str, source='str', codec='unknown')
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard not installed')
+    def test_compress_buf_zstd(self):
+        in_str = 'qwertyuiopasdfghjklzxcvbnm_-./' * 10
+        in_str_comp = utils.compress_buf(in_str, source='str', codec='zstd:9')
+        self.assertEqual(compression.blob_codec(in_str_comp), 'zstd')
+        self.assertEqual(utils.decompress_buf(in_str_comp, None, des='buf'),
+                         in_str)
+
     def test_concatenate_files(self):
         utils.concatenate_files([self.concat_file_in_1, self.concat_file_in_2],
                                 self.concat_file_out)
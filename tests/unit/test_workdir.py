@@ -0,0 +1,100 @@
+import unittest
+import shutil
+import os
+from pathlib import Path
+from unittest import mock
+import sys
+# give the test runner the import access
+pysixdesk_path = str(Path(__file__).parents[2].absolute())
+sys.path.insert(0, pysixdesk_path)
+from pysixdesk.lib import workdir
+from pysixdesk.lib.workdir import WorkDir
+
+
+class WorkDirTest(unittest.TestCase):
+
+    def setUp(self):
+        # prepare a testing folder
+        self.test_folder = Path('unit_test/workdir/').absolute()
+        self.test_folder.mkdir(parents=True, exist_ok=True)
+        (self.test_folder / 'fort.2').write_text('two')
+        (self.test_folder / 'fort.6').write_text('old')
+
+    def test_policies(self):
+        for policy in ['cwd', 'scratch', 'auto']:
+            with WorkDir('temp', ['fort.2'], policy,
+                         parent=self.test_folder) as work:
+                self.assertEqual((work.path / 'fort.2').read_text(), 'two')
+                (work.path / 'fort.6').write_text(policy)
+                (work.path / 'fort.10').write_text('ten')
+                moved = work.move_out(['fort.2', 'fort.6', 'fort.10',
+                                       'missing'])
+            self.assertFalse(work.path.exists())
+            self.assertEqual(moved[-2:], ['fort.6', 'fort.10'])
+            self.assertEqual((self.test_folder / 'fort.6').read_text(),
+                             policy)
+            self.assertEqual(work.io['out'][0], len(moved))
+
+    def test_missing_input(self):
+        with self.assertRaises(FileNotFoundError):
+            with WorkDir('temp', ['fort.8'], 'cwd', parent=self.test_folder):
+                pass
+        self.assertFalse((self.test_folder / 'temp').exists())
+        with self.assertRaises(ValueError):
+            WorkDir('temp', policy='nfs')
+
+    def test_default(self):
+        with mock.patch.dict('os.environ', clear=True):
+            with WorkDir('temp', ['fort.2'], parent=self.test_folder) as work:
+                self.assertEqual(work.location, 'scratch')
+                self.assertTrue(work.path.name.startswith('pysixdesk_temp_'))
+            # shm is skipped without the memory of the slot
+            with WorkDir('temp', policy='auto', size=1,
+                         parent=self.test_folder) as work:
+                self.assertEqual(work.location, 'scratch')
+
+    @unittest.skipUnless(os.access(workdir.SHM, os.W_OK),
+                         "/dev/shm isn't writable")
+    def test_shm_limit(self):
+        machine_ad = self.test_folder / '.machine.ad'
+        machine_ad.write_text('Cpus = 1\nMemory = 100\n')
+        env = {'_CONDOR_MACHINE_AD': str(machine_ad)}
+        with mock.patch.dict('os.environ', env):
+            with WorkDir('temp', policy='auto', size=20,
+                         parent=self.test_folder) as work:
+                self.assertEqual(work.location, 'shm')
+            # more than a quarter of the slot memory
+            with WorkDir('temp', policy='auto', size=30,
+                         parent=self.test_folder) as work:
+                self.assertEqual(work.location, 'scratch')
+            with self.assertRaises(OSError):
+                with WorkDir('temp', policy='shm', size=30,
+                             parent=self.test_folder):
+                    pass
+
+    def test_clean_stale(self):
+        root = self.test_folder / 'root'
+        for name in ['pysixdesk_dead', 'pysixdesk_nolock', 'other']:
+            (root / name).mkdir(parents=True)
+        (root / 'pysixdesk_dead' / workdir.LOCK).touch()
+        (root / 'other' / workdir.LOCK).touch()
+        (root / 'pysixdesk_file').touch()
+        with mock.patch.object(workdir, 'scratch_root', lambda: str(root)):
+            with WorkDir('temp', policy='scratch',
+                         parent=self.test_folder) as work:
+                self.assertEqual(work.path.parent, root)
+                # the folder of a killed job is removed, not the others
+                self.assertEqual(sorted(i.name for i in root.iterdir()),
+                                 sorted(['pysixdesk_nolock', 'other',
+                                         'pysixdesk_file', work.path.name]))
+                # the folder in use is kept
+                self.assertEqual(workdir.clean_stale(root), [])
+                self.assertTrue(work.path.is_dir())
+        self.assertFalse(work.path.exists())
+
+    def tearDown(self):
+        shutil.rmtree(self.test_folder.parents[0], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()